@@ -0,0 +1,38 @@
+"""
+Async versions of the USstates.queries reads, on data.db_connect_async.
+They share the state cache with USstates.queries; writes still go
+through USstates.queries.
+"""
+import data.db_connect_async as adbc
+import USstates.queries as qry
+
+
+async def load_cache():
+    if not await adbc.is_available():
+        raise ConnectionError('cannot connect')
+    qry.install_cache(
+        [state async for state in adbc.read_iter(qry.STATE_COLLECTION)]
+    )
+
+
+async def _ensure_cache():
+    if qry.cache is None:
+        await load_cache()
+
+
+async def read() -> list[dict]:
+    """Async qry.read(): every state, shared with the cache (read-only)."""
+    await _ensure_cache()
+    return qry.read()
+
+
+async def read_one(code: str, country_code: str = None):
+    """Async qry.read_one(): a cached state by code (and country), or None."""
+    await _ensure_cache()
+    return qry.read_one(code, country_code)
+
+
+async def read_by_country(country_code: str) -> list[dict]:
+    """Async qry.read_by_country()."""
+    await _ensure_cache()
+    return qry.read_by_country(country_code)
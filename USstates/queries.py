@@ -1,5 +1,8 @@
+import re
 from functools import wraps
 
+from pymongo.errors import PyMongoError
+
 import data.db_connect as dbc
 from data.db_connect import is_valid_id  # noqa F401
 
@@ -19,25 +22,80 @@ SAMPLE_STATE = {
     COUNTRY_CODE: SAMPLE_COUNTRY,
 }
 
+# One state per (code, country); create() relies on this.
+dbc.register_index(STATE_COLLECTION,
+                   [(CODE, dbc.ASC), (COUNTRY_CODE, dbc.ASC)],
+                   unique=True)
+
+# (code, country_code) -> state; None until load_cache() has run, so an
+# empty collection is not mistaken for an unloaded one.
 cache = None
+# Bumped on every change to cache, so callers can tell when it moved on.
+cache_version = 0
+
+# Secondary indexes over cache:
+# upper-cased postal code -> keys of the states using it
+code_index = {}
+# upper-cased country code -> keys of its states
+country_index = {}
 
 
 def needs_cache(fn, *args, **kwargs):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        if not cache:
+        if cache is None:
             load_cache()
         return fn(*args, **kwargs)
     return wrapper
 
 
+def _serialize(state: dict) -> dict:
+    """
+    Make a JSON-ready copy of a state, done once when it is cached so
+    reads can hand out the cached record as is.
+    """
+    s = dict(state)
+    if dbc.MONGO_ID in s:
+        s[dbc.MONGO_ID] = str(s[dbc.MONGO_ID])
+    return s
+
+
+def _index(key: tuple) -> None:
+    code, country_code = key
+    keys = code_index.setdefault(str(code).upper(), [])
+    if key not in keys:
+        keys.append(key)
+    country_index.setdefault(str(country_code).upper(), set()).add(key)
+
+
+def _unindex(key: tuple) -> None:
+    code, country_code = key
+    keys = code_index.get(str(code).upper(), [])
+    if key in keys:
+        keys.remove(key)
+    country_index.get(str(country_code).upper(), set()).discard(key)
+
+
+def _cache_put(key: tuple, state: dict) -> None:
+    global cache_version
+    cache[key] = _serialize(state)
+    _index(key)
+    cache_version += 1
+
+
+def _cache_pop(key: tuple) -> None:
+    global cache_version
+    if cache is not None and cache.pop(key, None) is not None:
+        _unindex(key)
+        cache_version += 1
+
+
 @needs_cache
 def count() -> int:
     return len(cache)
 
 
-@needs_cache
-def create(flds: dict) -> str:
+def validate(flds: dict) -> None:
     if not isinstance(flds, dict):
         raise ValueError(f'Bad type for {type(flds)=}')
     code = flds.get(CODE)
@@ -49,49 +107,156 @@ def create(flds: dict) -> str:
     if not country_code:
         raise ValueError(f'Bad value for {country_code=}')
 
-    if (code, country_code) in cache:
-        raise ValueError(f'Duplicate key: {code=}; {country_code=}')
-
-    res = dbc.create(STATE_COLLECTION, flds)
 
-    # dbc.create may return InsertOneResult, ObjectId, or a string id.
-    if hasattr(res, "inserted_id"):
-        new_id = res.inserted_id
-    else:
-        new_id = res
+@needs_cache
+def create(flds: dict) -> str:
+    validate(flds)
+    code = flds[CODE]
+    country_code = flds[COUNTRY_CODE]
+    new_id = dbc.insert_unique(STATE_COLLECTION,
+                               {CODE: code, COUNTRY_CODE: country_code},
+                               flds)
+    if new_id is None:
+        raise ValueError(f'Duplicate key: {code=}; {country_code=}')
 
-    new_id = str(new_id)
     print(f'{new_id=}')
-    load_cache()
+    _cache_put((code, country_code), dict(flds))
     return new_id
 
 
+@needs_cache
+def create_many(recs: list, ordered: bool = True,
+                batch_size: int = dbc.DEFAULT_BATCH_SIZE) -> list[dict]:
+    """
+    Create many states with batched upserts; duplicates are detected by
+    the DB as part of the write.
+
+    Returns one result per input record, in input order:
+    {'index': i, 'id': new_id} or {'index': i, 'error': msg}.
+    With `ordered`, everything after the first invalid record or failed
+    write is skipped; a duplicate is reported but is not a failure, so
+    the records after it are still written. If the DB can't be written
+    to at all, every record still pending gets that error.
+    """
+    if not isinstance(recs, list):
+        raise ValueError(f'Bad type for {type(recs)=}')
+
+    results = [{} for _ in recs]
+    pending = []
+    for i, flds in enumerate(recs):
+        try:
+            validate(flds)
+        except ValueError as err:
+            results[i] = {dbc.INDEX: i, dbc.ERROR: str(err)}
+            if ordered:
+                for j in range(i + 1, len(recs)):
+                    results[j] = {dbc.INDEX: j, dbc.ERROR: dbc.SKIPPED_MSG}
+                break
+            continue
+        pending.append((i, flds))
+
+    try:
+        report = dbc.create_many_unique(STATE_COLLECTION,
+                                        [dict(flds) for _, flds in pending],
+                                        [CODE, COUNTRY_CODE],
+                                        ordered=ordered,
+                                        batch_size=batch_size)
+    except PyMongoError as err:
+        report = {dbc.INSERTED_IDS: {}}
+        db_failed = {j: f'DB write failed: {err}'
+                     for j in range(len(pending))}
+    else:
+        db_failed = dbc.failed_indexes(report)
+    for j, (i, flds) in enumerate(pending):
+        key = (flds[CODE], flds[COUNTRY_CODE])
+        if j in db_failed:
+            results[i] = {dbc.INDEX: i, dbc.ERROR: db_failed[j]}
+        elif j in report[dbc.INSERTED_IDS]:
+            results[i] = {dbc.INDEX: i, ID: report[dbc.INSERTED_IDS][j]}
+            _cache_put(key, dict(flds))
+        else:
+            results[i] = {dbc.INDEX: i,
+                          dbc.ERROR: f'Duplicate key: code={key[0]!r}; '
+                                     f'country_code={key[1]!r}'}
+    return results
+
+
 def delete(code: str, cntry_code: str) -> bool:
     ret = dbc.delete(STATE_COLLECTION, {CODE: code, COUNTRY_CODE: cntry_code})
     if ret < 1:
         raise ValueError(f'State not found: {code}, {cntry_code}')
-    load_cache()
+    _cache_pop((code, cntry_code))
     return ret
 
 
 @needs_cache
 def read() -> list[dict]:
-    out = []
-    for state in cache.values():
-        s = dict(state)
-        if "_id" in s:
-            s["_id"] = str(s["_id"])
-        out.append(s)
-    return out
+    """
+    Every state, as JSON-ready records shared with the cache: treat them
+    as read-only.
+    """
+    return list(cache.values())
 
 
+@needs_cache
+def read_one(code: str, country_code: str = None):
+    """
+    Look a state up by postal code (any case) through code_index, and by
+    country too if given; with no country the first state using the code
+    wins. Returns the cached JSON-ready record (treat it as read-only),
+    or None.
+    """
+    for key in code_index.get(str(code).upper(), []):
+        if country_code and str(key[1]).upper() != country_code.upper():
+            continue
+        rec = cache.get(key)
+        if rec is not None:
+            return rec
+    return None
+
+
+@needs_cache
+def read_by_country(country_code: str) -> list[dict]:
+    """Every cached state in one country, found through country_index."""
+    keys = country_index.get(str(country_code).upper(), set())
+    return [cache[key] for key in keys if key in cache]
+
+
+def export(country_code: str = None, fields: list = None):
+    """
+    Stream the matching states straight from the DB, bypassing the cache.
+    `fields` limits each record to those fields. Country codes are stored
+    as given, so they are matched ignoring case, as read_by_country() does
+    (the states collection is small enough not to need an index for it).
+    """
+    if not dbc.is_available():
+        raise ConnectionError('cannot connect')
+    filt = {}
+    if country_code:
+        filt[COUNTRY_CODE] = {'$regex': f'^{re.escape(country_code)}$',
+                              '$options': 'i'}
+    return dbc.read_iter(STATE_COLLECTION, filt,
+                         projection=dbc.fields_projection(fields))
+
 
 def load_cache():
-    global cache
-    cache = {}
-    states = dbc.read(STATE_COLLECTION)
+    if not dbc.is_available():
+        raise ConnectionError('cannot connect')
+    install_cache(dbc.read_iter(STATE_COLLECTION))
+
+
+def install_cache(states) -> None:
+    """Replace the cache (and its indexes) with the given state docs."""
+    global cache, cache_version
+    new_cache = {}
     for state in states:
-        cache[(state[CODE], state[COUNTRY_CODE])] = state
+        new_cache[(state[CODE], state[COUNTRY_CODE])] = _serialize(state)
+    cache = new_cache
+    code_index.clear()
+    country_index.clear()
+    for key in cache:
+        _index(key)
+    cache_version += 1
 
 
 def main():
@@ -0,0 +1,20 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+import USstates.async_queries as aqry
+import USstates.queries as qry
+
+
+async def state_docs(*args, **kwargs):
+    yield dict(qry.SAMPLE_STATE)
+
+
+@patch('data.db_connect_async.read_iter', side_effect=state_docs)
+@patch('data.db_connect_async.is_available',
+       new=AsyncMock(return_value=True))
+def test_read_one_loads_cache(mock_read_iter):
+    with patch.object(qry, 'cache', None):
+        rec = asyncio.run(aqry.read_one(qry.SAMPLE_CODE.lower()))
+        assert rec[qry.NAME] == qry.SAMPLE_STATE[qry.NAME]
+        asyncio.run(aqry.read())
+        assert mock_read_iter.call_count == 1
@@ -2,7 +2,10 @@ from copy import deepcopy
 
 from unittest.mock import patch
 import pytest
+from pymongo.errors import AutoReconnect
 
+import data.db_connect as dbc
+import data.memory_backend as mb
 import USstates.queries as qry
 
 
@@ -96,4 +99,104 @@ def test_read(temp_state):
     assert any(
         s.get(qry.CODE) == temp_rec[qry.CODE] and s.get(qry.COUNTRY_CODE) == temp_rec[qry.COUNTRY_CODE]
         for s in states
-    )
\ No newline at end of file
+    )
+
+
+@patch('data.db_connect.is_available', return_value=True)
+@patch('data.db_connect.read_iter', return_value=iter([qry.SAMPLE_STATE]))
+def test_load_cache(mock_read_iter, mock_available):
+    old_cache = qry.cache
+    try:
+        qry.load_cache()
+        assert qry.cache == {qry.SAMPLE_KEY: qry.SAMPLE_STATE}
+    finally:
+        qry.cache = old_cache
+
+
+@patch('data.db_connect.insert_unique', return_value=None)
+def test_create_dup_detected_by_db(mock_insert_unique):
+    with patch.object(qry, 'cache', {}):
+        with pytest.raises(ValueError):
+            qry.create(get_temp_rec())
+
+
+@patch('data.db_connect.create_many_unique',
+       return_value={'errors': [], 'skipped': [],
+                     'inserted_ids': {0: 'abc'}, 'duplicates': [1]})
+def test_create_many_reports_duplicates(mock_create_many):
+    with patch.object(qry, 'cache', {}):
+        results = qry.create_many([get_temp_rec(), get_temp_rec()])
+        assert results[0][qry.ID] == 'abc'
+        assert 'Duplicate' in results[1]['error']
+        assert (TEMP_CODE, qry.SAMPLE_COUNTRY) in qry.cache
+
+
+@patch('data.db_connect.create_many_unique',
+       side_effect=AutoReconnect('db down'))
+def test_create_many_reports_db_failure(mock_create_many):
+    with patch.object(qry, 'cache', {}):
+        results = qry.create_many([get_temp_rec(), get_temp_rec()])
+        assert [res['index'] for res in results] == [0, 1]
+        assert all('db down' in res['error'] for res in results)
+        assert qry.cache == {}
+
+
+@patch('data.db_connect.is_available', return_value=False)
+def test_load_cache_cant_connect(mock_available):
+    with pytest.raises(ConnectionError):
+        qry.load_cache()
+
+
+@patch('data.db_connect.insert_unique', return_value='abc123')
+@patch('data.db_connect.delete', return_value=1)
+def test_create_delete_update_cache_in_place(mock_delete, mock_insert):
+    with patch.object(qry, 'cache', {}), \
+            patch('USstates.queries.load_cache') as mock_load:
+        old_version = qry.cache_version
+        temp_rec = get_temp_rec()
+        qry.create(temp_rec)
+        assert qry.count() == 1
+        qry.delete(temp_rec[qry.CODE], temp_rec[qry.COUNTRY_CODE])
+        assert qry.count() == 0
+        assert qry.cache_version == old_version + 2
+        mock_load.assert_not_called()
+
+
+@patch('data.db_connect.is_available', return_value=True)
+@patch('data.db_connect.read_iter')
+def test_read_one_and_by_country(mock_read_iter, mock_available):
+    mock_read_iter.return_value = iter([
+        qry.SAMPLE_STATE,
+        {qry.NAME: 'Nayarit', qry.CODE: 'NY', qry.COUNTRY_CODE: 'MEX'},
+        {qry.NAME: 'New Jersey', qry.CODE: 'NJ', qry.COUNTRY_CODE: 'USA'},
+    ])
+    with patch.object(qry, 'cache', None):
+        assert qry.read_one('ny')[qry.NAME] == 'New York'
+        assert qry.read_one('NY', 'mex')[qry.NAME] == 'Nayarit'
+        assert qry.read_one('NY', 'CAN') is None
+        assert qry.read_one('ZZ') is None
+        assert len(qry.read_by_country('usa')) == 2
+        # pre-serialized: the same record comes back each time
+        assert qry.read_one('NJ') is qry.read_one('NJ')
+
+
+@patch('data.db_connect.is_available', return_value=True)
+@patch('data.db_connect.read_iter', return_value=iter([qry.SAMPLE_STATE]))
+def test_export(mock_read_iter, mock_available):
+    assert list(qry.export(country_code='usa', fields=[qry.CODE])) \
+        == [qry.SAMPLE_STATE]
+    assert mock_read_iter.call_args.kwargs['projection'] == {qry.CODE: 1}
+
+
+def test_export_ignores_country_case():
+    mb.reset()
+    with patch('data.db_connect.client', mb.MemoryClient()), \
+            patch('data.db_connect.connect_db'), \
+            patch('data.db_connect.is_available', return_value=True):
+        dbc.create(qry.STATE_COLLECTION,
+                   {qry.NAME: 'Ontario', qry.CODE: 'ON',
+                    qry.COUNTRY_CODE: 'Can'})
+        found = list(qry.export(country_code='can', fields=[qry.CODE]))
+        assert found == [{qry.CODE: 'ON'}]
+        assert list(qry.export(country_code='ca')) == []
+    mb.reset()
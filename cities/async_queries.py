@@ -0,0 +1,106 @@
+"""
+Async versions of the cities.queries reads, on data.db_connect_async.
+
+They share city_cache and its indexes with cities.queries, so sync and
+async callers can be mixed; writes still go through cities.queries.
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Any
+
+import cities.queries as qry
+import data.db_connect_async as adbc
+
+
+async def _ensure_loaded() -> bool:
+    """
+    Load every city into the cache unless it is already there; returns
+    whether it all fits. The docs are fetched on this loop but cached
+    (qry.fill_cache(), CPU-bound for a big collection) in a worker
+    thread, so the loop keeps serving other requests meanwhile.
+    Once the collection is known not to fit, returns False straight away.
+    """
+    qry.city_cache.purge()
+    if qry.cache_loaded:
+        return True
+    if qry.cache_overflow:
+        return False
+    if (qry.city_cache.max_entries is not None
+            and not qry.fits(await adbc.count(qry.CITY_COLLECTION))):
+        return False
+    docs = adbc.read_iter(qry.CITY_COLLECTION, no_id=False)
+    return await asyncio.to_thread(
+        qry.fill_cache,
+        adbc.blocking_iter(docs, asyncio.get_running_loop()),
+    )
+
+
+async def read() -> dict[str, dict[str, Any]]:
+    """
+    Async qry.read(): load cities from the DB into the cache (if needed)
+    and return the cache.
+
+    Raises:
+        ConnectionError: if the DB is not reachable.
+        ValueError: if a bounded cache can't hold them all.
+    """
+    if not await adbc.is_available():
+        raise ConnectionError("cannot connect")
+
+    if not await _ensure_loaded():
+        raise ValueError(qry.TOO_MANY_MSG)
+    return qry.city_cache
+
+
+async def read_one(city_id: str) -> dict[str, Any] | None:
+    """
+    Async qry.read_one(): a single city by its internal ID, from the
+    cache or else one indexed DB lookup; None if not found.
+
+    Raises:
+        ValueError: if the id is clearly invalid.
+        ConnectionError: if the DB is not reachable.
+    """
+    if not qry.is_valid_id(city_id):
+        raise ValueError(f"Invalid city id: {city_id!r}")
+
+    if not await adbc.is_available():
+        raise ConnectionError("cannot connect")
+
+    if qry.cache_mode == qry.EAGER:
+        await _ensure_loaded()
+
+    rec = qry.city_cache.get(city_id)
+    if rec is not None:
+        return rec
+    doc = await adbc.read_one(qry.CITY_COLLECTION, {qry.ID: city_id})
+    legacy = qry.legacy_filter(city_id)
+    if doc is None and legacy:
+        doc = await adbc.read_one(qry.CITY_COLLECTION, legacy)
+    if doc is None:
+        return None
+    return qry.cache_doc(doc)
+
+
+async def read_by_state(state_code: str) -> list[dict[str, Any]]:
+    """
+    Async qry.read_by_state(): from the cache's state index when the
+    whole collection is cached, otherwise from the DB.
+
+    Raises:
+        ConnectionError: if the DB is not reachable.
+    """
+    if not await adbc.is_available():
+        raise ConnectionError("cannot connect")
+
+    if qry.cache_loaded:
+        return qry.cached_in_state(state_code)
+
+    return [
+        qry.from_doc(doc)
+        async for doc in adbc.read_iter(
+            qry.CITY_COLLECTION, {qry.STATE_CODE: qry.state_key(state_code)},
+            no_id=False,
+        )
+    ]
@@ -0,0 +1,111 @@
+"""
+Geographic helpers for city coordinates, and an in-memory KD-tree for
+nearest-city lookups.
+"""
+from __future__ import annotations
+
+import heapq
+import math
+from typing import Any, Iterable
+
+# Mean Earth radius.
+EARTH_RADIUS_KM = 6371.0088
+
+
+def point(lat: float, lon: float) -> dict[str, Any]:
+    """A GeoJSON Point, as Mongo's 2dsphere indexes expect (lon first)."""
+    return {"type": "Point", "coordinates": [lon, lat]}
+
+
+def unit_vector(lat: float, lon: float) -> tuple[float, float, float]:
+    """Where (lat, lon) sits on the unit sphere."""
+    phi, lam = math.radians(lat), math.radians(lon)
+    return (math.cos(phi) * math.cos(lam),
+            math.cos(phi) * math.sin(lam),
+            math.sin(phi))
+
+
+def chord_to_km(chord: float) -> float:
+    """Great-circle distance for a straight-line chord of the unit sphere."""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def km_to_chord(km: float) -> float:
+    if km >= math.pi * EARTH_RADIUS_KM:
+        return 2.0
+    return 2 * math.sin(km / (2 * EARTH_RADIUS_KM))
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points, in km."""
+    return chord_to_km(math.dist(unit_vector(lat1, lon1),
+                                 unit_vector(lat2, lon2)))
+
+
+class KDTree:
+    """
+    A static 3-d tree over points on the unit sphere. Straight-line
+    distance there grows with great-circle distance, so the k nearest
+    points in 3-d are the k nearest on the globe, with no trouble at the
+    poles or the antimeridian.
+    """
+
+    def __init__(self, items: Iterable[tuple[str, float, float]]):
+        """`items` are (key, lat, lon) triples."""
+        self._keys: list[str] = []
+        self._points: list[tuple[float, float, float]] = []
+        for key, lat, lon in items:
+            self._keys.append(key)
+            self._points.append(unit_vector(lat, lon))
+        # node i: (point index, split axis, left node, right node); -1 = none
+        self._nodes: list[tuple[int, int, int, int]] = []
+        self._root = self._build(list(range(len(self._points))), 0)
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def _build(self, idxs: list[int], depth: int) -> int:
+        if not idxs:
+            return -1
+        axis = depth % 3
+        idxs.sort(key=lambda i: self._points[i][axis])
+        mid = len(idxs) // 2
+        node = len(self._nodes)
+        self._nodes.append((idxs[mid], axis, -1, -1))
+        left = self._build(idxs[:mid], depth + 1)
+        right = self._build(idxs[mid + 1:], depth + 1)
+        self._nodes[node] = (idxs[mid], axis, left, right)
+        return node
+
+    def nearest(self, lat: float, lon: float, k: int,
+                max_km: float | None = None) -> list[tuple[str, float]]:
+        """
+        (key, distance in km) for the `k` points nearest (lat, lon),
+        nearest first, leaving out any further than `max_km`.
+        """
+        if k < 1 or self._root < 0:
+            return []
+        target = unit_vector(lat, lon)
+        limit = km_to_chord(max_km) ** 2 if max_km is not None else math.inf
+        best: list[tuple[float, int]] = []  # max-heap of (-dist², point)
+        # (node, a lower bound on dist² to anything under it)
+        stack = [(self._root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            worst = -best[0][0] if len(best) == k else limit
+            if node < 0 or bound > min(worst, limit):
+                continue
+            idx, axis, left, right = self._nodes[node]
+            pt = self._points[idx]
+            d2 = sum((a - b) ** 2 for a, b in zip(pt, target))
+            if d2 <= limit:
+                if len(best) < k:
+                    heapq.heappush(best, (-d2, idx))
+                elif d2 < -best[0][0]:
+                    heapq.heapreplace(best, (-d2, idx))
+            diff = target[axis] - pt[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            stack.append((far, max(bound, diff * diff)))
+            stack.append((near, bound))
+        return [(self._keys[idx], chord_to_km(math.sqrt(-neg)))
+                for neg, idx in sorted(best, reverse=True)]
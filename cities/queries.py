@@ -1,36 +1,150 @@
 from __future__ import annotations
 
+import os
+import re
+import threading
 from copy import deepcopy
-from typing import Any, Dict
+from typing import Any, Iterator
 from uuid import uuid4
 
+from bson import ObjectId
+
 from data import db_connect as dbc
+from data.cache import BoundedCache
+from cities import geo
+from cities.search import PrefixIndex, TrigramIndex, normalize
 
 MIN_ID_LEN = 1
+
+TOO_MANY_MSG = "Too many cities to cache; use read_page() or export()"
+
 CITY_COLLECTION = "cities"
 ID = "id"
 NAME = "name"
+# normalize(name), stored on DB docs only, for DB prefix searches
+NAME_KEY = "name_key"
 STATE_CODE = "state_code"
+LAT = "lat"
+LON = "lon"
+# GeoJSON point kept in step with LAT/LON, for the 2dsphere index.
+LOCATION = "location"
+# Added to the results of near().
+DISTANCE = "distance_km"
+
+DEFAULT_SEARCH_LIMIT = 10
+DEFAULT_NEAR_K = 10
+
+# How the cache fills up:
+#   EAGER: the first lookup loads the whole collection.
+#   LAZY: lookups fetch only the record asked for (read-through), and
+#         the whole collection is loaded only when read() needs it.
+EAGER = "eager"
+LAZY = "lazy"
+cache_mode = os.getenv("CITY_CACHE_MODE", LAZY)
+
+
+def _env_num(name: str, kind=int):
+    """Read an optional numeric setting from the environment."""
+    val = os.getenv(name)
+    return kind(val) if val else None
+
 
 SAMPLE_CITY = {
     NAME: "TempCity",
     STATE_CODE: "ZZ",
 }
 
-# in-memory cache: key = internal city id, value = city record
-city_cache: dict[str, dict[str, Any]] = {}
+dbc.register_index(CITY_COLLECTION, NAME)
+# Serves search() when the cache is cold: a case-sensitive anchored
+# regex on the normalized name becomes a range scan of this index.
+dbc.register_index(CITY_COLLECTION, NAME_KEY)
+# Serves per-state reads and (state_code, name) deletes.
+dbc.register_index(CITY_COLLECTION, [(STATE_CODE, dbc.ASC), (NAME, dbc.ASC)])
+# Serves read_page() with a state filter: {state_code, _id > after}
+# sorted on _id is one range scan of this index.
+dbc.register_index(CITY_COLLECTION,
+                   [(STATE_CODE, dbc.ASC), (dbc.MONGO_ID, dbc.ASC)])
+
+# Ids are looked up directly; docs without one (see backfill_ids()) are
+# left out of the index.
+dbc.register_index(CITY_COLLECTION, ID, unique=True,
+                   partial={ID: {"$type": "string"}})
+
+# Serves near() when the cache is cold; cities without coordinates are
+# left out of the index.
+dbc.register_index(CITY_COLLECTION, [(LOCATION, dbc.GEOSPHERE)])
+
+
+def _on_evict(city_id: str, rec: dict[str, Any]) -> None:
+    """city_cache dropped a record: unindex it; the cache is now partial."""
+    global cache_loaded, cache_version
+    state_index.get(state_key(rec.get(STATE_CODE)), set()).discard(city_id)
+    with _search_lock:
+        if name_index_ready:
+            name_index.remove(rec.get(NAME), city_id)
+        if trigram_index_ready:
+            trigram_index.remove(city_id)
+    cache_loaded = False
+    cache_version += 1
+
+
+# in-memory cache: key = internal city id, value = city record.
+# Unbounded unless CITY_CACHE_MAX_ENTRIES / CITY_CACHE_MAX_BYTES are set,
+# in which case least recently used records are evicted; CITY_CACHE_TTL
+# (seconds) expires records so they are re-read from the DB.
+city_cache: BoundedCache = BoundedCache(
+    max_entries=_env_num("CITY_CACHE_MAX_ENTRIES"),
+    max_bytes=_env_num("CITY_CACHE_MAX_BYTES"),
+    ttl=_env_num("CITY_CACHE_TTL", float),
+    on_evict=_on_evict,
+)
+
+# True once read() has loaded the whole collection; until then
+# city_cache may hold only the records looked up or created so far.
+cache_loaded = False
+
+# True once the collection turned out too big for a bounded city_cache,
+# so full loads stop being tried (each would stream every city only to
+# evict most of them) until clear_cache() or a delete may have made room.
+cache_overflow = False
+
+# Bumped on every change to city_cache, so callers can tell when it moved on.
+cache_version = 0
+
+# secondary index over city_cache: upper-cased state code -> city ids
+state_index: dict[str, set[str]] = {}
+
+# secondary index over city_cache: city ids sorted by normalized name.
+# Built in one go by the first search that needs it (see _name_index()),
+# then kept in step with city_cache; read() drops it before a full load.
+name_index = PrefixIndex()
+name_index_ready = False
+# Keeps writes from slipping past an index while it is being built.
+_search_lock = threading.RLock()
+
+# secondary index over city_cache: name trigrams -> city ids, for fuzzy
+# search. Built, like name_index, by the first search that needs it.
+trigram_index = TrigramIndex()
+trigram_index_ready = False
+
+# KD-tree over the coordinates of the cached cities, and the
+# cache_version it was built at; see _geo_tree().
+geo_tree: geo.KDTree | None = None
+geo_tree_version = -1
+
+# statistic name -> (cache_version it was computed at, value);
+# see _memoized().
+stats_memo: dict[str, tuple[int, Any]] = {}
 
 
 def _can_connect() -> bool:
     """
     Small helper so tests can monkeypatch connectivity.
-    Prefer dbc.ping() if present; otherwise fall back to a simple read.
+    Asks dbc's connectivity tracker, which answers without a round trip
+    while its last health check is fresh, so warm reads stay off the network.
     """
     try:
-        if hasattr(dbc, "ping"):
-            return bool(dbc.ping())
-        _ = dbc.read(CITY_COLLECTION)
-        return True
+        return bool(dbc.is_available())
     except Exception:
         return False
 
@@ -40,14 +154,267 @@ def is_valid_id(_id: str) -> bool:
     return isinstance(_id, str) and len(_id) >= MIN_ID_LEN
 
 
+def legacy_filter(city_id: str) -> dict[str, Any] | None:
+    """
+    The DB filter for a doc written before ids were stored, whose id is
+    its Mongo _id (see from_doc()), or None if city_id can't be one.
+    Used when {ID: city_id} matches nothing; see also backfill_ids().
+    """
+    if ObjectId.is_valid(city_id):
+        return {dbc.MONGO_ID: ObjectId(city_id)}
+    return None
+
+
 def _next_id() -> str:
     """Generate a new internal city id."""
     return str(uuid4())
 
 
+def state_key(state_code: Any) -> str:
+    """State codes are stored and compared upper-cased."""
+    return str(state_code or "").upper()
+
+
+def from_doc(doc: dict[str, Any]) -> dict[str, Any]:
+    """Turn a DB doc into a city record, dropping the Mongo _id."""
+    mongo_id = doc.pop(dbc.MONGO_ID, None)
+    if not doc.get(ID):
+        # Docs written before ids were stored fall back to their Mongo id,
+        # which at least stays the same across restarts and workers.
+        doc[ID] = str(mongo_id) if mongo_id is not None else _next_id()
+    if STATE_CODE in doc:
+        # docs written before codes were normalized; see
+        # normalize_state_codes()
+        doc[STATE_CODE] = state_key(doc[STATE_CODE])
+    doc.pop(NAME_KEY, None)
+    return doc
+
+
+def to_doc(rec: dict[str, Any]) -> dict[str, Any]:
+    """The DB doc for a city record: a copy, with its NAME_KEY."""
+    return {**rec, NAME_KEY: normalize(rec.get(NAME))}
+
+
+def _cache_put(rec: dict[str, Any]) -> None:
+    """Add or replace a record in city_cache, keeping the indexes in step."""
+    global cache_version
+    old = city_cache.peek(rec[ID])
+    if old is not None:
+        state_index.get(state_key(old.get(STATE_CODE)), set()).discard(rec[ID])
+    city_cache[rec[ID]] = rec
+    state_index.setdefault(state_key(rec.get(STATE_CODE)), set()).add(rec[ID])
+    with _search_lock:
+        if name_index_ready:
+            if old is not None:
+                name_index.remove(old.get(NAME), rec[ID])
+            name_index.add(rec.get(NAME), rec[ID])
+        if trigram_index_ready:
+            trigram_index.add(rec.get(NAME), rec[ID])
+    cache_version += 1
+
+
+def _cache_pop(city_id: str) -> dict[str, Any] | None:
+    """Remove a record from city_cache and its indexes, returning it."""
+    global cache_version
+    rec = city_cache.pop(city_id, None)
+    if rec is not None:
+        state_index.get(state_key(rec.get(STATE_CODE)), set()).discard(city_id)
+        with _search_lock:
+            if name_index_ready:
+                name_index.remove(rec.get(NAME), city_id)
+            if trigram_index_ready:
+                trigram_index.remove(city_id)
+        cache_version += 1
+    return rec
+
+
+def _db_changed() -> None:
+    """
+    A write reached the DB without going through city_cache (e.g. the
+    delete of an uncached city): move cache_version on so memoized
+    statistics are recomputed, and let the next read() try a full load
+    again, as the collection may fit the cache now.
+    """
+    global cache_overflow, cache_version
+    cache_overflow = False
+    cache_version += 1
+
+
+def cache_doc(doc: dict[str, Any]) -> dict[str, Any]:
+    """Cache the city in a DB doc (see from_doc()) and return its record."""
+    rec = from_doc(doc)
+    _cache_put(rec)
+    return rec
+
+
+def _drop_search_indexes() -> None:
+    """Empty the search indexes; they are rebuilt when next needed."""
+    global name_index_ready, trigram_index_ready
+    with _search_lock:
+        name_index_ready = trigram_index_ready = False
+        name_index.clear()
+        trigram_index.clear()
+
+
+def _name_index() -> PrefixIndex:
+    """name_index, built from city_cache if it hasn't been yet."""
+    global name_index_ready
+    with _search_lock:
+        if not name_index_ready:
+            name_index.build((rec.get(NAME), cid)
+                             for cid, rec in list(city_cache.items()))
+            name_index_ready = True
+    return name_index
+
+
+def _trigram_index() -> TrigramIndex:
+    """trigram_index, built from city_cache if it hasn't been yet."""
+    global trigram_index_ready
+    with _search_lock:
+        if not trigram_index_ready:
+            trigram_index.build((rec.get(NAME), cid)
+                                for cid, rec in list(city_cache.items()))
+            trigram_index_ready = True
+    return trigram_index
+
+
+def cached_in_state(state_code: str) -> list[dict[str, Any]]:
+    """
+    Cached cities in a state, found through state_index.
+    Entries are re-checked against city_cache in case it was changed
+    behind our back.
+    """
+    code = state_key(state_code)
+    recs = []
+    for cid in list(state_index.get(code, ())):
+        rec = city_cache.peek(cid)
+        if rec is not None and state_key(rec.get(STATE_CODE)) == code:
+            recs.append(rec)
+    return recs
+
+
+def _memoized(name: str, compute):
+    """compute()'s result, reused until cache_version moves on."""
+    hit = stats_memo.get(name)
+    if hit is not None and hit[0] == cache_version:
+        return hit[1]
+    version = cache_version
+    value = compute()
+    stats_memo[name] = (version, value)
+    return value
+
+
 def num_cities() -> int:
-    """Return the number of cities currently known (via read())."""
-    return len(read())
+    """
+    Return the number of cities: the cache size once the whole
+    collection is cached, otherwise counted by the DB.
+
+    Raises:
+        ConnectionError: if the DB is not reachable.
+    """
+    if not _can_connect():
+        raise ConnectionError("cannot connect")
+    if cache_loaded:
+        return len(city_cache)
+    return _memoized("count", lambda: dbc.count(CITY_COLLECTION))
+
+
+def _count_by_state() -> dict[str, int]:
+    if cache_loaded:
+        counts = {code: len(cached_in_state(code)) for code in state_index}
+        return {code: n for code, n in counts.items() if n}
+    counts: dict[str, int] = {}
+    for code, n in dbc.group_count(CITY_COLLECTION, STATE_CODE).items():
+        key = state_key(code)
+        counts[key] = counts.get(key, 0) + n
+    return counts
+
+
+def count_by_state() -> dict[str, int]:
+    """
+    How many cities each state has: {upper-cased state code: count}.
+
+    Counted through state_index when the whole collection is cached, and
+    otherwise by a $group on the DB; either way the result is kept until
+    cache_version moves on. Treat it as read-only.
+
+    Raises:
+        ConnectionError: if the DB is not reachable.
+    """
+    if not _can_connect():
+        raise ConnectionError("cannot connect")
+    return _memoized("by_state", _count_by_state)
+
+
+def count_in_state(state_code: str) -> int:
+    """
+    How many cities a state has, from count_by_state().
+
+    Raises:
+        ConnectionError: if the DB is not reachable.
+    """
+    return count_by_state().get(state_key(state_code), 0)
+
+
+def _coords(flds: dict[str, Any]) -> tuple[float, float] | None:
+    """
+    The (lat, lon) of a city as floats, or None if it has no coordinates.
+
+    Raises:
+        ValueError: if only one of them is given, or either is out of range.
+    """
+    lat, lon = flds.get(LAT), flds.get(LON)
+    if lat is None and lon is None:
+        return None
+    if lat is None or lon is None:
+        raise ValueError("lat and lon must be given together")
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        raise ValueError(f"Bad coordinates: {lat!r}, {lon!r}")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"Coordinates out of range: {lat}, {lon}")
+    return lat, lon
+
+
+def _with_location(rec: dict[str, Any]) -> dict[str, Any]:
+    """Store rec's coordinates as floats, with a GeoJSON LOCATION to match."""
+    coords = _coords(rec)
+    if coords is None:
+        rec.pop(LOCATION, None)
+    else:
+        rec[LAT], rec[LON] = coords
+        rec[LOCATION] = geo.point(*coords)
+    return rec
+
+
+def validate(flds: dict[str, Any]) -> None:
+    """
+    Check that `flds` can be stored as a city.
+
+    Raises:
+        ValueError: if required fields are missing, the coordinates are
+            bad, or flds is not a dict.
+    """
+    if not isinstance(flds, dict):
+        raise ValueError(f"Bad type for {type(flds)=}")
+    if not flds.get(NAME):
+        raise ValueError("Missing city name")
+    if not flds.get(STATE_CODE):
+        raise ValueError("Missing state code")
+    _coords(flds)
+
+
+def prepare(flds: dict[str, Any]) -> dict[str, Any]:
+    """
+    The city record create() would store for `flds`, which must have
+    passed validate(): a copy with the state code normalized, the
+    coordinates parsed (see LOCATION) and a new ID.
+    """
+    rec = _with_location(deepcopy(flds))
+    rec[STATE_CODE] = state_key(rec[STATE_CODE])
+    rec[ID] = _next_id()
+    return rec
 
 
 def create(flds: dict[str, Any]) -> str:
@@ -63,53 +430,113 @@ def create(flds: dict[str, Any]) -> str:
     Raises:
         ValueError: if required fields are missing or flds is not a dict.
     """
-    if not isinstance(flds, dict):
-        raise ValueError(f"Bad type for {type(flds)=}")
-    if not flds.get(NAME):
-        raise ValueError("Missing city name")
-    if not flds.get(STATE_CODE):
-        raise ValueError("Missing state code")
+    validate(flds)
 
-    new_id = _next_id()
-    rec = deepcopy(flds)
-    rec[ID] = new_id
-    city_cache[new_id] = rec
+    rec = prepare(flds)
+    new_id = rec[ID]
+    _cache_put(rec)
 
     # Best-effort write to DB; failures are swallowed so cache still works.
     try:
-        dbc.create(CITY_COLLECTION, flds)
+        dbc.create(CITY_COLLECTION, to_doc(rec))
     except Exception:
         pass
 
     return new_id
 
 
+def create_many(
+    recs: list,
+    ordered: bool = True,
+    batch_size: int = dbc.DEFAULT_BATCH_SIZE,
+) -> list[dict[str, Any]]:
+    """
+    Create many cities with batched DB writes instead of one round trip each.
+
+    Args:
+        recs: a list of mappings, each valid for create().
+        ordered: if True, stop at the first bad record and skip the rest;
+            otherwise try every record.
+        batch_size: how many records to send to the DB per round trip.
+
+    Returns:
+        One result per input record, in input order: {"index": i, "id": id}
+        for a created city, or {"index": i, "error": msg} for a failure
+        (including a DB write that failed; such cities are not cached).
+
+    Raises:
+        ValueError: if recs is not a list.
+    """
+    if not isinstance(recs, list):
+        raise ValueError(f"Bad type for {type(recs)=}")
+
+    results: list[dict[str, Any]] = [{} for _ in recs]
+    pending: list[tuple[int, dict[str, Any]]] = []
+    for i, flds in enumerate(recs):
+        try:
+            validate(flds)
+        except ValueError as err:
+            results[i] = {dbc.INDEX: i, dbc.ERROR: str(err)}
+            if ordered:
+                for j in range(i + 1, len(recs)):
+                    results[j] = {dbc.INDEX: j, dbc.ERROR: dbc.SKIPPED_MSG}
+                break
+            continue
+        pending.append((i, prepare(flds)))
+
+    # Unlike create(), a failed write is reported back: per record, or
+    # for every record still pending if the whole batch failed.
+    db_failed: dict[int, str] = {}
+    try:
+        report = dbc.create_many(
+            CITY_COLLECTION,
+            [to_doc(rec) for _, rec in pending],
+            ordered=ordered,
+            batch_size=batch_size,
+        )
+        db_failed = dbc.failed_indexes(report)
+    except Exception as err:
+        db_failed = {j: f"DB write failed: {err}"
+                     for j in range(len(pending))}
+
+    for j, (i, rec) in enumerate(pending):
+        if j in db_failed:
+            results[i] = {dbc.INDEX: i, dbc.ERROR: db_failed[j]}
+            continue
+        _cache_put(rec)
+        results[i] = {dbc.INDEX: i, ID: rec[ID]}
+    return results
+
+
 def delete(*args: str) -> bool:
     """
     Delete a city.
 
     Usage:
-        delete(city_id)                 -> delete from cache (and try DB)
+        delete(city_id)                 -> delete from cache and DB
         delete(name, state_code)       -> delete from DB and cache
 
     Raises:
         ValueError: if the city does not exist for the given key(s).
         TypeError: if called with the wrong number of arguments.
     """
-    # Case 1: Delete by internal city ID from the in-memory cache (used by older tests)
+    # Case 1: Delete by internal city ID, from the cache and the DB
     if len(args) == 1:
         city_id = args[0]
-        if city_id not in city_cache:
-            raise ValueError(f"No such city: {city_id}")
-        rec = city_cache.pop(city_id)
+        rec = _cache_pop(city_id)
+        deleted = 0
         try:
-            if rec and NAME in rec and STATE_CODE in rec:
-                dbc.delete(
-                    CITY_COLLECTION,
-                    {NAME: rec[NAME], STATE_CODE: rec[STATE_CODE]},
-                )
+            if rec is not None or _can_connect():
+                deleted = dbc.delete(CITY_COLLECTION, {ID: city_id})
+                legacy = legacy_filter(city_id)
+                if deleted < 1 and legacy:
+                    deleted = dbc.delete(CITY_COLLECTION, legacy)
         except Exception:
             pass
+        if deleted > 0:
+            _db_changed()
+        if rec is None and deleted < 1:
+            raise ValueError(f"No such city: {city_id}")
         return True
 
     # Case 2: Delete by city name and state code, removing from both MongoDB and the local cache
@@ -117,17 +544,15 @@ def delete(*args: str) -> bool:
         name, state_code = args
         deleted = dbc.delete(
             CITY_COLLECTION,
-            {NAME: name, STATE_CODE: state_code},
+            {NAME: name, STATE_CODE: state_key(state_code)},
         )
         if deleted < 1:
             raise ValueError(f"City not found: {name}, {state_code}")
+        _db_changed()
 
-        ids_to_del: list[str] = []
-        for cid, rec in city_cache.items():
-            if rec.get(NAME) == name and rec.get(STATE_CODE) == state_code:
-                ids_to_del.append(cid)
-        for cid in ids_to_del:
-            del city_cache[cid]
+        for rec in cached_in_state(state_code):
+            if rec.get(NAME) == name:
+                _cache_pop(rec[ID])
         return True
 
     # Case 3: Invalid argument count — enforce correct usage
@@ -149,61 +574,456 @@ def update(city_id: str, updates: dict[str, Any]) -> dict[str, Any]:
     if not isinstance(updates, dict):
         raise ValueError(f"Bad type for updates: {type(updates)!r}")
 
-    cities = read()  # ensure cache is loaded and DB reachable
-    rec = cities.get(city_id)
+    rec = read_one(city_id)  # raises if the DB is unreachable
     if rec is None:
         raise ValueError(f"No such city: {city_id}")
 
+    # ids are fixed once stored
+    updates = {k: v for k, v in updates.items() if k != ID}
+    if STATE_CODE in updates:
+        updates[STATE_CODE] = state_key(updates[STATE_CODE])
+
     # compute new record
     new_rec = deepcopy(rec)
     new_rec.update(updates)
-    city_cache[city_id] = new_rec
+    if LAT in updates or LON in updates:
+        _with_location(new_rec)
+        for fld in (LAT, LON, LOCATION):
+            updates[fld] = new_rec.get(fld)
+    _cache_put(new_rec)
+    if NAME in updates:
+        updates[NAME_KEY] = normalize(new_rec.get(NAME))
 
     # best-effort update in DB
     try:
-        dbc.update(
-            CITY_COLLECTION,
-            {NAME: rec.get(NAME), STATE_CODE: rec.get(STATE_CODE)},
-            updates,
-        )
+        result = dbc.update(CITY_COLLECTION, {ID: city_id}, updates)
+        legacy = legacy_filter(city_id)
+        if result.matched_count == 0 and legacy:
+            # store the id while we are at it, as backfill_ids() would
+            dbc.update(CITY_COLLECTION, legacy, {**updates, ID: city_id})
     except Exception:
         pass
 
     return new_rec
 
+
+def fill_cache(docs) -> bool:
+    """
+    Put every city doc streamed by `docs` (the whole collection) in
+    city_cache. Returns whether they all fit, in which case cache_loaded
+    is set; with a bounded cache too small for the collection it ends up
+    holding only the most recent records.
+
+    This is CPU-bound for a big collection: async callers should run it
+    in a thread (as cities.async_queries does).
+    """
+    global cache_loaded, cache_overflow
+    evicted_before = city_cache.evictions
+    expired_before = city_cache.expirations
+    # Adding 100k names one by one to the search indexes is slow (the
+    # sorted name index quadratically so); let the next search build
+    # them in one pass instead.
+    _drop_search_indexes()
+    for doc in docs:
+        cache_doc(doc)
+    if city_cache.evictions > evicted_before:
+        cache_overflow = True
+        return False
+    if city_cache.expirations > expired_before:
+        return False
+    cache_loaded = True
+    return True
+
+
+def fits(count: int) -> bool:
+    """
+    Whether a full load of `count` cities is worth trying: False once a
+    load has overflowed city_cache (see cache_overflow), or if `count` is
+    more than its max_entries, which is then remembered.
+    """
+    global cache_overflow
+    limit = city_cache.max_entries
+    if limit is not None and count > limit:
+        cache_overflow = True
+    return not cache_overflow
+
+
+def _ensure_loaded() -> bool:
+    """
+    Load the whole collection into city_cache unless it is already
+    there; returns whether it is (see fill_cache()). Once it is known not
+    to fit, returns False straight away; callers then go to the DB.
+    """
+    city_cache.purge()  # expired records make the cache partial
+    if cache_loaded:
+        return True
+    if cache_overflow:
+        return False
+    if (city_cache.max_entries is not None
+            and not fits(dbc.count(CITY_COLLECTION))):
+        return False
+    return fill_cache(dbc.read_iter(CITY_COLLECTION, no_id=False))
+
+
 def read() -> dict[str, dict[str, Any]]:
     """
     Load cities from DB into the cache (if needed) and return the cache.
 
     Raises:
         ConnectionError: if the DB is not reachable.
+        ValueError: if the collection is bigger than a bounded city_cache
+            can hold; read it with export() or read_page() instead.
     """
     if not _can_connect():
         raise ConnectionError("cannot connect")
 
-    if city_cache:
-        return city_cache
-
-    recs = dbc.read(CITY_COLLECTION)
-    for rec in recs:
-        rec = dict(rec)
-        cid = rec.get(ID) or _next_id()
-        rec[ID] = cid
-        city_cache[cid] = rec
+    if not _ensure_loaded():
+        raise ValueError(TOO_MANY_MSG)
     return city_cache
 
+
+def read_by_state(state_code: str) -> list[dict[str, Any]]:
+    """
+    Return the cities in one state.
+
+    Served from the cache's per-state index when the whole collection is
+    cached;
+    otherwise only that state's docs are read from the DB, using the
+    (state_code, name) index.
+
+    Raises:
+        ConnectionError: if the DB is not reachable.
+    """
+    if not _can_connect():
+        raise ConnectionError("cannot connect")
+
+    if cache_loaded:
+        return cached_in_state(state_code)
+
+    return [
+        from_doc(doc)
+        for doc in dbc.read_iter(
+            CITY_COLLECTION, {STATE_CODE: state_key(state_code)}, no_id=False,
+        )
+    ]
+
+
+def _cached_search(prefix: str, state_code: str | None,
+                   limit: int) -> list[dict[str, Any]]:
+    """
+    Cached cities matching a prefix, found through name_index.
+    Entries are re-checked against city_cache in case it was changed
+    behind our back.
+    """
+    norm = normalize(prefix)
+    code = state_key(state_code) if state_code else None
+    recs: list[dict[str, Any]] = []
+    seen: set[str] = set()
+    for cid in _name_index().prefix(prefix):
+        if len(recs) >= limit:
+            break
+        rec = city_cache.peek(cid)
+        if rec is None or cid in seen:
+            continue
+        if not normalize(rec.get(NAME)).startswith(norm):
+            continue
+        if code and state_key(rec.get(STATE_CODE)) != code:
+            continue
+        seen.add(cid)
+        recs.append(rec)
+    return recs
+
+
+def _fuzzy_search(text: str, state_code: str | None,
+                  limit: int) -> list[dict[str, Any]]:
+    """
+    Cached cities whose names are most like `text`, best first, found
+    through trigram_index. Loads the cache first if need be; with a
+    bounded cache too small for the collection only cached cities count
+    (and the collection is not streamed again on every search).
+    """
+    _ensure_loaded()
+    code = state_key(state_code) if state_code else None
+    recs: list[dict[str, Any]] = []
+    for cid, _score in _trigram_index().similar(text):
+        if len(recs) >= limit:
+            break
+        rec = city_cache.peek(cid)
+        if rec is None:
+            continue
+        if code and state_key(rec.get(STATE_CODE)) != code:
+            continue
+        recs.append(rec)
+    return recs
+
+
+def search(
+    prefix: str,
+    state_code: str | None = None,
+    limit: int = DEFAULT_SEARCH_LIMIT,
+    fuzzy: bool = False,
+) -> list[dict[str, Any]]:
+    """
+    Type-ahead search: up to `limit` cities whose name starts with
+    `prefix`, in name order, optionally only in one state.
+
+    Served from name_index (ignoring case and accents) when the whole
+    collection is cached; otherwise by an anchored regex on the stored
+    NAME_KEY, which the DB answers from its index.
+
+    With `fuzzy`, `prefix` is instead matched against whole names,
+    tolerating typos, and the closest names come first; this is always
+    served from the cache.
+
+    Raises:
+        ValueError: if the prefix is empty.
+        ConnectionError: if the DB is not reachable.
+    """
+    if not normalize(prefix):
+        raise ValueError("Empty search prefix")
+    if not _can_connect():
+        raise ConnectionError("cannot connect")
+
+    if fuzzy:
+        return _fuzzy_search(prefix, state_code, limit)
+    if cache_loaded:
+        return _cached_search(prefix, state_code, limit)
+
+    filt: dict[str, Any] = {
+        NAME_KEY: {"$regex": "^" + re.escape(normalize(prefix))},
+    }
+    if state_code:
+        filt[STATE_CODE] = state_key(state_code)
+    return [
+        from_doc(doc)
+        for doc in dbc.read_iter(CITY_COLLECTION, filt, no_id=False,
+                                 sort=NAME_KEY, limit=limit)
+    ]
+
+
+def _geo_tree() -> geo.KDTree:
+    """
+    The KD-tree over the cached cities with coordinates, rebuilt when
+    city_cache has changed since it was last built.
+    """
+    global geo_tree, geo_tree_version
+    if geo_tree is None or geo_tree_version != cache_version:
+        version = cache_version
+        geo_tree = geo.KDTree(
+            (cid, rec[LAT], rec[LON])
+            for cid, rec in list(city_cache.items())
+            if rec.get(LAT) is not None and rec.get(LON) is not None
+        )
+        geo_tree_version = version
+    return geo_tree
+
+
+def near(
+    lat: float,
+    lon: float,
+    k: int = DEFAULT_NEAR_K,
+    radius_km: float | None = None,
+) -> list[dict[str, Any]]:
+    """
+    The `k` cities nearest (lat, lon), nearest first, each with its
+    DISTANCE in km; only those within `radius_km`, if given.
+
+    Served from a KD-tree over the cached cities when the whole
+    collection is cached; otherwise by a $nearSphere query on the
+    2dsphere index. The records are copies, so they may be changed.
+
+    Raises:
+        ValueError: on bad coordinates, k or radius.
+        ConnectionError: if the DB is not reachable.
+    """
+    lat, lon = _coords({LAT: lat, LON: lon})
+    if k < 1:
+        raise ValueError(f"Bad k: {k}")
+    if radius_km is not None and radius_km < 0:
+        raise ValueError(f"Bad radius: {radius_km}")
+    if not _can_connect():
+        raise ConnectionError("cannot connect")
+
+    if cache_loaded:
+        recs = []
+        for cid, km in _geo_tree().nearest(lat, lon, k, radius_km):
+            rec = city_cache.peek(cid)
+            if rec is not None:
+                recs.append({**rec, DISTANCE: round(km, 3)})
+        return recs
+
+    near_spec: dict[str, Any] = {"$geometry": geo.point(lat, lon)}
+    if radius_km is not None:
+        near_spec["$maxDistance"] = radius_km * 1000  # meters
+    recs = []
+    for doc in dbc.read_iter(CITY_COLLECTION,
+                             {LOCATION: {"$nearSphere": near_spec}},
+                             no_id=False, limit=k):
+        rec = from_doc(doc)
+        doc_lon, doc_lat = rec[LOCATION]["coordinates"]
+        km = geo.haversine_km(lat, lon, doc_lat, doc_lon)
+        rec[DISTANCE] = round(km, 3)
+        recs.append(rec)
+    return recs
+
+
+def read_page(
+    limit: int,
+    after: str | None = None,
+    state_code: str | None = None,
+) -> tuple[list[dict[str, Any]], str | None]:
+    """
+    Read one page of cities straight from the DB, in insertion order.
+
+    Args:
+        limit: the page size.
+        after: the token returned with the previous page, if any.
+        state_code: only return cities in this state.
+
+    Returns:
+        (cities, next_token), where next_token is None on the last page.
+
+    Raises:
+        ConnectionError: if the DB is not reachable.
+        ValueError: on a bad page token or limit.
+    """
+    if not _can_connect():
+        raise ConnectionError("cannot connect")
+
+    filt = {STATE_CODE: state_key(state_code)} if state_code else None
+    docs, next_token = dbc.read_page(
+        CITY_COLLECTION, limit, after=after, filt=filt,
+    )
+    return [from_doc(doc) for doc in docs], next_token
+
+
+def export(
+    state_code: str | None = None,
+    name: str | None = None,
+    fields: list[str] | None = None,
+) -> Iterator[dict[str, Any]]:
+    """
+    Stream the matching cities straight from the DB, without touching the
+    cache, so memory stays flat however many there are.
+
+    Args:
+        state_code: only cities in this state.
+        name: only cities with this exact name.
+        fields: only these fields of each city; all of them by default.
+
+    Raises:
+        ConnectionError: if the DB is not reachable.
+    """
+    if not _can_connect():
+        raise ConnectionError("cannot connect")
+
+    filt = {}
+    if state_code:
+        filt[STATE_CODE] = state_key(state_code)
+    if name:
+        filt[NAME] = name
+    docs = dbc.read_iter(CITY_COLLECTION, filt, no_id=False,
+                         projection=dbc.fields_projection(fields))
+    if not fields:
+        return (from_doc(doc) for doc in docs)
+    # The projection keeps _id, so from_doc() can still fall back on it
+    # for the id; what it adds beyond `fields` is dropped again.
+    keep = {field.split(".")[0] for field in fields}
+    return ({fld: val for fld, val in from_doc(doc).items() if fld in keep}
+            for doc in docs)
+
+
 def read_one(city_id: str) -> dict[str, Any] | None:
     """
     Return a single city record by its internal ID, or None if not found.
 
+    In EAGER cache_mode the whole collection is loaded first; in LAZY mode
+    only this record is fetched on a cache miss.
+
     Raises:
         ValueError: if the id is clearly invalid.
+        ConnectionError: if the DB is not reachable.
     """
     if not is_valid_id(city_id):
         raise ValueError(f"Invalid city id: {city_id!r}")
 
-    cities = read()  # ensures cache is populated (and DB reachable)
-    return cities.get(city_id)
+    if not _can_connect():
+        raise ConnectionError("cannot connect")
+
+    if cache_mode == EAGER:
+        _ensure_loaded()
+
+    rec = city_cache.get(city_id)
+    if rec is not None:
+        return rec
+    # Cache miss: one indexed lookup rather than loading every city,
+    # and keep the result for next time.
+    doc = dbc.read_one(CITY_COLLECTION, {ID: city_id})
+    legacy = legacy_filter(city_id)
+    if doc is None and legacy:
+        doc = dbc.read_one(CITY_COLLECTION, legacy)
+    if doc is None:
+        return None
+    return cache_doc(doc)
+
+
+def clear_cache() -> None:
+    """Forget every cached city; the next read starts cold."""
+    global cache_loaded, cache_overflow, cache_version
+    city_cache.clear()
+    state_index.clear()
+    _drop_search_indexes()
+    stats_memo.clear()
+    cache_loaded = cache_overflow = False
+    cache_version += 1
+
+
+def backfill_ids(batch_size: int = dbc.DEFAULT_BATCH_SIZE) -> int:
+    """
+    One-time migration: store an id on every city doc written before ids
+    were persisted. The id is the doc's Mongo _id, which is what read()
+    has been reporting for such docs, so existing ids stay valid.
+
+    Returns:
+        The number of docs updated.
+    """
+    return dbc.backfill_field(
+        CITY_COLLECTION, ID,
+        lambda doc: str(doc[dbc.MONGO_ID]),
+        batch_size=batch_size,
+    )
+
+
+def backfill_name_keys(batch_size: int = dbc.DEFAULT_BATCH_SIZE) -> int:
+    """
+    One-time migration: store NAME_KEY on city docs written before it
+    was, so cold-cache searches find them.
+
+    Returns:
+        The number of docs updated.
+    """
+    return dbc.backfill_field(
+        CITY_COLLECTION, NAME_KEY,
+        lambda doc: normalize(doc.get(NAME)),
+        batch_size=batch_size,
+    )
+
+
+def normalize_state_codes() -> int:
+    """
+    One-time migration: upper-case the state_code of docs written before
+    codes were normalized on write, so the DB's per-state queries find
+    them as the cache does.
+
+    Returns:
+        The number of docs updated.
+    """
+    updated = 0
+    for code in dbc.distinct(CITY_COLLECTION, STATE_CODE):
+        if isinstance(code, str) and code != state_key(code):
+            updated += dbc.update_many(CITY_COLLECTION, {STATE_CODE: code},
+                                       {STATE_CODE: state_key(code)})
+    return updated
 
 
 def main() -> None:
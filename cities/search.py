@@ -0,0 +1,185 @@
+"""
+In-memory indexes over city names, for type-ahead search.
+"""
+from __future__ import annotations
+
+import bisect
+import threading
+import unicodedata
+from typing import Any, Iterator
+
+
+def normalize(name: Any) -> str:
+    """Fold case, accents and runs of whitespace so names compare loosely."""
+    text = unicodedata.normalize("NFKD", str(name or ""))
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.casefold().split())
+
+
+class PrefixIndex:
+    """
+    (normalized name, key) pairs kept sorted, so every name starting with
+    a prefix is found by bisection and a short forward scan.
+    """
+
+    def __init__(self):
+        self._entries: list[tuple[str, str]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def build(self, pairs) -> None:
+        """
+        Replace the contents with (name, key) `pairs` in one sort, which is
+        far cheaper than add()ing them one at a time.
+        """
+        entries = sorted({(normalize(name), key) for name, key in pairs})
+        with self._lock:
+            self._entries = entries
+
+    def add(self, name: Any, key: str) -> None:
+        entry = (normalize(name), key)
+        with self._lock:
+            i = bisect.bisect_left(self._entries, entry)
+            if i == len(self._entries) or self._entries[i] != entry:
+                self._entries.insert(i, entry)
+
+    def remove(self, name: Any, key: str) -> None:
+        entry = (normalize(name), key)
+        with self._lock:
+            i = bisect.bisect_left(self._entries, entry)
+            if i < len(self._entries) and self._entries[i] == entry:
+                del self._entries[i]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def prefix(self, prefix: str) -> Iterator[str]:
+        """Yield the keys of names starting with `prefix`, in name order."""
+        norm = normalize(prefix)
+        with self._lock:
+            i = bisect.bisect_left(self._entries, (norm,))
+        while True:
+            with self._lock:
+                if i >= len(self._entries):
+                    return
+                name, key = self._entries[i]
+            if not name.startswith(norm):
+                return
+            yield key
+            i += 1
+
+
+# Similarity below this isn't worth returning as a fuzzy match.
+MIN_SIMILARITY = 0.3
+
+# Names scored per fuzzy query at most, however common its trigrams are.
+MAX_CANDIDATES = 2000
+
+
+def trigrams(name: Any) -> frozenset[str]:
+    """The trigrams of a normalized name, padded so word edges count."""
+    grams = set()
+    for word in normalize(name).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+class TrigramIndex:
+    """
+    Inverted index from trigrams to keys, for typo-tolerant lookups:
+    names are scored by the share of trigrams they have in common with
+    the query (Jaccard similarity).
+    """
+
+    def __init__(self):
+        self._postings: dict[str, set[str]] = {}
+        self._grams: dict[str, frozenset[str]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._grams)
+
+    def _unlink(self, key: str) -> None:
+        for gram in self._grams.pop(key, ()):
+            posting = self._postings.get(gram)
+            if posting is not None:
+                posting.discard(key)
+                if not posting:
+                    del self._postings[gram]
+
+    def build(self, pairs) -> None:
+        """Replace the contents with (name, key) `pairs`."""
+        grams = {key: trigrams(name) for name, key in pairs}
+        postings: dict[str, set[str]] = {}
+        for key, key_grams in grams.items():
+            for gram in key_grams:
+                postings.setdefault(gram, set()).add(key)
+        with self._lock:
+            self._grams = grams
+            self._postings = postings
+
+    def add(self, name: Any, key: str) -> None:
+        """Index `key` under `name`, replacing any name it had before."""
+        grams = trigrams(name)
+        with self._lock:
+            self._unlink(key)
+            self._grams[key] = grams
+            for gram in grams:
+                self._postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            self._unlink(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._postings.clear()
+            self._grams.clear()
+
+    def similar(self, query: str, min_score: float = MIN_SIMILARITY,
+                max_candidates: int = MAX_CANDIDATES
+                ) -> list[tuple[str, float]]:
+        """
+        (key, score) for every name at least `min_score` similar to
+        `query`, best first.
+
+        Rare trigrams are looked at first, and at most `max_candidates`
+        names are considered, so very common trigrams can't make a
+        query scan most of the index.
+        """
+        qgrams = trigrams(query)
+        if not qgrams:
+            return []
+        with self._lock:
+            postings = [self._postings[g] for g in qgrams
+                        if g in self._postings]
+            postings.sort(key=len)
+            shared: dict[str, int] = {}
+            for posting in postings:
+                # count this trigram for the names we already have...
+                if len(shared) < len(posting):
+                    for key in shared:
+                        if key in posting:
+                            shared[key] += 1
+                else:
+                    for key in posting:
+                        if key in shared:
+                            shared[key] += 1
+                # ...and take on new names while there is room
+                if len(shared) < max_candidates:
+                    for key in posting:
+                        if key not in shared:
+                            shared[key] = 1
+                            if len(shared) >= max_candidates:
+                                break
+            scored = []
+            for key, common in shared.items():
+                score = common / (len(qgrams) + len(self._grams[key]) - common)
+                if score >= min_score:
+                    scored.append((key, score))
+        scored.sort(key=lambda pair: (-pair[1], pair[0]))
+        return scored
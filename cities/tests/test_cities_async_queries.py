@@ -0,0 +1,96 @@
+import asyncio
+import threading
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+import cities.async_queries as aqry
+import cities.queries as qry
+
+
+def test_read_one_from_cache():
+    rec = {qry.ID: "c1", qry.NAME: "Albany", qry.STATE_CODE: "NY"}
+    with patch.dict("cities.queries.city_cache", {"c1": rec}, clear=True), \
+            patch("data.db_connect_async.is_available",
+                  new=AsyncMock(return_value=True)), \
+            patch("data.db_connect_async.read_one") as mock_read_one:
+        assert asyncio.run(aqry.read_one("c1")) is rec
+        mock_read_one.assert_not_called()
+
+
+def test_read_one_miss_fetches_and_caches():
+    doc = {"_id": "abc", qry.ID: "c2", qry.NAME: "Trenton",
+           qry.STATE_CODE: "NJ"}
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.cache_mode", qry.LAZY), \
+            patch("data.db_connect_async.is_available",
+                  new=AsyncMock(return_value=True)), \
+            patch("data.db_connect_async.read_one",
+                  new=AsyncMock(return_value=doc)):
+        rec = asyncio.run(aqry.read_one("c2"))
+        assert rec[qry.NAME] == "Trenton"
+        assert qry.city_cache["c2"] is rec
+        assert [c[qry.ID] for c in qry.cached_in_state("NJ")] == ["c2"]
+
+
+def test_read_one_db_down():
+    with patch("data.db_connect_async.is_available",
+               new=AsyncMock(return_value=False)):
+        with pytest.raises(ConnectionError):
+            asyncio.run(aqry.read_one("c1"))
+
+
+def test_read_by_state_streams_from_db():
+    async def docs(*args, **kwargs):
+        yield {"_id": "abc", qry.NAME: "Albany", qry.STATE_CODE: "NY"}
+
+    with patch("cities.queries.cache_loaded", False), \
+            patch("data.db_connect_async.is_available",
+                  new=AsyncMock(return_value=True)), \
+            patch("data.db_connect_async.read_iter",
+                  side_effect=docs) as mock_iter:
+        found = asyncio.run(aqry.read_by_state("ny"))
+        assert found[0][qry.ID] == "abc"
+        assert mock_iter.call_args.args[1] == {qry.STATE_CODE: "NY"}
+
+
+def test_read_fills_cache_off_the_loop():
+    docs = [{"_id": f"oid{i}", qry.NAME: f"C{i}", qry.STATE_CODE: "NY"}
+            for i in range(5)]
+    threads = []
+
+    async def read_iter(*args, **kwargs):
+        for doc in docs:
+            yield dict(doc)
+
+    def fill_cache(recs):
+        threads.append(threading.current_thread())
+        return real_fill(recs)
+
+    real_fill = qry.fill_cache
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.cache_loaded", False), \
+            patch("cities.queries.fill_cache", side_effect=fill_cache), \
+            patch("data.db_connect_async.is_available",
+                  new=AsyncMock(return_value=True)), \
+            patch("data.db_connect_async.read_iter", side_effect=read_iter):
+        cities = asyncio.run(aqry.read())
+        assert sorted(cities) == [f"oid{i}" for i in range(5)]
+        assert qry.cache_loaded
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_read_too_many_skips_the_scan():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch.object(qry.city_cache, "max_entries", 2), \
+            patch("cities.queries.cache_loaded", False), \
+            patch("cities.queries.cache_overflow", False), \
+            patch("data.db_connect_async.is_available",
+                  new=AsyncMock(return_value=True)), \
+            patch("data.db_connect_async.count",
+                  new=AsyncMock(return_value=5)), \
+            patch("data.db_connect_async.read_iter") as mock_iter:
+        with pytest.raises(ValueError):
+            asyncio.run(aqry.read())
+        assert qry.cache_overflow
+        mock_iter.assert_not_called()
@@ -0,0 +1,38 @@
+import pytest
+
+import cities.geo as geo
+
+NYC = (40.7128, -74.0060)
+NEWARK = (40.7357, -74.1724)
+PHILLY = (39.9526, -75.1652)
+LA = (34.0522, -118.2437)
+
+
+def test_point():
+    assert geo.point(1.5, 2.5) == {"type": "Point", "coordinates": [2.5, 1.5]}
+
+
+def test_haversine_km():
+    assert geo.haversine_km(*NYC, *LA) == pytest.approx(3936, rel=0.01)
+    assert geo.haversine_km(*NYC, *NYC) == 0
+
+
+def test_kdtree_nearest():
+    tree = geo.KDTree([("la", *LA), ("philly", *PHILLY),
+                       ("newark", *NEWARK), ("nyc", *NYC)])
+    assert len(tree) == 4
+    found = tree.nearest(*NYC, k=2)
+    assert [key for key, _ in found] == ["nyc", "newark"]
+    assert found[1][1] == pytest.approx(geo.haversine_km(*NYC, *NEWARK))
+    assert [key for key, _ in tree.nearest(*NYC, k=10, max_km=200)] \
+        == ["nyc", "newark", "philly"]
+    assert tree.nearest(*NYC, k=0) == []
+
+
+def test_kdtree_across_antimeridian():
+    tree = geo.KDTree([("east", 0, 179.9), ("west", 0, -170)])
+    assert tree.nearest(0, -179.9, k=1)[0][0] == "east"
+
+
+def test_empty_kdtree():
+    assert geo.KDTree([]).nearest(0, 0, k=3) == []
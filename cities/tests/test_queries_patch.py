@@ -1,6 +1,21 @@
 from unittest.mock import patch
 import pytest
+from pymongo.errors import ConnectionFailure
 import cities.queries as qry
+import data.db_connect as dbc_mod
+import data.memory_backend as mb
+
+
+@pytest.fixture
+def memory_db():
+    """cities.queries on an empty in-memory DB, with a cold cache."""
+    mb.reset()
+    qry.clear_cache()
+    with patch("data.db_connect.client", mb.MemoryClient()), \
+            patch("cities.queries._can_connect", return_value=True):
+        yield dbc_mod.client
+    qry.clear_cache()
+    mb.reset()
 
 
 def test_read_raises_when_db_connect_fails():
@@ -31,7 +46,7 @@ def test_create_with_isolated_cache_via_patch_dict():
 def test_main_prints_result(monkeypatch):
     # fake print and make db_connect work
     with patch("cities.queries._can_connect", return_value=True), \
-        patch("cities.queries.dbc.read", return_value=[]):
+            patch("cities.queries.dbc.read_iter", return_value=iter([])):
         printed = []
         #help to verify print output
         def fake_print(x):
@@ -40,3 +55,510 @@ def test_main_prints_result(monkeypatch):
         monkeypatch.setattr("builtins.print", fake_print)
         qry.main()
         assert printed and isinstance(printed[0], dict)
+
+
+def test_create_many_reports_per_record():
+    report = {dbc_mod.INSERTED: 1, dbc_mod.ERRORS: [], dbc_mod.SKIPPED: []}
+    recs = [
+        {qry.NAME: "BulkCity", qry.STATE_CODE: "ZZ"},
+        {qry.STATE_CODE: "ZZ"},
+        {qry.NAME: "Unordered", qry.STATE_CODE: "ZZ"},
+    ]
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.dbc.create_many",
+                  return_value=report) as mock_create:
+        results = qry.create_many(recs, ordered=False)
+        assert len(mock_create.call_args.args[1]) == 2
+        assert qry.city_cache[results[0][qry.ID]][qry.NAME] == "BulkCity"
+        assert dbc_mod.ERROR in results[1]
+        assert results[2][qry.ID] in qry.city_cache
+
+
+def test_create_many_ordered_skips_after_failure():
+    report = {dbc_mod.ERRORS: [], dbc_mod.SKIPPED: []}
+    recs = [{}, {qry.NAME: "Skipped", qry.STATE_CODE: "ZZ"}]
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.dbc.create_many", return_value=report):
+        results = qry.create_many(recs)
+        assert results[1][dbc_mod.ERROR] == dbc_mod.SKIPPED_MSG
+        assert not qry.city_cache
+
+
+def test_create_many_db_write_error():
+    report = {dbc_mod.ERRORS: [{dbc_mod.INDEX: 0, dbc_mod.ERROR: "dup"}],
+              dbc_mod.SKIPPED: []}
+    recs = [{qry.NAME: "Dup", qry.STATE_CODE: "ZZ"}]
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.dbc.create_many", return_value=report):
+        assert qry.create_many(recs) == [{dbc_mod.INDEX: 0,
+                                          dbc_mod.ERROR: "dup"}]
+        assert not qry.city_cache
+
+
+def test_create_many_batch_failure_reported():
+    recs = [{qry.NAME: "Albany", qry.STATE_CODE: "NY"}, {},
+            {qry.NAME: "Troy", qry.STATE_CODE: "NY"}]
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.dbc.create_many",
+                  side_effect=ConnectionFailure("down")):
+        results = qry.create_many(recs, ordered=False)
+        assert [res[dbc_mod.INDEX] for res in results] == [0, 1, 2]
+        assert all(dbc_mod.ERROR in res for res in results)
+        assert "down" in results[2][dbc_mod.ERROR]
+        assert not qry.city_cache
+
+
+def test_read_page_uses_stored_or_mongo_id():
+    docs = [{"_id": "abc123", qry.NAME: "Old", qry.STATE_CODE: "NY"},
+            {"_id": "def456", qry.ID: "city-1", qry.NAME: "New",
+             qry.STATE_CODE: "NY"}]
+    with patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.read_page",
+                  return_value=(docs, "tok")) as mock_page:
+        cities, next_token = qry.read_page(2, state_code="ny")
+        assert [c[qry.ID] for c in cities] == ["abc123", "city-1"]
+        assert all("_id" not in c for c in cities)
+        assert next_token == "tok"
+        assert mock_page.call_args.kwargs["filt"] == {qry.STATE_CODE: "NY"}
+
+
+def test_state_page_index_registered():
+    keys = [spec[dbc_mod.IDX_KEY]
+            for spec in dbc_mod.index_registry[qry.CITY_COLLECTION]]
+    assert [(qry.STATE_CODE, dbc_mod.ASC), ("_id", dbc_mod.ASC)] in keys
+
+
+def test_export_streams_from_db():
+    docs = [{"_id": "abc123", qry.NAME: "Albany", qry.STATE_CODE: "NY"}]
+    with patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.read_iter",
+                  return_value=iter(docs)) as mock_read:
+        out = list(qry.export(state_code="ny", name="Albany"))
+        assert out[0][qry.ID] == "abc123"
+        assert mock_read.call_args.args[1] == {qry.STATE_CODE: "NY",
+                                               qry.NAME: "Albany"}
+        qry.export(fields=[qry.NAME])
+        assert mock_read.call_args.kwargs["projection"] == {qry.NAME: 1}
+
+
+def test_export_fields_converted_like_records(memory_db):
+    dbc_mod.create(qry.CITY_COLLECTION,
+                   {qry.NAME: "Albany", qry.STATE_CODE: "ny"})
+    legacy_id = str(dbc_mod.read_one(qry.CITY_COLLECTION, {})["_id"])
+    out = list(qry.export(fields=[qry.ID, qry.STATE_CODE]))
+    assert out == [{qry.ID: legacy_id, qry.STATE_CODE: "NY"}]
+    assert list(qry.export(fields=[qry.NAME])) == [{qry.NAME: "Albany"}]
+
+
+def test_export_raises_when_db_down():
+    with patch("cities.queries._can_connect", return_value=False):
+        with pytest.raises(ConnectionError):
+            qry.export()
+
+
+def test_search_from_cache():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.cache_loaded", True), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.create"), \
+            patch("cities.queries.dbc.update"), \
+            patch("cities.queries.dbc.delete", return_value=1):
+        ny_id = qry.create({qry.NAME: "New York", qry.STATE_CODE: "NY"})
+        nj_id = qry.create({qry.NAME: "Newark", qry.STATE_CODE: "NJ"})
+        qry.create({qry.NAME: "Albany", qry.STATE_CODE: "NY"})
+        assert [c[qry.ID] for c in qry.search("new")] == [ny_id, nj_id]
+        assert [c[qry.ID] for c in qry.search("NEW", "ny")] == [ny_id]
+        assert len(qry.search("new", limit=1)) == 1
+        qry.update(nj_id, {qry.NAME: "Trenton"})
+        assert [c[qry.ID] for c in qry.search("new")] == [ny_id]
+        qry.delete(ny_id)
+        assert qry.search("new") == []
+
+
+def test_fuzzy_search_tracks_writes():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.cache_loaded", True), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.create"), \
+            patch("cities.queries.dbc.update"):
+        pa_id = qry.create({qry.NAME: "Philadelphia", qry.STATE_CODE: "PA"})
+        ms_id = qry.create({qry.NAME: "Philadelphia", qry.STATE_CODE: "MS"})
+        qry.create({qry.NAME: "Pittsburgh", qry.STATE_CODE: "PA"})
+        found = qry.search("Philadelpia", fuzzy=True)
+        assert {c[qry.ID] for c in found} == {pa_id, ms_id}
+        assert [c[qry.ID] for c in
+                qry.search("philly delphia", "pa", fuzzy=True)] == [pa_id]
+        qry.update(ms_id, {qry.NAME: "Jackson"})
+        assert [c[qry.ID] for c in
+                qry.search("Philadelpia", fuzzy=True)] == [pa_id]
+
+
+def test_create_stores_location():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.dbc.create") as mock_create:
+        new_id = qry.create({qry.NAME: "Albany", qry.STATE_CODE: "NY",
+                             qry.LAT: "42.65", qry.LON: -73.75})
+        rec = qry.city_cache[new_id]
+        assert rec[qry.LAT] == 42.65
+        assert rec[qry.LOCATION] == {"type": "Point",
+                                     "coordinates": [-73.75, 42.65]}
+        assert mock_create.call_args.args[1][qry.LOCATION] == rec[qry.LOCATION]
+
+
+@pytest.mark.parametrize("flds", [
+    {qry.LAT: 10},
+    {qry.LAT: 91, qry.LON: 0},
+    {qry.LAT: "north", qry.LON: 0},
+])
+def test_validate_bad_coordinates(flds):
+    with pytest.raises(ValueError):
+        qry.validate({qry.NAME: "X", qry.STATE_CODE: "NY", **flds})
+
+
+def test_near_from_cache():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.cache_loaded", True), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.create"), \
+            patch("cities.queries.dbc.update"):
+        nyc = qry.create({qry.NAME: "New York", qry.STATE_CODE: "NY",
+                          qry.LAT: 40.71, qry.LON: -74.01})
+        philly = qry.create({qry.NAME: "Philadelphia", qry.STATE_CODE: "PA",
+                             qry.LAT: 39.95, qry.LON: -75.17})
+        qry.create({qry.NAME: "Nowhere", qry.STATE_CODE: "ZZ"})
+        found = qry.near(40.73, -74.17, k=5)
+        assert [c[qry.ID] for c in found] == [nyc, philly]
+        assert found[0][qry.DISTANCE] < found[1][qry.DISTANCE]
+        assert qry.DISTANCE not in qry.city_cache[nyc]
+        assert [c[qry.ID] for c in qry.near(40.73, -74.17, radius_km=50)] \
+            == [nyc]
+        # the tree follows writes
+        qry.update(philly, {qry.LAT: 40.74, qry.LON: -74.17})
+        assert qry.near(40.73, -74.17, k=1)[0][qry.ID] == philly
+
+
+def test_near_falls_back_to_db():
+    docs = [{"_id": "abc123", qry.NAME: "Albany", qry.STATE_CODE: "NY",
+             qry.LAT: 42.65, qry.LON: -73.75,
+             qry.LOCATION: {"type": "Point", "coordinates": [-73.75, 42.65]}}]
+    with patch("cities.queries.cache_loaded", False), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.read_iter",
+                  return_value=iter(docs)) as mock_read:
+        found = qry.near(42.0, -73.0, k=3, radius_km=150)
+        assert found[0][qry.ID] == "abc123"
+        assert 90 < found[0][qry.DISTANCE] < 100
+        near_spec = mock_read.call_args.args[1][qry.LOCATION]["$nearSphere"]
+        assert near_spec["$maxDistance"] == 150_000
+        assert mock_read.call_args.kwargs["limit"] == 3
+
+
+def test_near_bad_args():
+    with pytest.raises(ValueError):
+        qry.near(100, 0)
+    with pytest.raises(ValueError):
+        qry.near(0, 0, k=0)
+
+
+def test_count_by_state_from_db_is_memoized():
+    with patch.dict("cities.queries.stats_memo", {}, clear=True), \
+            patch("cities.queries.cache_loaded", False), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.group_count",
+                  return_value={"NY": 2, "ny": 1, None: 1}) as mock_group:
+        assert qry.count_by_state() == {"NY": 3, "": 1}
+        assert qry.count_in_state("ny") == 3
+        assert mock_group.call_count == 1
+        with patch("cities.queries.cache_version", qry.cache_version + 1):
+            qry.count_by_state()
+        assert mock_group.call_count == 2
+
+
+def test_uncached_delete_refreshes_counts(memory_db):
+    qry.create_many([{qry.NAME: f"C{i}", qry.STATE_CODE: "NY"}
+                     for i in range(3)])
+    qry.create({qry.NAME: "Troy", qry.STATE_CODE: "NY"})
+    qry.clear_cache()
+    assert qry.num_cities() == 4
+    assert qry.count_by_state() == {"NY": 4}
+    qry.delete("Troy", "NY")
+    ids = [doc[qry.ID] for doc in dbc_mod.read_iter(qry.CITY_COLLECTION)]
+    qry.delete(ids[0])
+    assert qry.num_cities() == 2
+    assert qry.count_by_state() == {"NY": 2}
+
+
+def test_count_by_state_from_cache():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch.dict("cities.queries.state_index", {}, clear=True), \
+            patch("cities.queries.cache_loaded", True), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.create"), \
+            patch("cities.queries.dbc.group_count") as mock_group:
+        qry.create({qry.NAME: "Albany", qry.STATE_CODE: "NY"})
+        qry.create({qry.NAME: "Buffalo", qry.STATE_CODE: "ny"})
+        assert qry.count_by_state() == {"NY": 2}
+        assert qry.num_cities() == 2
+        qry.create({qry.NAME: "Trenton", qry.STATE_CODE: "NJ"})
+        assert qry.count_in_state("NJ") == 1
+        mock_group.assert_not_called()
+
+
+def test_search_falls_back_to_db():
+    docs = [{"_id": "abc123", qry.NAME: "Albany", qry.STATE_CODE: "NY"}]
+    with patch("cities.queries.cache_loaded", False), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.read_iter",
+                  return_value=iter(docs)) as mock_read:
+        assert qry.search("al.", "ny", limit=5)[0][qry.ID] == "abc123"
+        filt = mock_read.call_args.args[1]
+        assert filt[qry.NAME_KEY] == {"$regex": "^al\\."}
+        assert filt[qry.STATE_CODE] == "NY"
+        assert mock_read.call_args.kwargs["limit"] == 5
+        assert mock_read.call_args.kwargs["sort"] == qry.NAME_KEY
+
+
+def test_cold_search_matches_name_key(memory_db):
+    qry.create({qry.NAME: "Ålesund", qry.STATE_CODE: "NY"})
+    qry.create({qry.NAME: "Albany", qry.STATE_CODE: "NY"})
+    qry.clear_cache()
+    found = qry.search("AL", "ny")
+    assert [rec[qry.NAME] for rec in found] == ["Albany", "Ålesund"]
+    assert qry.NAME_KEY not in found[0]
+
+
+def test_name_index_built_on_first_search(memory_db):
+    for name in ("Boston", "Bozeman", "Albany"):
+        qry.create({qry.NAME: name, qry.STATE_CODE: "MA"})
+    qry.read()
+    assert not qry.name_index_ready
+    assert len(qry.search("bo")) == 2
+    assert qry.name_index_ready
+    qry.create({qry.NAME: "Bolton", qry.STATE_CODE: "MA"})
+    assert len(qry.search("bo")) == 3
+
+
+def test_trigram_index_built_on_first_fuzzy_search(memory_db):
+    for name in ("Philadelphia", "Pittsburgh"):
+        qry.create({qry.NAME: name, qry.STATE_CODE: "PA"})
+    qry.read()
+    assert not qry.trigram_index_ready
+    found = qry.search("Philadelpia", fuzzy=True)
+    assert [rec[qry.NAME] for rec in found] == ["Philadelphia"]
+    assert qry.trigram_index_ready
+    qry.create({qry.NAME: "Philadelphus", qry.STATE_CODE: "PA"})
+    assert len(qry.search("Philadelpia", fuzzy=True)) == 2
+
+
+def test_search_empty_prefix():
+    with pytest.raises(ValueError):
+        qry.search("  ")
+
+
+def test_read_by_state_from_cache():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.cache_loaded", True), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.create"), \
+            patch("cities.queries.dbc.update"):
+        ny_id = qry.create({qry.NAME: "Albany", qry.STATE_CODE: "NY"})
+        qry.create({qry.NAME: "Trenton", qry.STATE_CODE: "NJ"})
+        assert [c[qry.ID] for c in qry.read_by_state("ny")] == [ny_id]
+        qry.update(ny_id, {qry.STATE_CODE: "NJ"})
+        assert qry.read_by_state("NY") == []
+        assert len(qry.read_by_state("NJ")) == 2
+
+
+def test_read_by_state_pushes_filter_to_db():
+    docs = [{"_id": "abc123", qry.NAME: "Albany", qry.STATE_CODE: "NY"}]
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.cache_loaded", False), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.read_iter",
+                  return_value=iter(docs)) as mock_read:
+        assert qry.read_by_state("ny")[0][qry.ID] == "abc123"
+        assert mock_read.call_args.args[1] == {qry.STATE_CODE: "NY"}
+
+
+def test_delete_by_name_and_state_uses_index():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.dbc.create"), \
+            patch("cities.queries.dbc.delete", return_value=1):
+        gone = qry.create({qry.NAME: "Gone", qry.STATE_CODE: "NY"})
+        kept = qry.create({qry.NAME: "Kept", qry.STATE_CODE: "NY"})
+        assert qry.delete("Gone", "NY")
+        assert gone not in qry.city_cache
+        assert kept in qry.city_cache
+        assert gone not in qry.state_index["NY"]
+
+
+def test_read_one_lazy_cache_miss_uses_find_one():
+    doc = {"_id": "abc123", qry.ID: "city-9", qry.NAME: "Albany",
+           qry.STATE_CODE: "NY"}
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.cache_mode", qry.LAZY), \
+            patch("cities.queries.cache_loaded", False), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.read_iter") as mock_read_all, \
+            patch("cities.queries.dbc.read_one",
+                  return_value=doc) as mock_read_one:
+        rec = qry.read_one("city-9")
+        assert rec[qry.NAME] == "Albany"
+        assert "_id" not in rec
+        mock_read_one.assert_called_once_with(qry.CITY_COLLECTION,
+                                              {qry.ID: "city-9"})
+        mock_read_all.assert_not_called()
+        # read-through: the record is now cached
+        assert qry.read_one("city-9") is rec
+        assert mock_read_one.call_count == 1
+
+
+def test_read_one_eager_loads_everything():
+    docs = [{qry.ID: f"city-{i}", qry.NAME: f"C{i}", qry.STATE_CODE: "NY"}
+            for i in range(3)]
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.cache_mode", qry.EAGER), \
+            patch("cities.queries.cache_loaded", False), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.read_iter",
+                  return_value=iter(docs)), \
+            patch("cities.queries.dbc.read_one") as mock_read_one:
+        assert qry.read_one("city-1")[qry.NAME] == "C1"
+        assert len(qry.city_cache) == 3
+        assert qry.cache_loaded
+        mock_read_one.assert_not_called()
+
+
+def test_read_after_lazy_lookups_loads_everything():
+    docs = [{qry.ID: f"city-{i}", qry.NAME: f"C{i}", qry.STATE_CODE: "NY"}
+            for i in range(3)]
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries.cache_loaded", False), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.create"), \
+            patch("cities.queries.dbc.read_iter", return_value=iter(docs)):
+        qry.create({qry.NAME: "Local", qry.STATE_CODE: "NY"})
+        assert len(qry.read()) == 4
+
+
+def test_update_and_delete_by_stored_id():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.create"), \
+            patch("cities.queries.dbc.update") as mock_update, \
+            patch("cities.queries.dbc.delete", return_value=1) as mock_delete:
+        new_id = qry.create({qry.NAME: "Albany", qry.STATE_CODE: "NY"})
+        rec = qry.update(new_id, {qry.NAME: "Troy", qry.ID: "other"})
+        assert rec[qry.ID] == new_id
+        mock_update.assert_called_once_with(
+            qry.CITY_COLLECTION, {qry.ID: new_id},
+            {qry.NAME: "Troy", qry.NAME_KEY: "troy"})
+        assert qry.delete(new_id)
+        mock_delete.assert_called_once_with(qry.CITY_COLLECTION,
+                                            {qry.ID: new_id})
+
+
+def test_legacy_doc_found_by_mongo_id(memory_db):
+    result = dbc_mod.create(qry.CITY_COLLECTION,
+                            {qry.NAME: "Albany", qry.STATE_CODE: "NY"})
+    city_id = str(result.inserted_id)
+    assert qry.read_one(city_id)[qry.NAME] == "Albany"
+    qry.update(city_id, {qry.NAME: "Troy"})
+    doc = dbc_mod.read_one(qry.CITY_COLLECTION, {qry.ID: city_id})
+    assert doc[qry.NAME] == "Troy"
+    qry.clear_cache()
+    assert qry.delete(city_id)
+    assert dbc_mod.count(qry.CITY_COLLECTION) == 0
+
+
+def test_delete_cache_miss_goes_to_db():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.delete", return_value=0):
+        with pytest.raises(ValueError):
+            qry.delete("city-nowhere")
+
+
+def test_backfill_ids_uses_mongo_id():
+    with patch("cities.queries.dbc.backfill_field",
+               return_value=3) as mock_backfill:
+        assert qry.backfill_ids() == 3
+        make_id = mock_backfill.call_args.args[2]
+        assert make_id({dbc_mod.MONGO_ID: "abc123"}) == "abc123"
+
+
+def test_bounded_cache_refuses_full_read():
+    docs = [{qry.ID: f"city-{i}", qry.NAME: f"C{i}", qry.STATE_CODE: "NY"}
+            for i in range(5)]
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch.object(qry.city_cache, "max_entries", 2), \
+            patch("cities.queries.cache_loaded", False), \
+            patch("cities.queries.cache_overflow", False), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.count", return_value=2), \
+            patch("cities.queries.dbc.read_iter",
+                  return_value=iter(docs)) as mock_read:
+        with pytest.raises(ValueError):
+            qry.read()
+        assert len(qry.city_cache) == 2
+        assert not qry.cache_loaded
+        # evicted records are no longer indexed by state
+        assert not {"city-0", "city-1", "city-2"} & qry.state_index["NY"]
+        # the overflow is remembered: no second full scan
+        with pytest.raises(ValueError):
+            qry.read()
+        assert mock_read.call_count == 1
+
+
+def test_bounded_cache_too_small_uses_db(memory_db):
+    qry.create_many([{qry.NAME: f"C{i}", qry.STATE_CODE: "NY"}
+                     for i in range(50)])
+    ids = [doc[qry.ID] for doc in dbc_mod.read_iter(qry.CITY_COLLECTION)]
+    qry.clear_cache()
+    with patch.object(qry.city_cache, "max_entries", 10), \
+            patch("cities.queries.cache_mode", qry.EAGER), \
+            patch("cities.queries.dbc.read_iter",
+                  wraps=dbc_mod.read_iter) as mock_read:
+        for city_id in ids[:5]:
+            assert qry.read_one(city_id)[qry.ID] == city_id
+        for _ in range(3):
+            with pytest.raises(ValueError):
+                qry.read()
+        qry.search("C1", fuzzy=True)
+        # counted once, never streamed
+        mock_read.assert_not_called()
+        assert qry.cache_overflow
+
+
+def test_cache_version_bumps_on_writes():
+    with patch.dict("cities.queries.city_cache", {}, clear=True), \
+            patch("cities.queries._can_connect", return_value=True), \
+            patch("cities.queries.dbc.create"), \
+            patch("cities.queries.dbc.update"), \
+            patch("cities.queries.dbc.delete", return_value=1):
+        v0 = qry.cache_version
+        new_id = qry.create({qry.NAME: "Albany", qry.STATE_CODE: "NY"})
+        v1 = qry.cache_version
+        qry.update(new_id, {qry.NAME: "Troy"})
+        v2 = qry.cache_version
+        qry.delete(new_id)
+        assert v0 < v1 < v2 < qry.cache_version
+
+
+def test_state_codes_stored_upper_cased(memory_db):
+    qry.create({qry.NAME: "Albany", qry.STATE_CODE: "ny"})
+    qry.create_many([{qry.NAME: "Buffalo", qry.STATE_CODE: "Ny"}])
+    qry.clear_cache()
+    cold = sorted(c[qry.NAME] for c in qry.read_by_state("ny"))
+    qry.read()
+    warm = sorted(c[qry.NAME] for c in qry.read_by_state("ny"))
+    assert cold == warm == ["Albany", "Buffalo"]
+    assert dbc_mod.distinct(qry.CITY_COLLECTION, qry.STATE_CODE) == ["NY"]
+
+
+def test_normalize_state_codes(memory_db):
+    for name, code in (("Old", "ny"), ("New", "NY")):
+        dbc_mod.create(qry.CITY_COLLECTION,
+                       {qry.NAME: name, qry.STATE_CODE: code})
+    assert qry.normalize_state_codes() == 1
+    assert [c[qry.NAME] for c in qry.read_by_state("NY")] == ["Old", "New"]
@@ -0,0 +1,68 @@
+import cities.search as srch
+
+
+def test_normalize():
+    assert srch.normalize("  São   Paulo ") == "sao paulo"
+    assert srch.normalize(None) == ""
+
+
+def test_prefix_index():
+    idx = srch.PrefixIndex()
+    idx.add("Newark", "1")
+    idx.add("New York", "2")
+    idx.add("Albany", "3")
+    idx.add("newark", "4")
+    idx.add("Newark", "1")
+    assert len(idx) == 4
+    assert list(idx.prefix("NEW")) == ["2", "1", "4"]
+    assert list(idx.prefix("new y")) == ["2"]
+    assert list(idx.prefix("Z")) == []
+    idx.remove("Newark", "1")
+    assert list(idx.prefix("new")) == ["2", "4"]
+    idx.clear()
+    assert list(idx.prefix("")) == []
+
+
+def test_prefix_index_build():
+    idx = srch.PrefixIndex()
+    idx.add("Albany", "9")
+    idx.build([("Newark", "1"), ("New York", "2"), ("Newark", "1")])
+    assert len(idx) == 2
+    assert list(idx.prefix("new")) == ["2", "1"]
+    assert list(idx.prefix("alb")) == []
+
+
+def test_trigrams():
+    assert srch.trigrams("Ab") == {"  a", " ab", "ab "}
+    assert srch.trigrams("") == frozenset()
+
+
+def test_trigram_index_similar():
+    idx = srch.TrigramIndex()
+    idx.add("Philadelphia", "1")
+    idx.add("Pittsburgh", "2")
+    idx.add("Phoenix", "3")
+    found = idx.similar("Philadelpia")
+    assert [key for key, _ in found] == ["1"]
+    assert 0 < found[0][1] < 1
+    idx.add("Boston", "1")  # renamed
+    assert idx.similar("Philadelpia") == []
+    idx.remove("2")
+    assert len(idx) == 2
+    assert idx.similar("Pittsburgh") == []
+
+
+def test_trigram_index_caps_candidates():
+    idx = srch.TrigramIndex()
+    for i in range(50):
+        idx.add(f"Springfield {i}", str(i))
+    assert len(idx.similar("Springfield", min_score=0,
+                           max_candidates=10)) == 10
+
+
+def test_trigram_index_build():
+    idx = srch.TrigramIndex()
+    idx.add("Albany", "9")
+    idx.build([("Boston", "1"), ("Bostwick", "2")])
+    assert [key for key, _ in idx.similar("bostn")] == ["1", "2"]
+    assert idx.similar("albany") == []
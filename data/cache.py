@@ -0,0 +1,205 @@
+"""
+A bounded, dict-like in-memory cache for DB records.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+# Keys of the dict returned by BoundedCache.stats():
+HITS = "hits"
+MISSES = "misses"
+EVICTIONS = "evictions"
+EXPIRATIONS = "expirations"
+ENTRIES = "entries"
+BYTES = "bytes"
+
+_MISSING = object()
+
+
+def approx_size(value: Any) -> int:
+    """
+    Cheap estimate of a record's memory use: the object itself plus its
+    top-level keys and values. Good enough to bound a cache by bytes.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, val in value.items():
+            size += sys.getsizeof(key) + sys.getsizeof(val)
+    return size
+
+
+class BoundedCache(dict):
+    """
+    A dict that keeps at most `max_entries` items and/or `max_bytes`
+    (as measured by `sizeof`), evicting the least recently used first,
+    and optionally drops items `ttl` seconds after they were stored.
+
+    With no limits it behaves like a plain dict (plus the counters).
+    It is a real dict, so it can be returned and serialized as one;
+    keyed access (`[]`, get(), `in`, pop()) honours LRU order and TTLs,
+    while bulk iteration sees every stored item: call purge() first to
+    drop expired ones.
+
+    `on_evict(key, value)` is called whenever the cache itself drops an
+    item (eviction or expiry), but not for explicit deletes.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None,
+                 max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None,
+                 sizeof: Callable[[Any], int] = approx_size,
+                 on_evict: Optional[Callable[[Any, Any], None]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.clock = clock
+        # key -> (expires_at or None, size in bytes), in LRU order
+        self._meta: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expired(self, key) -> bool:
+        expires_at = self._meta[key][0]
+        return expires_at is not None and self.clock() >= expires_at
+
+    def _drop(self, key):
+        self.total_bytes -= self._meta.pop(key)[1]
+        return dict.pop(self, key)
+
+    def _expire(self, key) -> None:
+        value = self._drop(key)
+        self.expirations += 1
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def _over_limit(self) -> bool:
+        if self.max_entries is not None and len(self) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.total_bytes > self.max_bytes
+
+    def _evict(self) -> None:
+        # Never evict the item just stored, even if it alone is too big.
+        while len(self) > 1 and self._over_limit():
+            key = next(iter(self._meta))
+            value = self._drop(key)
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(key, value)
+
+    def _live(self, key) -> bool:
+        """Is `key` stored and unexpired? Expires it if needed."""
+        if not dict.__contains__(self, key):
+            return False
+        if self._expired(key):
+            self._expire(key)
+            return False
+        return True
+
+    def __getitem__(self, key):
+        with self._lock:
+            if not self._live(key):
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            self._meta.move_to_end(key)
+            return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value) -> None:
+        with self._lock:
+            if dict.__contains__(self, key):
+                self._drop(key)
+            expires_at = None if self.ttl is None else self.clock() + self.ttl
+            size = self.sizeof(value)
+            dict.__setitem__(self, key, value)
+            self._meta[key] = (expires_at, size)
+            self.total_bytes += size
+            self._evict()
+
+    def __delitem__(self, key) -> None:
+        with self._lock:
+            if not dict.__contains__(self, key):
+                raise KeyError(key)
+            self._drop(key)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return self._live(key)
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            if self._live(key):
+                return self._drop(key)
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+
+    def popitem(self):
+        with self._lock:
+            if not self:
+                raise KeyError("popitem(): cache is empty")
+            key = next(reversed(self._meta))
+            return key, self._drop(key)
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            if self._live(key):
+                return self[key]
+            self[key] = default
+            return default
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self) -> None:
+        with self._lock:
+            dict.clear(self)
+            self._meta.clear()
+            self.total_bytes = 0
+
+    def copy(self) -> dict:
+        """A plain-dict snapshot of the stored items."""
+        return dict(self)
+
+    def peek(self, key, default=None):
+        """Like get(), but without touching the counters or LRU order."""
+        with self._lock:
+            if not self._live(key):
+                return default
+            return dict.__getitem__(self, key)
+
+    def purge(self) -> int:
+        """Drop every expired item now; returns how many were dropped."""
+        with self._lock:
+            if self.ttl is None:
+                return 0
+            expired = [key for key in self._meta if self._expired(key)]
+            for key in expired:
+                self._expire(key)
+            return len(expired)
+
+    def stats(self) -> dict:
+        return {
+            HITS: self.hits,
+            MISSES: self.misses,
+            EVICTIONS: self.evictions,
+            EXPIRATIONS: self.expirations,
+            ENTRIES: len(self),
+            BYTES: self.total_bytes,
+        }
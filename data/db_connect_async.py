@@ -0,0 +1,331 @@
+"""
+The asyncio counterpart of data.db_connect: the same create / read /
+read_one / update / delete surface, as coroutines on pymongo's
+AsyncMongoClient, so one thread can keep many DB requests in flight.
+
+Connection settings and the connectivity state (health, circuit
+breaker) are shared with data.db_connect.
+
+An AsyncMongoClient belongs to the event loop it was made on, so each
+loop gets its own. Sync code (e.g. Flask views) should go through run(),
+which runs coroutines on one long-lived loop per process instead of
+starting a loop (and a client) per call.
+"""
+import asyncio
+import inspect
+import os
+import threading
+import time
+import weakref
+from functools import wraps
+from typing import Optional
+
+import pymongo as pm
+from pymongo.errors import ConnectionFailure
+
+import data.db_connect as dbc
+from data import memory_backend, metrics, slow_queries
+from data.db_connect import SE_DB, MONGO_ID, DEFAULT_BATCH_SIZE
+
+# event loop -> its client
+_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+# The loop run() uses, and the thread running it.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+
+
+def _build_client() -> pm.AsyncMongoClient:
+    if dbc.backend() == dbc.BACKEND_MEMORY:
+        return memory_backend.AsyncMemoryClient()
+    uri, extra = dbc.client_target()
+    return pm.AsyncMongoClient(uri, **extra, **dbc.client_options())
+
+
+async def connect_db() -> pm.AsyncMongoClient:
+    """
+    The client for the running event loop, made (and checked with a
+    ping, which raises on failure) the first time the loop asks.
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        db_client = _clients.get(loop)
+        fresh = db_client is None
+        if fresh:
+            db_client = _build_client()
+            _clients[loop] = db_client
+    if fresh:
+        await db_client.admin.command("ping")
+    return db_client
+
+
+async def close_db() -> None:
+    """Close the running loop's client, if it has one."""
+    with _clients_lock:
+        db_client = _clients.pop(asyncio.get_running_loop(), None)
+    if db_client is not None:
+        await db_client.close()
+
+
+def needs_db(fn):
+    """
+    Decorator for coroutines that talk to the DB: connects first,
+    records a failed connection in the shared health state, and records
+    the call in data.metrics and the slow-query log as dbc.needs_db does
+    (without explain plans, which would block the loop). Async generators
+    (read_iter) are metered like dbc's generators: only the time spent
+    fetching counts, and a stream closed early is still recorded.
+    """
+    sig = inspect.signature(fn)
+
+    if inspect.isasyncgenfunction(fn):
+        @wraps(fn)
+        async def gen_wrapper(*args, **kwargs):
+            await connect_db()
+            collection = dbc._collection_label(args, kwargs)
+            async for doc in _metered_aiter(fn(*args, **kwargs), fn.__name__,
+                                            collection, (sig, args, kwargs)):
+                yield doc
+
+        return gen_wrapper
+
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        await connect_db()
+        collection = dbc._collection_label(args, kwargs)
+        start = time.perf_counter()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as err:
+            metrics.record_db(fn.__name__, collection,
+                              time.perf_counter() - start, error=err)
+            if isinstance(err, ConnectionFailure):
+                dbc.mark_down()
+            raise
+        seconds = time.perf_counter() - start
+        metrics.record_db(fn.__name__, collection, seconds, result)
+        if seconds >= slow_queries.THRESHOLD:
+            slow_queries.check(sig, fn.__name__, collection, args, kwargs,
+                               seconds, metrics.measure(result)[0])
+        return result
+
+    return wrapper
+
+
+async def _metered_aiter(agen, op: str, collection: str, call: tuple):
+    """
+    The async counterpart of dbc._metered_iter(): pass `agen` through,
+    recording the time spent fetching from it once it is done or closed.
+    """
+    seconds = 0.0
+    docs = 0
+    nbytes = 0
+    failed = False
+    try:
+        while True:
+            fetch = time.perf_counter()
+            try:
+                doc = await anext(agen, dbc._END)
+            finally:
+                seconds += time.perf_counter() - fetch
+            if doc is dbc._END:
+                break
+            docs += 1
+            if metrics.TRACK_BYTES:
+                nbytes += metrics.doc_bytes([doc])
+            yield doc
+    except Exception as err:
+        failed = True
+        metrics.record_db(op, collection, seconds, error=err)
+        if isinstance(err, ConnectionFailure):
+            dbc.mark_down()
+        raise
+    finally:
+        await agen.aclose()
+        if not failed:
+            dbc._record_stream(op, collection, seconds, docs, nbytes, call)
+
+
+def _client() -> pm.AsyncMongoClient:
+    return _clients[asyncio.get_running_loop()]
+
+
+async def ping() -> bool:
+    """
+    Return True if the DB answers, recording the result in the shared
+    health state. Always a round trip; prefer is_available().
+    """
+    try:
+        db_client = await connect_db()
+        alive = (await db_client.admin.command("ping")).get("ok") == 1
+    except Exception:
+        alive = False
+    if alive:
+        dbc.mark_up()
+    else:
+        dbc.mark_down()
+    return alive
+
+
+async def is_available() -> bool:
+    """
+    dbc.is_available() without blocking the loop: answered from the
+    shared health state, with an async ping only when that has gone
+    stale.
+    """
+    health = dbc.health
+    now = time.monotonic()
+    ok_at = health["ok_at"]
+    if (health["state"] == dbc.CLOSED and ok_at is not None
+            and now - ok_at < dbc.HEALTH_TTL):
+        return True
+    if (health["state"] == dbc.OPEN
+            and now - health["opened_at"] < dbc.BREAKER_COOLDOWN):
+        return False
+    return await ping()
+
+
+@needs_db
+async def create(collection: str, doc: dict, db: str = SE_DB):
+    """Insert a single doc into a collection."""
+    return await _client()[db][collection].insert_one(doc)
+
+
+@needs_db
+async def read_one(collection: str, filt: dict, db: str = SE_DB):
+    """
+    Find with a filter and return only the first doc found.
+    Return None if not found.
+    """
+    result = await _client()[db][collection].find_one(filt)
+    if result:
+        dbc.convert_mongo_id(result)
+    return result
+
+
+@needs_db
+async def delete(collection: str, filt: dict, db: str = SE_DB) -> int:
+    """Delete a single doc matching the filter; returns 0 or 1."""
+    result = await _client()[db][collection].delete_one(filt)
+    return result.deleted_count
+
+
+@needs_db
+async def update(collection: str, filters: dict, update_dict: dict,
+                 db: str = SE_DB):
+    """Update a single document matching `filters` with `update_dict`."""
+    return await _client()[db][collection].update_one(
+        filters, {"$set": update_dict},
+    )
+
+
+@needs_db
+async def count(collection: str, filt: Optional[dict] = None,
+                db: str = SE_DB) -> int:
+    """The number of docs matching `filt` (all of them if omitted)."""
+    coll = _client()[db][collection]
+    if not filt:
+        return await coll.estimated_document_count()
+    return await coll.count_documents(filt)
+
+
+@needs_db
+async def read_iter(collection: str, filt: Optional[dict] = None,
+                    db: str = SE_DB, no_id: bool = True,
+                    batch_size: int = DEFAULT_BATCH_SIZE,
+                    sort=None, projection=None, limit: int = 0):
+    """
+    Asynchronously yield the documents of a collection, `batch_size` at a
+    time from the server; arguments as for dbc.read_iter().
+    """
+    cursor = _client()[db][collection].find(
+        filt or {}, projection, batch_size=batch_size, limit=limit,
+    )
+    if sort:
+        cursor = cursor.sort(sort)
+    try:
+        async for doc in cursor:
+            if no_id:
+                doc.pop(MONGO_ID, None)
+            else:
+                dbc.convert_mongo_id(doc)
+            yield doc
+    finally:
+        await cursor.close()
+
+
+async def read(collection: str, db: str = SE_DB, no_id: bool = True,
+               filt: Optional[dict] = None) -> list:
+    """
+    Return a list of all docs (matching `filt`) in a collection; metered
+    as the read_iter() it is made of, as dbc.read() is.
+    """
+    return [doc async for doc in read_iter(collection, filt, db=db,
+                                           no_id=no_id)]
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None or not _loop_thread.is_alive():
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever,
+                                            name="db-async", daemon=True)
+            _loop_thread.start()
+        return _loop
+
+
+def run(coro, timeout: Optional[float] = None):
+    """
+    Run a coroutine from sync code on this process's shared DB event
+    loop and return its result, so every caller shares one loop and one
+    client. Must not be called from that loop itself.
+    """
+    loop = _background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("run() called from the DB event loop")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+
+def blocking_iter(agen, loop: asyncio.AbstractEventLoop,
+                  batch_size: int = DEFAULT_BATCH_SIZE):
+    """
+    Iterate the async generator `agen`, which runs on `loop`, from
+    another thread (e.g. one started with asyncio.to_thread()), fetching
+    up to `batch_size` items per trip to the loop.
+    """
+    async def next_batch() -> list:
+        batch = []
+        async for item in agen:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                break
+        return batch
+
+    try:
+        while batch := asyncio.run_coroutine_threadsafe(next_batch(),
+                                                        loop).result():
+            yield from batch
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+def _reset_after_fork() -> None:
+    """In a forked child: the parent's loop thread and clients are gone."""
+    global _loop, _loop_thread, _loop_lock, _clients_lock
+    _loop = None
+    _loop_thread = None
+    _loop_lock = threading.Lock()
+    _clients_lock = threading.Lock()
+    _clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,977 @@
+"""
+An in-process, in-memory stand-in for MongoDB, used by data.db_connect
+(and data.db_connect_async) when DB_BACKEND=memory: for running the
+query and server layers offline, in tests and in benchmarks.
+
+It implements the part of pymongo's client / database / collection API
+that those modules call, with the semantics the project relies on:
+
+  - filters: equality (including on array elements and dotted paths),
+    $eq $ne $gt $gte $lt $lte $in $nin $exists $type $regex $not,
+    $and $or $nor, and $nearSphere on GeoJSON points;
+  - updates: $set $setOnInsert $unset $inc, upserts and replacements;
+  - bulk writes, ordered or not, reporting errors as pymongo does;
+  - aggregation: $match $group $sort $skip $limit $project $count;
+  - indexes: unique (and partial unique) constraints raise
+    DuplicateKeyError, and equality lookups on an indexed key (or a
+    prefix of one) go through the index instead of a scan.
+
+Data lives at module level, so every client in a process sees the same
+databases; reset() empties them. Nothing is persisted.
+"""
+import copy
+import math
+import re
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+
+from bson import ObjectId
+import pymongo as pm
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import (BulkWriteResult, DeleteResult, InsertOneResult,
+                             UpdateResult)
+
+MONGO_ID = "_id"
+ID_INDEX = "_id_"
+DUP_KEY_CODE = 11000
+EARTH_RADIUS_M = 6371008.8
+
+# db name -> collection name -> MemoryCollection
+_databases: dict = {}
+_databases_lock = threading.Lock()
+
+# Stands in for a field a doc does not have (None is a real value).
+_MISSING = object()
+
+
+def reset() -> None:
+    """Drop every database."""
+    with _databases_lock:
+        _databases.clear()
+
+
+def _collection(db: str, name: str) -> "MemoryCollection":
+    with _databases_lock:
+        colls = _databases.setdefault(db, {})
+        coll = colls.get(name)
+        if coll is None:
+            coll = colls[name] = MemoryCollection(db, name)
+        return coll
+
+
+# --- field access ---
+
+def _get(doc, path: str):
+    val = doc
+    for part in path.split("."):
+        if isinstance(val, dict) and part in val:
+            val = val[part]
+        elif isinstance(val, list) and part.isdigit() and int(part) < len(val):
+            val = val[int(part)]
+        else:
+            return _MISSING
+    return val
+
+
+def _set(doc: dict, path: str, value) -> None:
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def _unset(doc: dict, path: str) -> None:
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+def _freeze(value):
+    """A hashable stand-in for a field value, for index keys."""
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    return value
+
+
+def _order(value) -> tuple:
+    """
+    A sort key following Mongo's ordering across types: null, numbers,
+    strings, objects, arrays, ObjectIds, booleans, dates.
+    """
+    if value is _MISSING or value is None:
+        return (1, 0)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, dict):
+        return (4, [(k, _order(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        return (5, [_order(v) for v in value])
+    if isinstance(value, ObjectId):
+        return (7, value.binary)
+    if isinstance(value, datetime):
+        return (9, value)
+    return (10, str(value))
+
+
+# --- filters ---
+
+_TYPES = {
+    "double": (float,), "int": (int,), "long": (int,),
+    "number": (int, float), "string": (str,), "object": (dict,),
+    "array": (list,), "objectId": (ObjectId,), "bool": (bool,),
+    "date": (datetime,), "null": (type(None),),
+}
+
+
+@lru_cache(maxsize=256)
+def _regex(pattern: str, options: str = "") -> re.Pattern:
+    flags = 0
+    for opt, flag in (("i", re.I), ("m", re.M), ("s", re.S), ("x", re.X)):
+        if opt in options:
+            flags |= flag
+    return re.compile(pattern, flags)
+
+
+def _equals(actual, expected) -> bool:
+    if isinstance(expected, re.Pattern):
+        return isinstance(actual, str) and bool(expected.search(actual))
+    if actual is _MISSING:
+        return expected is None
+    if isinstance(actual, list) and not isinstance(expected, list):
+        return any(_equals(a, expected) for a in actual)
+    return _order(actual)[0] == _order(expected)[0] and actual == expected
+
+
+def _compare(actual, expected, test) -> bool:
+    if isinstance(actual, list):
+        return any(_compare(a, expected, test) for a in actual)
+    if actual is _MISSING:
+        return False
+    a, e = _order(actual), _order(expected)
+    return a[0] == e[0] and test(a[1], e[1])
+
+
+def _has_type(actual, names) -> bool:
+    names = names if isinstance(names, list) else [names]
+    if actual is _MISSING:
+        return False
+    for name in names:
+        kinds = _TYPES.get(name)
+        if kinds is None:
+            raise OperationFailure(f"unknown type name alias: {name}")
+        if isinstance(actual, bool) and bool not in kinds:
+            continue
+        if isinstance(actual, kinds):
+            return True
+    return False
+
+
+def _distance_m(point, lon: float, lat: float) -> float:
+    """Great-circle distance from a GeoJSON point (or [lon, lat]) in m."""
+    if isinstance(point, dict):
+        point = point.get("coordinates")
+    if not isinstance(point, (list, tuple)) or len(point) != 2:
+        return math.inf
+    lon2, lat2 = point
+    phi1, phi2 = math.radians(lat), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2)
+         * math.sin(math.radians(lon2 - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _near_origin(spec: dict) -> tuple:
+    """(lon, lat, max metres) of a $nearSphere argument."""
+    geometry = spec.get("$geometry", spec)
+    lon, lat = geometry["coordinates"]
+    return lon, lat, spec.get("$maxDistance", math.inf)
+
+
+def _near(actual, spec) -> bool:
+    lon, lat, max_m = _near_origin(spec)
+    dist = _distance_m(actual, lon, lat)
+    return dist != math.inf and dist <= max_m
+
+
+_OPS = {
+    "$eq": lambda actual, arg, _: _equals(actual, arg),
+    "$ne": lambda actual, arg, _: not _equals(actual, arg),
+    "$gt": lambda actual, arg, _: _compare(actual, arg, lambda a, e: a > e),
+    "$gte": lambda actual, arg, _: _compare(actual, arg, lambda a, e: a >= e),
+    "$lt": lambda actual, arg, _: _compare(actual, arg, lambda a, e: a < e),
+    "$lte": lambda actual, arg, _: _compare(actual, arg, lambda a, e: a <= e),
+    "$in": lambda actual, arg, _: any(_equals(actual, v) for v in arg),
+    "$nin": lambda actual, arg, _: not any(_equals(actual, v) for v in arg),
+    "$exists": lambda actual, arg, _: (actual is not _MISSING) == bool(arg),
+    "$type": lambda actual, arg, _: _has_type(actual, arg),
+    "$regex": lambda actual, arg, opts: _equals(
+        actual, arg if isinstance(arg, re.Pattern) else _regex(arg, opts)),
+    "$not": lambda actual, arg, _: not _match_field(actual, arg),
+    "$nearSphere": lambda actual, arg, _: _near(actual, arg),
+}
+
+
+def _is_operators(cond) -> bool:
+    return (isinstance(cond, dict) and bool(cond)
+            and all(key.startswith("$") for key in cond))
+
+
+def _match_field(actual, cond) -> bool:
+    if not _is_operators(cond):
+        return _equals(actual, cond)
+    options = cond.get("$options", "")
+    for op, arg in cond.items():
+        if op in ("$options", "$maxDistance"):
+            continue
+        check = _OPS.get(op)
+        if check is None:
+            raise OperationFailure(f"unknown operator: {op}")
+        if not check(actual, arg, options):
+            return False
+    return True
+
+
+def matches(doc: dict, filt: dict) -> bool:
+    """Does `doc` match the Mongo filter `filt`?"""
+    for key, cond in filt.items():
+        if key == "$and":
+            if not all(matches(doc, sub) for sub in cond):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, sub) for sub in cond):
+                return False
+        elif key == "$nor":
+            if any(matches(doc, sub) for sub in cond):
+                return False
+        elif key.startswith("$"):
+            raise OperationFailure(f"unknown top level operator: {key}")
+        elif not _match_field(_get(doc, key), cond):
+            return False
+    return True
+
+
+def _equalities(filt: dict) -> dict:
+    """The fields `filt` pins to one plain value: {path: value}."""
+    found = {}
+    for key, cond in filt.items():
+        if key == "$and":
+            for sub in cond:
+                found.update(_equalities(sub))
+            continue
+        if key.startswith("$"):
+            continue
+        if _is_operators(cond):
+            if "$eq" not in cond:
+                continue
+            cond = cond["$eq"]
+        if cond is not None and not isinstance(cond, (list, dict, re.Pattern)):
+            found[key] = cond
+    return found
+
+
+def _near_field(filt: dict):
+    """The (path, $nearSphere spec) in `filt`, if it has one."""
+    for key, cond in filt.items():
+        if isinstance(cond, dict) and "$nearSphere" in cond:
+            return key, cond["$nearSphere"]
+    return None
+
+
+# --- sorting, projection, updates ---
+
+def _sort_spec(key_or_list, direction=None) -> list:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or pm.ASCENDING)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return list(key_or_list)
+
+
+def _sorted(docs: list, spec: list) -> list:
+    for key, direction in reversed(spec):
+        docs = sorted(docs, key=lambda doc: _order(_get(doc, key)),
+                      reverse=direction == pm.DESCENDING)
+    return docs
+
+
+def _project(doc: dict, projection) -> dict:
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    keep_id = projection.get(MONGO_ID, 1)
+    fields = {k: v for k, v in projection.items() if k != MONGO_ID}
+    if fields and all(fields.values()):
+        out: dict = {}
+        for path in fields:
+            val = _get(doc, path)
+            if val is not _MISSING:
+                _set(out, path, val)
+    else:
+        out = dict(doc)
+        for path in fields:
+            _unset(out, path)
+    if keep_id and MONGO_ID in doc:
+        out[MONGO_ID] = doc[MONGO_ID]
+    else:
+        out.pop(MONGO_ID, None)
+    return out
+
+
+def _apply_update(doc: dict, update: dict, inserting: bool) -> dict:
+    """A copy of `doc` with `update` (operators or a replacement) applied."""
+    if not _is_operators(update):
+        new = copy.deepcopy(update)
+        if MONGO_ID in doc:
+            new[MONGO_ID] = doc[MONGO_ID]
+        return new
+    new = copy.deepcopy(doc)
+    for op, fields in update.items():
+        if op == "$set" or (op == "$setOnInsert" and inserting):
+            for path, val in fields.items():
+                _set(new, path, copy.deepcopy(val))
+        elif op == "$setOnInsert":
+            continue
+        elif op == "$unset":
+            for path in fields:
+                _unset(new, path)
+        elif op == "$inc":
+            for path, amount in fields.items():
+                current = _get(new, path)
+                _set(new, path, (0 if current is _MISSING else current)
+                     + amount)
+        else:
+            raise OperationFailure(f"Unknown modifier: {op}")
+    return new
+
+
+# --- aggregation ---
+
+def _expr(doc: dict, expr):
+    if isinstance(expr, str) and expr.startswith("$"):
+        val = _get(doc, expr[1:])
+        return None if val is _MISSING else val
+    if isinstance(expr, dict):
+        return {k: _expr(doc, v) for k, v in expr.items()}
+    return expr
+
+
+def _group(docs: list, spec: dict) -> list:
+    groups: dict = {}
+    for doc in docs:
+        key = _expr(doc, spec[MONGO_ID])
+        state = groups.setdefault(_freeze(key), {MONGO_ID: key, "docs": []})
+        state["docs"].append(doc)
+    out = []
+    for state in groups.values():
+        result = {MONGO_ID: state[MONGO_ID]}
+        for field, acc in spec.items():
+            if field == MONGO_ID:
+                continue
+            (op, arg), = acc.items()
+            values = [_expr(doc, arg) for doc in state["docs"]]
+            numbers = [v for v in values
+                       if isinstance(v, (int, float))
+                       and not isinstance(v, bool)]
+            if op == "$sum":
+                result[field] = sum(numbers)
+            elif op == "$avg":
+                result[field] = (sum(numbers) / len(numbers)
+                                 if numbers else None)
+            elif op == "$min":
+                result[field] = min(values, key=_order, default=None)
+            elif op == "$max":
+                result[field] = max(values, key=_order, default=None)
+            elif op == "$first":
+                result[field] = values[0]
+            elif op == "$last":
+                result[field] = values[-1]
+            elif op == "$push":
+                result[field] = values
+            else:
+                raise OperationFailure(f"unknown group operator: {op}")
+        out.append(result)
+    return out
+
+
+def _run_pipeline(docs: list, pipeline: list) -> list:
+    for stage in pipeline:
+        (name, arg), = stage.items()
+        if name == "$match":
+            docs = [doc for doc in docs if matches(doc, arg)]
+        elif name == "$group":
+            docs = _group(docs, arg)
+        elif name == "$sort":
+            docs = _sorted(docs, _sort_spec(arg))
+        elif name == "$skip":
+            docs = docs[arg:]
+        elif name == "$limit":
+            docs = docs[:arg]
+        elif name == "$project":
+            docs = [_project(doc, arg) for doc in docs]
+        elif name == "$count":
+            docs = [{arg: len(docs)}] if docs else []
+        else:
+            raise OperationFailure(f"Unrecognized pipeline stage: {name}")
+    return docs
+
+
+# --- indexes ---
+
+class _Index:
+    """A registered index; non-geo ones map key prefixes to doc ids."""
+
+    def __init__(self, name: str, keys: list, unique: bool = False,
+                 partial: dict = None, ttl: int = None):
+        self.name = name
+        self.keys = keys
+        self.fields = [field for field, _ in keys]
+        self.unique = unique
+        self.partial = partial
+        self.ttl = ttl
+        self.geo = any(isinstance(direction, str) for _, direction in keys)
+        # prefix length -> key prefix -> ids of the docs with it
+        self.entries = {n: {} for n in range(1, len(keys) + 1)}
+        # ids of docs with an array in an indexed field (not keyed)
+        self.unkeyed: set = set()
+
+    def info(self) -> dict:
+        info = {"v": 2, "key": list(self.keys)}
+        if self.unique:
+            info["unique"] = True
+        if self.partial is not None:
+            info["partialFilterExpression"] = self.partial
+        if self.ttl is not None:
+            info["expireAfterSeconds"] = self.ttl
+        return info
+
+    def covers(self, doc: dict) -> bool:
+        return self.partial is None or matches(doc, self.partial)
+
+    def key_of(self, doc: dict):
+        """The doc's key, or None if it can't be keyed (arrays)."""
+        values = [_get(doc, field) for field in self.fields]
+        if any(isinstance(v, list) for v in values):
+            return None
+        return tuple(None if v is _MISSING else _freeze(v) for v in values)
+
+    def add(self, doc_id, doc: dict) -> None:
+        if self.geo or not self.covers(doc):
+            return
+        key = self.key_of(doc)
+        if key is None:
+            self.unkeyed.add(doc_id)
+            return
+        for n, entries in self.entries.items():
+            entries.setdefault(key[:n], set()).add(doc_id)
+
+    def remove(self, doc_id, doc: dict) -> None:
+        self.unkeyed.discard(doc_id)
+        key = self.key_of(doc)
+        if key is None:
+            return
+        for n, entries in self.entries.items():
+            ids = entries.get(key[:n])
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del entries[key[:n]]
+
+    def clash(self, doc_id, doc: dict) -> bool:
+        """Would `doc` repeat another doc's key in this unique index?"""
+        if not self.unique or self.geo or not self.covers(doc):
+            return False
+        key = self.key_of(doc)
+        others = self.entries[len(self.fields)].get(key, set()) - {doc_id}
+        return bool(others)
+
+    def lookup(self, equalities: dict):
+        """
+        (ids, keys examined) for docs whose indexed fields take the values
+        in `equalities`, or None if they don't pin a prefix of the key (or,
+        for a partial index, don't imply its filter).
+        """
+        if self.geo:
+            return None
+        if self.partial is not None:
+            probe: dict = {}
+            for path, val in equalities.items():
+                _set(probe, path, val)
+            if not matches(probe, self.partial):
+                return None
+        prefix = []
+        for field in self.fields:
+            if field not in equalities:
+                break
+            prefix.append(_freeze(equalities[field]))
+        if not prefix:
+            return None
+        ids = self.entries[len(prefix)].get(tuple(prefix), set())
+        return ids | self.unkeyed, len(ids)
+
+
+# --- client, database, collection, cursor ---
+
+class MemoryCursor:
+    """
+    The results of find() or aggregate(): computed on first use, and
+    adjustable with sort() / skip() / limit() until then.
+    """
+
+    def __init__(self, run, sort=None, skip: int = 0, limit: int = 0):
+        self._run = run
+        self._sort = _sort_spec(sort) if sort else []
+        self._skip = skip
+        self._limit = limit
+        self._docs = None
+
+    def sort(self, key_or_list, direction=None) -> "MemoryCursor":
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def skip(self, skip: int) -> "MemoryCursor":
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int) -> "MemoryCursor":
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int) -> "MemoryCursor":
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        if self._docs is None:
+            self._docs = iter(self._run(self._sort, self._skip, self._limit))
+        return next(self._docs)
+
+    def close(self) -> None:
+        self._docs = iter(())
+
+    def __enter__(self) -> "MemoryCursor":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class MemoryCollection:
+    """One collection: docs by _id, in insertion order, plus indexes."""
+
+    def __init__(self, database: str, name: str):
+        self.database_name = database
+        self.name = name
+        self._docs: dict = {}
+        self._indexes: dict = {}
+        # Docs are replaced, never changed in place, so readers can copy
+        # what they found after letting go of the lock.
+        self._lock = threading.RLock()
+
+    # reads
+
+    def _plan(self, filt: dict) -> tuple:
+        """(candidate docs, index used or None, keys examined)."""
+        equal = _equalities(filt)
+        if MONGO_ID in equal:
+            doc = self._docs.get(_freeze(equal[MONGO_ID]))
+            return ([doc] if doc is not None else []), ID_INDEX, 1
+        best = None
+        for index in self._indexes.values():
+            found = index.lookup(equal)
+            if found is not None and (best is None
+                                      or len(found[0]) < len(best[1][0])):
+                best = (index, found)
+        if best is None:
+            return list(self._docs.values()), None, 0
+        index, (ids, keys) = best
+        docs = [self._docs[doc_id] for doc_id in ids if doc_id in self._docs]
+        # in index order, as an index scan returns them
+        docs.sort(key=lambda doc: [_order(_get(doc, field))
+                                   for field in (*index.fields, MONGO_ID)])
+        return docs, index.name, keys
+
+    def _select(self, filt: dict, sort=None, skip: int = 0,
+                limit: int = 0) -> list:
+        filt = filt or {}
+        with self._lock:
+            docs, _, _ = self._plan(filt)
+            docs = [doc for doc in docs if matches(doc, filt)]
+        near = _near_field(filt)
+        if near:
+            path, spec = near
+            lon, lat, _ = _near_origin(spec)
+            docs.sort(key=lambda doc: _distance_m(_get(doc, path), lon, lat))
+        if sort:
+            docs = _sorted(docs, sort)
+        if skip:
+            docs = docs[skip:]
+        if limit:
+            docs = docs[:abs(limit)]
+        return docs
+
+    def find(self, filter=None, projection=None, skip: int = 0,
+             limit: int = 0, sort=None, **kwargs) -> MemoryCursor:
+        filt = filter
+
+        def run(sort_spec, skip_n, limit_n):
+            return [_project(copy.deepcopy(doc), projection)
+                    for doc in self._select(filt, sort_spec, skip_n, limit_n)]
+
+        return MemoryCursor(run, sort, skip, limit)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {MONGO_ID: filter}
+        return next(self.find(filter, *args, limit=1, **kwargs), None)
+
+    def count_documents(self, filter: dict, **kwargs) -> int:
+        return len(self._select(filter, skip=kwargs.get("skip", 0),
+                                limit=kwargs.get("limit", 0)))
+
+    def estimated_document_count(self, **kwargs) -> int:
+        return len(self._docs)
+
+    def distinct(self, key: str, filter=None, **kwargs) -> list:
+        seen: dict = {}
+        for doc in self._select(filter):
+            val = _get(doc, key)
+            for item in val if isinstance(val, list) else [val]:
+                if item is not _MISSING:
+                    seen.setdefault((_order(item)[0], _freeze(item)), item)
+        return [copy.deepcopy(v) for v in seen.values()]
+
+    def aggregate(self, pipeline: list, **kwargs) -> MemoryCursor:
+        def run(sort_spec, skip_n, limit_n):
+            with self._lock:
+                docs = list(self._docs.values())
+            return copy.deepcopy(_run_pipeline(docs, pipeline))
+
+        return MemoryCursor(run)
+
+    def explain(self, filt: dict) -> dict:
+        """A find's plan and execution stats, shaped like Mongo's."""
+        started = time.perf_counter()
+        with self._lock:
+            docs, index, keys = self._plan(filt or {})
+            returned = sum(1 for doc in docs if matches(doc, filt or {}))
+        millis = int((time.perf_counter() - started) * 1000)
+        if index is None:
+            plan = {"stage": "COLLSCAN"}
+        else:
+            plan = {"stage": "FETCH",
+                    "inputStage": {"stage": "IXSCAN", "indexName": index}}
+        return {
+            "queryPlanner": {"namespace": f"{self.database_name}.{self.name}",
+                             "winningPlan": plan},
+            "executionStats": {"nReturned": returned,
+                               "executionTimeMillis": millis,
+                               "totalKeysExamined": keys,
+                               "totalDocsExamined": len(docs)},
+            "ok": 1.0,
+        }
+
+    # writes (callers hold self._lock)
+
+    def _check_unique(self, doc_id, doc: dict) -> None:
+        for index in self._indexes.values():
+            if index.clash(doc_id, doc):
+                key = {field: _get(doc, field) for field in index.fields}
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: "
+                    f"{self.database_name}.{self.name} index: {index.name} "
+                    f"dup key: {key}", DUP_KEY_CODE)
+
+    def _put(self, doc: dict, old: dict = None) -> None:
+        doc_id = _freeze(doc[MONGO_ID])
+        if old is None and doc_id in self._docs:
+            raise DuplicateKeyError(
+                f"E11000 duplicate key error collection: "
+                f"{self.database_name}.{self.name} index: {ID_INDEX} "
+                f"dup key: {{_id: {doc[MONGO_ID]!r}}}", DUP_KEY_CODE)
+        self._check_unique(doc_id, doc)
+        for index in self._indexes.values():
+            if old is not None:
+                index.remove(doc_id, old)
+            index.add(doc_id, doc)
+        self._docs[doc_id] = doc
+
+    def _insert(self, doc: dict):
+        doc.setdefault(MONGO_ID, ObjectId())
+        self._put(copy.deepcopy(doc))
+        return doc[MONGO_ID]
+
+    def _update(self, filt: dict, update: dict, upsert: bool,
+                multi: bool) -> dict:
+        """Mongo's raw update result: n, nModified and maybe upserted."""
+        targets = self._select(filt, limit=0 if multi else 1)
+        if not targets:
+            if not upsert:
+                return {"n": 0, "nModified": 0}
+            base = {}
+            for path, val in _equalities(filt).items():
+                _set(base, path, copy.deepcopy(val))
+            new = _apply_update(base, update, inserting=True)
+            new.setdefault(MONGO_ID, ObjectId())
+            self._put(new)
+            return {"n": 1, "nModified": 0, "upserted": new[MONGO_ID]}
+        modified = 0
+        for old in targets:
+            new = _apply_update(old, update, inserting=False)
+            if new != old:
+                self._put(new, old)
+                modified += 1
+        return {"n": len(targets), "nModified": modified}
+
+    def _delete(self, filt: dict, multi: bool) -> int:
+        targets = self._select(filt, limit=0 if multi else 1)
+        for doc in targets:
+            doc_id = _freeze(doc[MONGO_ID])
+            for index in self._indexes.values():
+                index.remove(doc_id, doc)
+            del self._docs[doc_id]
+        return len(targets)
+
+    def insert_one(self, document: dict, **kwargs) -> InsertOneResult:
+        with self._lock:
+            return InsertOneResult(self._insert(document), True)
+
+    def update_one(self, filter: dict, update: dict, upsert: bool = False,
+                   **kwargs) -> UpdateResult:
+        with self._lock:
+            return UpdateResult(self._update(filter, update, upsert, False),
+                                True)
+
+    def update_many(self, filter: dict, update: dict, upsert: bool = False,
+                    **kwargs) -> UpdateResult:
+        with self._lock:
+            return UpdateResult(self._update(filter, update, upsert, True),
+                                True)
+
+    def replace_one(self, filter: dict, replacement: dict,
+                    upsert: bool = False, **kwargs) -> UpdateResult:
+        return self.update_one(filter, replacement, upsert)
+
+    def delete_one(self, filter: dict, **kwargs) -> DeleteResult:
+        with self._lock:
+            return DeleteResult({"n": self._delete(filter, False)}, True)
+
+    def delete_many(self, filter: dict, **kwargs) -> DeleteResult:
+        with self._lock:
+            return DeleteResult({"n": self._delete(filter, True)}, True)
+
+    def _bulk_op(self, op, raw: dict, index: int) -> None:
+        if isinstance(op, pm.InsertOne):
+            self._insert(op._doc)
+            raw["nInserted"] += 1
+            return
+        if isinstance(op, (pm.DeleteOne, pm.DeleteMany)):
+            raw["nRemoved"] += self._delete(op._filter,
+                                            isinstance(op, pm.DeleteMany))
+            return
+        if isinstance(op, (pm.UpdateOne, pm.UpdateMany, pm.ReplaceOne)):
+            result = self._update(op._filter, op._doc, bool(op._upsert),
+                                  isinstance(op, pm.UpdateMany))
+            if "upserted" in result:
+                raw["nUpserted"] += 1
+                raw["upserted"].append({"index": index,
+                                        MONGO_ID: result["upserted"]})
+            else:
+                raw["nMatched"] += result["n"]
+                raw["nModified"] += result["nModified"]
+            return
+        raise TypeError(f"Unsupported bulk operation: {op!r}")
+
+    def bulk_write(self, requests: list, ordered: bool = True,
+                   **kwargs) -> BulkWriteResult:
+        raw: dict = {"writeErrors": [], "writeConcernErrors": [],
+                     "nInserted": 0, "nUpserted": 0, "nMatched": 0,
+                     "nModified": 0, "nRemoved": 0, "upserted": []}
+        with self._lock:
+            for i, op in enumerate(requests):
+                try:
+                    self._bulk_op(op, raw, i)
+                except DuplicateKeyError as err:
+                    raw["writeErrors"].append({"index": i, "code": err.code,
+                                               "errmsg": str(err)})
+                    if ordered:
+                        break
+        if raw["writeErrors"]:
+            raise BulkWriteError(raw)
+        return BulkWriteResult(raw, True)
+
+    # indexes
+
+    def create_index(self, keys, name: str = None, unique: bool = False,
+                     partialFilterExpression: dict = None,
+                     expireAfterSeconds: int = None, **kwargs) -> str:
+        keys = _sort_spec(keys)
+        name = name or "_".join(f"{field}_{direction}"
+                                for field, direction in keys)
+        index = _Index(name, keys, unique, partialFilterExpression,
+                       expireAfterSeconds)
+        with self._lock:
+            for doc_id, doc in self._docs.items():
+                if index.clash(doc_id, doc):
+                    raise DuplicateKeyError(
+                        f"E11000 duplicate key error building index "
+                        f"{name} on {self.database_name}.{self.name}",
+                        DUP_KEY_CODE)
+                index.add(doc_id, doc)
+            self._indexes[name] = index
+        return name
+
+    def drop_index(self, name: str) -> None:
+        with self._lock:
+            if self._indexes.pop(name, None) is None:
+                raise OperationFailure(f"index not found with name [{name}]")
+
+    def index_information(self) -> dict:
+        info = {ID_INDEX: {"v": 2, "key": [(MONGO_ID, pm.ASCENDING)]}}
+        for name, index in self._indexes.items():
+            info[name] = index.info()
+        return info
+
+    def drop(self) -> None:
+        with self._lock:
+            self._docs.clear()
+            self._indexes.clear()
+
+
+class MemoryDatabase:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getitem__(self, collection: str) -> MemoryCollection:
+        return _collection(self.name, collection)
+
+    def list_collection_names(self) -> list:
+        with _databases_lock:
+            return sorted(_databases.get(self.name, {}))
+
+    def drop_collection(self, collection: str) -> None:
+        with _databases_lock:
+            _databases.get(self.name, {}).pop(collection, None)
+
+    def command(self, command, value=1, **kwargs) -> dict:
+        """ping, and explain of a find or aggregate command."""
+        if command == "ping":
+            return {"ok": 1.0}
+        if command == "explain":
+            if "find" in value:
+                return self[value["find"]].explain(value.get("filter"))
+            if "aggregate" in value:
+                pipeline = value.get("pipeline") or []
+                first = pipeline[0] if pipeline else {}
+                return self[value["aggregate"]].explain(first.get("$match"))
+        raise OperationFailure(f"no such command: {command!r}")
+
+
+class MemoryClient:
+    """Takes (and ignores) MongoClient's arguments."""
+
+    def __init__(self, *args, **kwargs):
+        self.admin = MemoryDatabase("admin")
+
+    def __getitem__(self, db: str) -> MemoryDatabase:
+        return MemoryDatabase(db)
+
+    def list_database_names(self) -> list:
+        with _databases_lock:
+            return sorted(_databases)
+
+    def drop_database(self, db: str) -> None:
+        with _databases_lock:
+            _databases.pop(db, None)
+
+    def close(self) -> None:
+        pass
+
+
+# --- the asyncio flavour, for data.db_connect_async ---
+
+class _AsyncCursor:
+    def __init__(self, cursor: MemoryCursor):
+        self._cursor = cursor
+
+    def sort(self, key_or_list, direction=None) -> "_AsyncCursor":
+        self._cursor.sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit: int) -> "_AsyncCursor":
+        self._cursor.limit(limit)
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration from None
+
+    async def to_list(self, length=None) -> list:
+        docs = list(self._cursor)
+        return docs[:length] if length else docs
+
+    async def close(self) -> None:
+        self._cursor.close()
+
+
+class _AsyncCollection:
+    """Coroutine versions of MemoryCollection's methods."""
+
+    def __init__(self, coll: MemoryCollection):
+        self._coll = coll
+
+    def find(self, *args, **kwargs) -> _AsyncCursor:
+        return _AsyncCursor(self._coll.find(*args, **kwargs))
+
+    async def aggregate(self, *args, **kwargs) -> _AsyncCursor:
+        return _AsyncCursor(self._coll.aggregate(*args, **kwargs))
+
+    def __getattr__(self, name: str):
+        method = getattr(self._coll, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+class _AsyncDatabase:
+    def __init__(self, name: str):
+        self._db = MemoryDatabase(name)
+
+    def __getitem__(self, collection: str) -> _AsyncCollection:
+        return _AsyncCollection(self._db[collection])
+
+    async def command(self, command, value=1, **kwargs) -> dict:
+        return self._db.command(command, value, **kwargs)
+
+
+class AsyncMemoryClient:
+    """MemoryClient for AsyncMongoClient callers; same data."""
+
+    def __init__(self, *args, **kwargs):
+        self.admin = _AsyncDatabase("admin")
+
+    def __getitem__(self, db: str) -> _AsyncDatabase:
+        return _AsyncDatabase(db)
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,210 @@
+"""
+In-process metrics (counters and histograms) rendered in the Prometheus
+text format.
+
+Kept dependency-free and cheap: recording is a dict lookup and a bisect
+under a per-metric lock. Each worker process has its own numbers.
+"""
+import bisect
+import math
+import os
+import threading
+
+import bson
+
+# Latency buckets, in seconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Measuring bytes means BSON-encoding the documents again, so it is off
+# unless METRICS_TRACK_BYTES is set.
+TRACK_BYTES = os.getenv("METRICS_TRACK_BYTES", "") not in ("", "0")
+
+# every metric created, in creation order; see render()
+registry: list = []
+
+
+def _escape(value) -> str:
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(val)}"' for name, val in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _num(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count, per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self._values: dict = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.label_names, key)} {_num(val)}"
+                for key, val in items]
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, plus their sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self._values: dict = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[labels] = entry
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, *labels) -> int:
+        entry = self._values.get(labels)
+        return entry[2] if entry else 0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> list:
+        with self._lock:
+            items = sorted((key, ([*counts], total, n))
+                           for key, (counts, total, n) in self._values.items())
+        lines = []
+        for key, (counts, total, n) in items:
+            running = 0
+            for bound, hits in zip((*self.buckets, math.inf), counts):
+                running += hits
+                le = f'le="{_num(bound)}"'
+                lines.append(f"{self.name}_bucket"
+                             f"{_labels(self.label_names, key, le)} {running}")
+            label_str = _labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{label_str} {_num(total)}")
+            lines.append(f"{self.name}_count{label_str} {n}")
+        return lines
+
+
+def render() -> str:
+    """Every registered metric, in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.doc}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+# DB operations, recorded by data.db_connect(_async).needs_db:
+DB_SECONDS = Histogram("db_operation_seconds",
+                       "Time taken by data.db_connect operations.",
+                       ("op", "collection"))
+DB_ERRORS = Counter("db_operation_errors_total",
+                    "data.db_connect operations that raised.",
+                    ("op", "collection", "error"))
+DB_DOCS = Counter("db_documents_total",
+                  "Documents returned or written by data.db_connect "
+                  "operations.",
+                  ("op", "collection"))
+DB_BYTES = Counter("db_document_bytes_total",
+                   "BSON size of documents returned by data.db_connect "
+                   "operations (only with METRICS_TRACK_BYTES).",
+                   ("op", "collection"))
+
+# HTTP requests, recorded by the server:
+HTTP_SECONDS = Histogram("http_request_seconds",
+                         "Time taken to handle HTTP requests.",
+                         ("method", "endpoint", "status"))
+
+
+def doc_bytes(docs) -> int:
+    """The BSON size of the dicts among `docs`."""
+    return sum(len(bson.encode(doc)) for doc in docs
+               if isinstance(doc, dict))
+
+
+def measure(result) -> tuple:
+    """
+    (documents, bytes) moved by a DB operation, judged from its result:
+    a doc or list of docs, a count, a bulk report, or a pymongo result.
+    """
+    if result is None:
+        return 0, 0
+    if isinstance(result, bool):
+        return 0, 0
+    if isinstance(result, int):
+        return result, 0
+    if isinstance(result, str):  # a new doc's id
+        return 1, 0
+    if isinstance(result, list):
+        return len(result), doc_bytes(result) if TRACK_BYTES else 0
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return measure(result[0])  # e.g. read_page()'s (docs, token)
+    if isinstance(result, dict):
+        if "inserted" in result and "errors" in result:  # bulk report
+            return (result["inserted"] + result["upserted"]
+                    + result["modified"] + result["deleted"]), 0
+        return 1, doc_bytes([result]) if TRACK_BYTES else 0
+    for attr in ("deleted_count", "modified_count"):
+        if hasattr(result, attr):
+            return getattr(result, attr) or 0, 0
+    if hasattr(result, "inserted_id"):
+        return 1, 0
+    return 0, 0
+
+
+def record_db(op: str, collection: str, seconds: float, result=None,
+              error: BaseException = None) -> None:
+    """Record one DB operation's latency and outcome."""
+    DB_SECONDS.observe(seconds, op, collection)
+    if error is not None:
+        DB_ERRORS.inc(op, collection, type(error).__name__)
+        return
+    docs, nbytes = measure(result)
+    if docs:
+        DB_DOCS.inc(op, collection, amount=docs)
+    if nbytes:
+        DB_BYTES.inc(op, collection, amount=nbytes)
@@ -0,0 +1,163 @@
+"""
+A log of slow data.db_connect operations, for finding the queries that
+are missing an index without turning on the server's profiler.
+
+Operations taking at least SLOW_QUERY_MS (default 100) are logged to the
+"data.slow_queries" logger, at WARNING, with their collection, filter
+shape (field names and operators kept, values redacted), duration and
+document count. With SLOW_QUERY_EXPLAIN set, the first slow run of each
+shape is also explained with "executionStats", on a background thread so
+the slow request isn't made slower: a summary (plan stages, keys and docs
+examined) is logged and the full output kept in `explains`.
+
+Durations are DB time only; for read_iter that is the cursor fetches, not
+the caller's work between them.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# In seconds; a negative SLOW_QUERY_MS turns the log off.
+THRESHOLD = float(os.getenv("SLOW_QUERY_MS", "100")) / 1000
+EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "") not in ("", "0")
+
+# Stop explaining new shapes after this many.
+MAX_EXPLAINS = 500
+
+REDACTED = "?"
+
+# Argument names that hold a dbc function's filter (or pipeline).
+FILTER_ARGS = ("filt", "filters", "key_filt", "pipeline")
+PIPELINE = "pipeline"
+
+# Name of the threads explains run on.
+EXPLAIN_THREAD = "slow-query-explain"
+
+# shape key -> explain output (None while it is being fetched)
+explains: dict = {}
+_explains_lock = threading.Lock()
+
+
+def redact(value):
+    """
+    The shape of a filter or pipeline: dict keys are kept, every other
+    value becomes REDACTED, and lists keep one copy of each distinct
+    shape (so {"$in": [1, 2, 3]} becomes {"$in": ["?"]}).
+    """
+    if isinstance(value, dict):
+        return {key: redact(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes: list = []
+        for item in value:
+            shape = redact(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return REDACTED
+
+
+def query_args(sig, args, kwargs) -> tuple:
+    """
+    (argument name, filter, db) of a call to a dbc function with the
+    signature `sig`; the name and filter are None if it takes neither.
+    """
+    try:
+        bound = sig.bind_partial(*args, **kwargs)
+    except TypeError:
+        return None, None, None
+    db = bound.arguments.get("db")
+    if db is None and "db" in sig.parameters:
+        db = sig.parameters["db"].default
+    for name in FILTER_ARGS:
+        if name in sig.parameters:
+            return name, bound.arguments.get(name), db
+    return None, None, db
+
+
+def _stages(plan) -> list:
+    """The stage names of a query plan, outermost first."""
+    found = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            found.append(plan["stage"])
+        for val in plan.values():
+            found.extend(_stages(val))
+    elif isinstance(plan, list):
+        for val in plan:
+            found.extend(_stages(val))
+    return found
+
+
+def _find(obj, key):
+    """The first value under `key` anywhere in a nested explain output."""
+    if isinstance(obj, dict):
+        if key in obj:
+            return obj[key]
+        obj = list(obj.values())
+    if isinstance(obj, list):
+        for val in obj:
+            found = _find(val, key)
+            if found is not None:
+                return found
+    return None
+
+
+def summarize(explain: dict) -> dict:
+    """The parts of an explain("executionStats") output worth logging."""
+    stats = _find(explain, "executionStats") or {}
+    return {
+        "stages": _stages(_find(explain, "winningPlan")),
+        "nReturned": stats.get("nReturned"),
+        "totalKeysExamined": stats.get("totalKeysExamined"),
+        "totalDocsExamined": stats.get("totalDocsExamined"),
+        "executionTimeMillis": stats.get("executionTimeMillis"),
+    }
+
+
+def check(sig, op: str, collection: str, args, kwargs, seconds: float,
+          docs: int, explain=None) -> Optional[threading.Thread]:
+    """
+    Log the call `op(*args, **kwargs)` if it took `seconds` >= THRESHOLD.
+
+    `explain(db, collection, arg_name, filt)` returns the explain output
+    for a filter; given, and with EXPLAIN on, it is called for the first
+    slow call of each shape, on a new thread, which is returned.
+    """
+    if THRESHOLD < 0 or seconds < THRESHOLD:
+        return None
+    name, filt, db = query_args(sig, args, kwargs)
+    shape = json.dumps(redact(filt or {}), sort_keys=True) if name else ""
+    logger.warning("slow query: %s.%s took %.1f ms, %d docs%s",
+                   collection, op, seconds * 1000, docs,
+                   f", {name}={shape}" if name else "")
+    if not (EXPLAIN and explain and filt):
+        return None  # (an empty filter has no index to miss)
+    key = f"{collection}.{op} {shape}"
+    with _explains_lock:
+        if key in explains or len(explains) >= MAX_EXPLAINS:
+            return None
+        explains[key] = None
+    thread = threading.Thread(target=_explain, name=EXPLAIN_THREAD,
+                              args=(key, explain, db, collection, name, filt),
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def _explain(key: str, explain, db, collection: str, name: str,
+             filt) -> None:
+    """Fetch, keep and log the explain output for the shape `key`."""
+    try:
+        result = explain(db, collection, name, filt)
+    except Exception as err:
+        logger.info("could not explain %s: %s", key, err)
+        with _explains_lock:
+            explains.pop(key, None)
+        return
+    explains[key] = result
+    logger.warning("explain %s: %s", key,
+                   json.dumps(summarize(result), default=str))
@@ -0,0 +1,100 @@
+import pytest
+
+from data.cache import BoundedCache
+import data.cache as cch
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_unbounded_acts_like_dict():
+    cache = BoundedCache()
+    for i in range(100):
+        cache[i] = {'n': i}
+    assert len(cache) == 100
+    assert cache[5] == {'n': 5}
+    assert cache.get('missing') is None
+    del cache[5]
+    assert 5 not in cache
+    assert cache.stats()[cch.EVICTIONS] == 0
+
+
+def test_lru_eviction_by_entries():
+    evicted = []
+    cache = BoundedCache(max_entries=2,
+                         on_evict=lambda key, val: evicted.append(key))
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache['a'] == 1  # 'b' is now least recently used
+    cache['c'] = 3
+    assert evicted == ['b']
+    assert set(cache) == {'a', 'c'}
+    assert cache.stats()[cch.EVICTIONS] == 1
+
+
+def test_eviction_by_bytes():
+    cache = BoundedCache(max_bytes=10, sizeof=lambda val: 4)
+    for key in 'abcd':
+        cache[key] = key
+    assert list(cache) == ['c', 'd']
+    assert cache.total_bytes == 8
+
+
+def test_ttl_expiry():
+    clock = FakeClock()
+    evicted = []
+    cache = BoundedCache(ttl=10, clock=clock,
+                         on_evict=lambda key, val: evicted.append(key))
+    cache['a'] = 1
+    clock.now = 9
+    assert cache['a'] == 1
+    clock.now = 10
+    with pytest.raises(KeyError):
+        cache['a']
+    assert evicted == ['a']
+    assert cache.stats()[cch.EXPIRATIONS] == 1
+
+
+def test_purge():
+    clock = FakeClock()
+    cache = BoundedCache(ttl=1, clock=clock)
+    cache['a'] = 1
+    cache['b'] = 2
+    clock.now = 5
+    assert cache.purge() == 2
+    assert len(cache) == 0
+
+
+def test_hit_miss_counters_and_peek():
+    cache = BoundedCache()
+    cache['a'] = 1
+    cache.get('a')
+    cache.get('b')
+    assert cache.peek('a') == 1
+    assert 'a' in cache
+    stats = cache.stats()
+    assert (stats[cch.HITS], stats[cch.MISSES]) == (1, 1)
+
+
+def test_copy_is_plain_dict():
+    cache = BoundedCache()
+    cache['a'] = 1
+    snap = cache.copy()
+    assert snap == {'a': 1}
+    assert type(snap) is dict
+    assert isinstance(cache, dict)
+
+
+def test_pop_and_update():
+    cache = BoundedCache(max_entries=2)
+    cache.update({'a': 1, 'b': 2, 'c': 3})
+    assert set(cache) == {'b', 'c'}
+    assert cache.pop('b') == 2
+    assert cache.pop('b', None) is None
+    with pytest.raises(KeyError):
+        cache.pop('b')
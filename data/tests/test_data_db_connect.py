@@ -1,3 +1,9 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError
+
 import data.db_connect as dbc
 
 VALID_ID = '1' * dbc.MIN_ID_LEN
@@ -14,3 +20,311 @@ def test_is_not_valid_id():
 
 def test_is_not_valid_id_bad_type():
     assert not dbc.is_valid_id(17)
+
+
+def _bulk_result(n_inserted, write_errors=()):
+    return {'nInserted': n_inserted, 'writeErrors': list(write_errors)}
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_create_many_batches(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.bulk_write.return_value.bulk_api_result = _bulk_result(2)
+    docs = [{'name': str(i)} for i in range(5)]
+    report = dbc.create_many('cities', docs, batch_size=2)
+    assert coll.bulk_write.call_count == 3
+    assert report[dbc.INSERTED] == 6
+    assert not report[dbc.ERRORS]
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_bulk_write_ordered_stops_at_failure(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    details = _bulk_result(1, [{'index': 1, 'errmsg': 'dup'}])
+    coll.bulk_write.side_effect = BulkWriteError(details)
+    report = dbc.bulk_write('cities', [object()] * 5, batch_size=3)
+    assert coll.bulk_write.call_count == 1
+    assert report[dbc.ERRORS] == [{dbc.INDEX: 1, dbc.ERROR: 'dup'}]
+    assert report[dbc.SKIPPED] == [2, 3, 4]
+    assert set(dbc.failed_indexes(report)) == {1, 2, 3, 4}
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_bulk_write_unordered_reports_all(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.bulk_write.side_effect = [
+        BulkWriteError(_bulk_result(1, [{'index': 0, 'errmsg': 'a'}])),
+        BulkWriteError(_bulk_result(1, [{'index': 1, 'errmsg': 'b'}])),
+    ]
+    report = dbc.bulk_write('cities', [object()] * 4, ordered=False,
+                            batch_size=2)
+    assert [err[dbc.INDEX] for err in report[dbc.ERRORS]] == [0, 3]
+    assert report[dbc.INSERTED] == 2
+    assert not report[dbc.SKIPPED]
+
+
+def test_bulk_write_bad_batch_size():
+    with patch('data.db_connect.connect_db'), \
+            patch('data.db_connect.client'):
+        with pytest.raises(ValueError):
+            dbc.bulk_write('cities', [object()], batch_size=0)
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_read_iter_streams(mock_client, mock_connect):
+    cursor = MagicMock()
+    cursor.__iter__.return_value = iter([{dbc.MONGO_ID: 1, 'name': 'a'},
+                                         {dbc.MONGO_ID: 2, 'name': 'b'}])
+    cursor.sort.return_value = cursor
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value = cursor
+    docs = dbc.read_iter('cities', {'name': 'a'}, batch_size=10,
+                         sort='name', projection={'name': 1})
+    assert next(docs) == {'name': 'a'}
+    coll.find.assert_called_once_with({'name': 'a'}, {'name': 1},
+                                      batch_size=10, limit=0)
+    cursor.sort.assert_called_once_with('name')
+    docs.close()
+    cursor.close.assert_called_once()
+
+
+@patch('data.db_connect.read_iter',
+       return_value=iter([{'code': 'NY'}, {'code': 'NJ'}]))
+def test_read_dict(mock_read_iter):
+    assert set(dbc.read_dict('states', 'code')) == {'NY', 'NJ'}
+
+
+def test_fields_projection():
+    assert dbc.fields_projection(None) is None
+    assert dbc.fields_projection(['name', 'code']) == {'name': 1, 'code': 1}
+
+
+def test_page_token_round_trip():
+    oid = ObjectId()
+    assert dbc.decode_page_token(dbc.encode_page_token(oid)) == oid
+    assert dbc.decode_page_token(dbc.encode_page_token('Albany')) == 'Albany'
+
+
+def test_decode_bad_page_token():
+    with pytest.raises(ValueError):
+        dbc.decode_page_token('not a token')
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_read_page(mock_client, mock_connect):
+    oids = [ObjectId() for _ in range(3)]
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value = iter([{dbc.MONGO_ID: oid} for oid in oids])
+    after = dbc.encode_page_token(ObjectId())
+    docs, next_token = dbc.read_page('cities', 2, after=after,
+                                     filt={'state_code': 'NY'})
+    assert docs == [{dbc.MONGO_ID: str(oid)} for oid in oids[:2]]
+    assert dbc.decode_page_token(next_token) == oids[1]
+    query = coll.find.call_args.args[0]
+    assert query['state_code'] == 'NY'
+    assert '$gt' in query[dbc.MONGO_ID]
+    assert coll.find.call_args.kwargs['limit'] == 3
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_read_page_last_page(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value = iter([{dbc.MONGO_ID: ObjectId()}])
+    docs, next_token = dbc.read_page('cities', 2)
+    assert len(docs) == 1
+    assert next_token is None
+
+
+def test_register_index_replaces_same_name():
+    with patch.dict('data.db_connect.index_registry', {}, clear=True):
+        dbc.register_index('things', 'name')
+        spec = dbc.register_index('things', 'name', unique=True)
+        assert spec[dbc.IDX_NAME] == 'name_1'
+        assert dbc.index_registry['things'] == [spec]
+
+
+@patch('data.db_connect.connect_db')
+def test_ensure_indexes_reconciles(mock_connect):
+    coll = mock_connect.return_value[dbc.SE_DB]['things']
+    coll.index_information.return_value = {
+        '_id_': {'key': [('_id', 1)]},
+        'name_1': {'key': [('name', 1)]},
+        'code_1': {'key': [('code', 1)]},
+    }
+    with patch.dict('data.db_connect.index_registry', {}, clear=True):
+        dbc.register_index('things', 'name')
+        dbc.register_index('things', 'code', unique=True)
+        dbc.register_index('things', 'expires', ttl=60,
+                           partial={'expires': {'$exists': True}})
+        dbc.ensure_indexes()
+    # name_1 matches and is left alone; code_1 changed (and is built
+    # under a temporary name before the old one goes); expires_1 is new.
+    tmp_name = 'code_1' + dbc.IDX_TMP_SUFFIX
+    assert [call.args[0] for call in coll.drop_index.call_args_list] == [
+        'code_1', tmp_name]
+    created = {call.kwargs['name']: call.kwargs
+               for call in coll.create_index.call_args_list}
+    assert set(created) == {tmp_name, 'code_1', 'expires_1'}
+    assert created['code_1']['unique'] is True
+    assert created['expires_1'][dbc.IDX_TTL] == 60
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_insert_unique(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['states']
+    coll.update_one.return_value.upserted_id = ObjectId()
+    assert dbc.insert_unique('states', {'code': 'NY'}, {'code': 'NY'})
+    coll.update_one.return_value.upserted_id = None
+    assert dbc.insert_unique('states', {'code': 'NY'}, {'code': 'NY'}) is None
+    coll.update_one.side_effect = DuplicateKeyError('dup')
+    assert dbc.insert_unique('states', {'code': 'NY'}, {'code': 'NY'}) is None
+
+
+@pytest.fixture
+def fresh_health():
+    with patch.dict('data.db_connect.health',
+                    {'state': dbc.CLOSED, 'failures': 0, 'ok_at': None,
+                     'opened_at': 0.0}):
+        yield dbc.health
+
+
+def test_is_available_trusts_fresh_check(fresh_health):
+    dbc.mark_up()
+    with patch('data.db_connect.ping') as mock_ping:
+        assert dbc.is_available()
+        mock_ping.assert_not_called()
+
+
+def test_is_available_probes_when_stale(fresh_health):
+    with patch('data.db_connect.ping', return_value=True) as mock_ping:
+        assert dbc.is_available()
+        mock_ping.assert_called_once()
+
+
+def test_breaker_opens_and_fails_fast(fresh_health):
+    for _ in range(dbc.BREAKER_THRESHOLD):
+        dbc.mark_down()
+    assert fresh_health['state'] == dbc.OPEN
+    with patch('data.db_connect.ping') as mock_ping:
+        assert not dbc.is_available()
+        mock_ping.assert_not_called()
+
+
+def test_breaker_half_open_probe(fresh_health):
+    for _ in range(dbc.BREAKER_THRESHOLD):
+        dbc.mark_down()
+    fresh_health['opened_at'] -= dbc.BREAKER_COOLDOWN
+
+    def probe():
+        assert fresh_health['state'] == dbc.HALF_OPEN
+        dbc.mark_up()
+        return True
+
+    with patch('data.db_connect.ping', side_effect=probe):
+        assert dbc.is_available()
+    assert fresh_health['state'] == dbc.CLOSED
+
+
+def test_needs_db_marks_down_on_connection_failure(fresh_health):
+    @dbc.needs_db
+    def broken():
+        raise ConnectionFailure('gone')
+
+    with patch('data.db_connect.connect_db'):
+        with pytest.raises(ConnectionFailure):
+            broken()
+    assert fresh_health['failures'] == 1
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_backfill_field(mock_client, mock_connect):
+    oids = [ObjectId() for _ in range(3)]
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value = iter([{dbc.MONGO_ID: oid} for oid in oids])
+    coll.bulk_write.return_value.bulk_api_result = {'nModified': 2}
+    updated = dbc.backfill_field('cities', 'id',
+                                 lambda doc: str(doc[dbc.MONGO_ID]),
+                                 batch_size=2)
+    assert coll.bulk_write.call_count == 2
+    assert updated == 4
+    first_op = coll.bulk_write.call_args_list[0].args[0][0]
+    assert first_op._doc == {'$set': {'id': str(oids[0])}}
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_group_count(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    cursor = MagicMock()
+    cursor.__enter__.return_value = cursor
+    cursor.__iter__.return_value = iter([{dbc.MONGO_ID: 'NY', 'count': 2},
+                                         {dbc.MONGO_ID: 'NJ', 'count': 1}])
+    coll.aggregate.return_value = cursor
+    assert dbc.group_count('cities', 'state_code', {'x': 1}) \
+        == {'NY': 2, 'NJ': 1}
+    pipeline = coll.aggregate.call_args.args[0]
+    assert pipeline[0] == {'$match': {'x': 1}}
+    assert pipeline[1]['$group']['_id'] == '$state_code'
+    assert coll.aggregate.call_args.kwargs['allowDiskUse'] is True
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_count_and_distinct(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.estimated_document_count.return_value = 7
+    coll.count_documents.return_value = 3
+    coll.distinct.return_value = ['NY']
+    assert dbc.count('cities') == 7
+    assert dbc.count('cities', {'state_code': 'NY'}) == 3
+    assert dbc.distinct('cities', 'state_code') == ['NY']
+    coll.distinct.assert_called_once_with('state_code', {})
+
+
+def test_client_options_profiles(monkeypatch):
+    monkeypatch.delenv('MONGO_PROFILE', raising=False)
+    monkeypatch.delenv('MONGO_MAX_POOL_SIZE', raising=False)
+    opts = dbc.client_options()
+    assert opts['serverSelectionTimeoutMS'] == 5000
+    assert isinstance(opts['event_listeners'][0], dbc._HeartbeatListener)
+    monkeypatch.setenv('MONGO_PROFILE', dbc.PROFILE_WEB)
+    monkeypatch.setenv('MONGO_MAX_POOL_SIZE', '4')
+    opts = dbc.client_options()
+    assert opts['maxPoolSize'] == 4
+    assert opts['minPoolSize'] == dbc.PROFILES[dbc.PROFILE_WEB]['minPoolSize']
+    monkeypatch.setenv('MONGO_PROFILE', 'nope')
+    with pytest.raises(ValueError):
+        dbc.client_options()
+
+
+def test_connect_db_rebuilds_in_new_process():
+    old_client = MagicMock()
+    with patch.object(dbc, 'client', old_client), \
+            patch.object(dbc, 'client_pid', 1), \
+            patch('data.db_connect.os.getpid', return_value=1), \
+            patch('data.db_connect._build_client_from_env') as mock_build:
+        assert dbc.connect_db() is old_client
+        mock_build.assert_not_called()
+        with patch('data.db_connect.os.getpid', return_value=2):
+            assert dbc.connect_db() is mock_build.return_value
+            assert dbc.client_pid == 2
+        old_client.close.assert_not_called()
+
+
+def test_reset_after_fork():
+    with patch.object(dbc, 'client', MagicMock()), \
+            patch.object(dbc, 'client_pid', 1), \
+            patch.object(dbc, '_health_lock'), \
+            patch.object(dbc, '_probe_lock'), \
+            patch.object(dbc, '_client_lock'):
+        dbc._reset_after_fork()
+        assert dbc.client is None
+        assert dbc.client_pid is None
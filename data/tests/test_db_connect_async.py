@@ -0,0 +1,127 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+import data.db_connect as dbc
+import data.db_connect_async as adbc
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = list(docs)
+        self.closed = False
+
+    def sort(self, key):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.docs:
+            raise StopAsyncIteration
+        return self.docs.pop(0)
+
+    async def close(self):
+        self.closed = True
+
+
+def fake_client():
+    client = MagicMock()
+    client.admin.command = AsyncMock(return_value={'ok': 1})
+    return client
+
+
+@pytest.fixture
+def mock_build():
+    with patch('data.db_connect_async._build_client',
+               side_effect=fake_client) as build, \
+            patch.object(adbc, '_clients', adbc.weakref.WeakKeyDictionary()):
+        yield build
+
+
+def test_one_client_per_loop(mock_build):
+    async def get_twice():
+        return await adbc.connect_db(), await adbc.connect_db()
+
+    first, again = asyncio.run(get_twice())
+    assert first is again
+    second, _ = asyncio.run(get_twice())
+    assert second is not first
+    assert mock_build.call_count == 2
+
+
+def test_read_one(mock_build):
+    async def go():
+        db_client = await adbc.connect_db()
+        coll = db_client[dbc.SE_DB]['cities']
+        coll.find_one = AsyncMock(return_value={dbc.MONGO_ID: 1, 'a': 2})
+        return await adbc.read_one('cities', {'a': 2})
+
+    assert asyncio.run(go()) == {dbc.MONGO_ID: '1', 'a': 2}
+
+
+def test_read_iter(mock_build):
+    cursor = FakeCursor([{dbc.MONGO_ID: 1, 'a': 1}, {dbc.MONGO_ID: 2, 'a': 2}])
+
+    async def go():
+        db_client = await adbc.connect_db()
+        db_client[dbc.SE_DB]['cities'].find.return_value = cursor
+        return await adbc.read('cities')
+
+    assert asyncio.run(go()) == [{'a': 1}, {'a': 2}]
+    assert cursor.closed
+
+
+def test_read_iter_metered(mock_build):
+    cursor = FakeCursor([{'a': 1}, {'a': 2}, {'a': 3}])
+
+    async def go():
+        db_client = await adbc.connect_db()
+        db_client[dbc.SE_DB]['cities'].find.return_value = cursor
+        docs = adbc.read_iter('cities', {'a': 1})
+        first = await anext(docs)
+        await docs.aclose()  # e.g. a client disconnecting mid-stream
+        return first
+
+    with patch('data.metrics.record_db') as mock_record, \
+            patch('data.slow_queries.THRESHOLD', 0), \
+            patch('data.slow_queries.check') as mock_check:
+        assert asyncio.run(go()) == {'a': 1}
+    assert cursor.closed
+    op, collection, _seconds, docs = mock_record.call_args.args
+    assert (op, collection, docs) == ('read_iter', 'cities', 1)
+    assert mock_check.call_args.args[1:3] == ('read_iter', 'cities')
+
+
+def test_is_available_uses_shared_health():
+    with patch.dict('data.db_connect.health',
+                    {'state': dbc.CLOSED, 'failures': 0, 'ok_at': None,
+                     'opened_at': 0.0}):
+        dbc.mark_up()
+        with patch('data.db_connect_async.ping') as mock_ping:
+            assert asyncio.run(adbc.is_available())
+            mock_ping.assert_not_called()
+
+
+def test_run_from_sync_code():
+    async def add(a, b):
+        await asyncio.sleep(0)
+        return a + b
+
+    assert adbc.run(add(1, 2)) == 3
+    assert adbc.run(add(2, 2)) == 4
+
+
+def test_run_refuses_its_own_loop():
+    async def nested():
+        inner = add_one()
+        with pytest.raises(RuntimeError):
+            adbc.run(inner)
+        return True
+
+    async def add_one():
+        return 1
+
+    assert adbc.run(nested())
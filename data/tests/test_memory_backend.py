@@ -0,0 +1,180 @@
+import re
+from unittest.mock import patch
+
+import pymongo as pm
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+import data.db_connect as dbc
+import data.db_connect_async as adbc
+import data.memory_backend as mb
+
+COLL = 'things'
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    """dbc running on a fresh in-memory engine."""
+    monkeypatch.setenv('DB_BACKEND', dbc.BACKEND_MEMORY)
+    mb.reset()
+    with patch('data.db_connect.client', None), \
+            patch('data.db_connect.client_pid', None):
+        yield dbc.connect_db()
+    mb.reset()
+
+
+def test_backend_from_env(monkeypatch):
+    monkeypatch.delenv('DB_BACKEND', raising=False)
+    assert dbc.backend() == dbc.BACKEND_MONGO
+    monkeypatch.setenv('DB_BACKEND', 'memory')
+    assert isinstance(dbc._build_client_from_env(), mb.MemoryClient)
+    monkeypatch.setenv('DB_BACKEND', 'nope')
+    with pytest.raises(ValueError):
+        dbc.backend()
+
+
+@pytest.mark.parametrize('filt, expected', [
+    ({'name': 'b'}, True),
+    ({'name': 'x'}, False),
+    ({'n': {'$gt': 1, '$lte': 2}}, True),
+    ({'n': {'$gt': '1'}}, False),  # no comparing across types
+    ({'n': {'$in': [5, 2]}}, True),
+    ({'tags': 'red'}, True),
+    ({'missing': None}, True),
+    ({'missing': {'$exists': True}}, False),
+    ({'name': {'$type': 'string'}}, True),
+    ({'name': {'$regex': '^B', '$options': 'i'}}, True),
+    ({'name': re.compile('^z')}, False),
+    ({'loc.coordinates': -73.0}, True),
+    ({'$or': [{'name': 'x'}, {'n': 2}]}, True),
+    ({'$nor': [{'n': 2}]}, False),
+    ({'n': {'$not': {'$gt': 5}}}, True),
+])
+def test_matches(filt, expected):
+    doc = {'name': 'b', 'n': 2, 'tags': ['red', 'blue'],
+           'loc': {'type': 'Point', 'coordinates': [-73.0, 42.0]}}
+    assert mb.matches(doc, filt) is expected
+
+
+def test_crud_through_dbc(memory_db):
+    dbc.create(COLL, {'name': 'a', 'n': 1})
+    dbc.create(COLL, {'name': 'b', 'n': 2})
+    assert dbc.read_one(COLL, {'name': 'b'})['n'] == 2
+    assert dbc.update(COLL, {'name': 'b'}, {'n': 3}).modified_count == 1
+    assert dbc.read_dict(COLL, 'name') == {'a': {'name': 'a', 'n': 1},
+                                           'b': {'name': 'b', 'n': 3}}
+    assert dbc.delete(COLL, {'name': 'a'}) == 1
+    assert dbc.delete(COLL, {'name': 'a'}) == 0
+    assert dbc.read(COLL) == [{'name': 'b', 'n': 3}]
+
+
+def test_reads_return_copies(memory_db):
+    dbc.create(COLL, {'name': 'a', 'nested': {'x': 1}})
+    doc = dbc.read_one(COLL, {'name': 'a'})
+    doc['nested']['x'] = 99
+    assert dbc.read_one(COLL, {'name': 'a'})['nested'] == {'x': 1}
+
+
+def test_sort_page_count_distinct_group(memory_db):
+    for i, state in enumerate(['NY', 'CA', 'NY']):
+        dbc.create(COLL, {'name': f'c{i}', 'state_code': state})
+    names = [d['name'] for d in dbc.read_iter(COLL, sort=[('name', dbc.DESC)],
+                                              limit=2)]
+    assert names == ['c2', 'c1']
+    page, token = dbc.read_page(COLL, 2)
+    assert len(page) == 2 and token
+    rest, token = dbc.read_page(COLL, 2, after=token)
+    assert [d['name'] for d in rest] == ['c2'] and token is None
+    assert dbc.count(COLL) == 3
+    assert dbc.count(COLL, {'state_code': 'NY'}) == 2
+    assert sorted(dbc.distinct(COLL, 'state_code')) == ['CA', 'NY']
+    assert dbc.group_count(COLL, 'state_code') == {'NY': 2, 'CA': 1}
+
+
+def test_unique_partial_index(memory_db):
+    dbc.register_index(COLL, 'code', unique=True,
+                       partial={'code': {'$type': 'string'}})
+    try:
+        dbc.ensure_indexes()
+        coll = memory_db[dbc.SE_DB][COLL]
+        coll.insert_one({'code': 'A'})
+        coll.insert_one({'code': 1})
+        coll.insert_one({'code': 1})  # outside the partial index
+        with pytest.raises(DuplicateKeyError):
+            coll.insert_one({'code': 'A'})
+        plan = coll.explain({'code': 'A'})['queryPlanner']['winningPlan']
+        assert plan['inputStage']['indexName'] == 'code_1'
+        assert coll.find_one({'code': 'A'})['code'] == 'A'
+    finally:
+        dbc.index_registry.pop(COLL, None)
+
+
+def test_failed_rebuild_keeps_old_index(memory_db, capsys):
+    coll = memory_db[dbc.SE_DB][COLL]
+    coll.create_index('code', name='code_1')
+    coll.insert_one({'code': 'A'})
+    coll.insert_one({'code': 'A'})
+    dbc.register_index(COLL, 'code', unique=True)
+    dbc.register_index(COLL, 'name')
+    try:
+        dbc.ensure_indexes()
+    finally:
+        dbc.index_registry.pop(COLL, None)
+    info = coll.index_information()
+    assert not info['code_1'].get('unique')
+    assert 'name_1' in info
+    assert not any(name.endswith(dbc.IDX_TMP_SUFFIX) for name in info)
+    assert 'Could not build index code_1' in capsys.readouterr().out
+
+
+def test_compound_index_prefix_lookup(memory_db):
+    coll = memory_db[dbc.SE_DB][COLL]
+    coll.create_index([('state', pm.ASCENDING), ('name', pm.ASCENDING)])
+    for state, name in [('NY', 'b'), ('CA', 'a'), ('NY', 'a')]:
+        coll.insert_one({'state': state, 'name': name})
+    assert coll.explain({'state': 'NY'})['executionStats'][
+        'totalDocsExamined'] == 2
+    assert [d['name'] for d in coll.find({'state': 'NY'})] == ['a', 'b']
+    coll.update_one({'state': 'NY', 'name': 'b'}, {'$set': {'state': 'CA'}})
+    assert coll.count_documents({'state': 'NY'}) == 1
+
+
+def test_bulk_writes(memory_db):
+    dbc.register_index(COLL, 'key', unique=True)
+    try:
+        dbc.ensure_indexes()
+        docs = [{'key': 1}, {'key': 1}, {'key': 2}]
+        report = dbc.create_many(COLL, docs, ordered=False)
+        assert report[dbc.INSERTED] == 2
+        assert list(dbc.failed_indexes(report)) == [1]
+        report = dbc.create_many_unique(COLL, [{'key': 2}, {'key': 3}],
+                                        ['key'])
+        assert report[dbc.DUPLICATES] == [0]
+        assert list(report[dbc.INSERTED_IDS]) == [1]
+        assert dbc.insert_unique(COLL, {'key': 3}, {'key': 3}) is None
+        assert dbc.insert_unique(COLL, {'key': 4}, {'key': 4})
+    finally:
+        dbc.index_registry.pop(COLL, None)
+
+
+def test_near_sphere(memory_db):
+    coll = memory_db[dbc.SE_DB][COLL]
+    coll.insert_one({'name': 'far', 'loc': {'type': 'Point',
+                                            'coordinates': [-118.2, 34.0]}})
+    coll.insert_one({'name': 'near', 'loc': {'type': 'Point',
+                                             'coordinates': [-73.9, 40.7]}})
+    coll.insert_one({'name': 'nowhere'})
+    spec = {'$geometry': {'type': 'Point', 'coordinates': [-74.0, 40.7]}}
+    names = [d['name'] for d in coll.find({'loc': {'$nearSphere': spec}})]
+    assert names == ['near', 'far']
+    spec['$maxDistance'] = 50_000
+    assert [d['name'] for d in coll.find({'loc': {'$nearSphere': spec}})] \
+        == ['near']
+
+
+def test_async_shares_data(memory_db):
+    dbc.create(COLL, {'name': 'a'})
+    with patch('data.db_connect_async._clients', {}):
+        assert adbc.run(adbc.read_one(COLL, {'name': 'a'}))['name'] == 'a'
+        assert adbc.run(adbc.count(COLL)) == 1
+        assert adbc.run(adbc.read(COLL)) == [{'name': 'a'}]
@@ -0,0 +1,123 @@
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from pymongo.errors import ConnectionFailure
+
+import data.db_connect as dbc
+import data.metrics as mt
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    for metric in mt.registry:
+        metric.clear()
+    yield
+
+
+def test_histogram_buckets_are_cumulative():
+    hist = mt.Histogram('t_seconds', 'test', ('op',), buckets=(0.1, 1.0))
+    mt.registry.remove(hist)
+    for value in (0.05, 0.5, 5.0):
+        hist.observe(value, 'read')
+    lines = hist.samples()
+    assert 't_seconds_bucket{op="read",le="0.1"} 1' in lines
+    assert 't_seconds_bucket{op="read",le="1.0"} 2' in lines
+    assert 't_seconds_bucket{op="read",le="+Inf"} 3' in lines
+    assert 't_seconds_count{op="read"} 3' in lines
+    assert hist.count('read') == 3
+
+
+def test_render_escapes_labels():
+    mt.DB_ERRORS.inc('read', 'a"b', 'X')
+    text = mt.render()
+    assert '# TYPE db_operation_errors_total counter' in text
+    assert ('db_operation_errors_total'
+            '{op="read",collection="a\\"b",error="X"} 1') in text
+
+
+@pytest.mark.parametrize('result, docs', [
+    (None, 0),
+    (True, 0),
+    (7, 7),
+    ('abc', 1),
+    ([{}, {}], 2),
+    (([{}], 'token'), 1),
+    ({'name': 'x'}, 1),
+    ({'inserted': 2, 'upserted': 1, 'modified': 0, 'deleted': 0,
+      'errors': []}, 3),
+    (SimpleNamespace(deleted_count=1), 1),
+    (SimpleNamespace(inserted_id='x'), 1),
+])
+def test_measure(result, docs):
+    assert mt.measure(result)[0] == docs
+
+
+def test_measure_bytes_only_when_tracked():
+    with patch('data.metrics.TRACK_BYTES', False):
+        assert mt.measure([{'a': 1}]) == (1, 0)
+    with patch('data.metrics.TRACK_BYTES', True):
+        assert mt.measure([{'a': 1}])[1] == mt.doc_bytes([{'a': 1}]) > 0
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_needs_db_records_calls(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find_one.return_value = {'name': 'x'}
+    dbc.read_one('cities', {'name': 'x'})
+    assert mt.DB_SECONDS.count('read_one', 'cities') == 1
+    assert mt.DB_DOCS.value('read_one', 'cities') == 1
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_needs_db_records_errors(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find_one.side_effect = ConnectionFailure('down')
+    with patch('data.db_connect.mark_down') as mock_down:
+        with pytest.raises(ConnectionFailure):
+            dbc.read_one('cities', {})
+        mock_down.assert_called_once()
+    assert mt.DB_ERRORS.value('read_one', 'cities', 'ConnectionFailure') == 1
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_read_iter_recorded_when_done(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value.__iter__.return_value = [{'name': 'a'},
+                                                    {'name': 'b'}]
+    docs = dbc.read_iter('cities')
+    next(docs)
+    assert mt.DB_SECONDS.count('read_iter', 'cities') == 0
+    list(docs)
+    assert mt.DB_SECONDS.count('read_iter', 'cities') == 1
+    assert mt.DB_DOCS.value('read_iter', 'cities') == 2
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_read_iter_recorded_when_closed_early(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value.__iter__.return_value = [{'name': 'a'},
+                                                    {'name': 'b'}]
+    docs = dbc.read_iter('cities')
+    next(docs)
+    docs.close()  # e.g. a client disconnecting from an export
+    assert mt.DB_SECONDS.count('read_iter', 'cities') == 1
+    assert mt.DB_DOCS.value('read_iter', 'cities') == 1
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_read_iter_times_fetches_only(mock_client, mock_connect):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value.__iter__.return_value = [{'name': 'a'},
+                                                    {'name': 'b'}]
+    with patch('data.db_connect.metrics.record_db') as mock_record:
+        for _ in dbc.read_iter('cities'):
+            time.sleep(0.05)  # the caller's work
+        seconds = mock_record.call_args.args[2]
+    assert seconds < 0.05
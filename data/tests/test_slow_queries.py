@@ -0,0 +1,125 @@
+import inspect
+import logging
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import data.db_connect as dbc
+import data.slow_queries as sq
+
+
+@pytest.fixture(autouse=True)
+def clean_explains():
+    sq.explains.clear()
+    yield
+    sq.explains.clear()
+
+
+def join_explains():
+    for thread in threading.enumerate():
+        if thread.name == sq.EXPLAIN_THREAD:
+            thread.join()
+
+
+def test_redact_keeps_fields_and_operators():
+    filt = {'state_code': 'NY', 'population': {'$gt': 1000},
+            'name': {'$in': ['a', 'b', 'c']},
+            '$or': [{'a': 1}, {'b': 2}, {'a': 3}]}
+    assert sq.redact(filt) == {
+        'state_code': '?', 'population': {'$gt': '?'},
+        'name': {'$in': ['?']}, '$or': [{'a': '?'}, {'b': '?'}],
+    }
+
+
+def test_summarize():
+    explain = {
+        'queryPlanner': {'winningPlan': {'stage': 'FETCH',
+                                         'inputStage': {'stage': 'IXSCAN'}}},
+        'executionStats': {'nReturned': 2, 'totalKeysExamined': 2,
+                           'totalDocsExamined': 2, 'executionTimeMillis': 1},
+    }
+    summary = sq.summarize(explain)
+    assert summary['stages'] == ['FETCH', 'IXSCAN']
+    assert summary['totalDocsExamined'] == 2
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_fast_query_not_logged(mock_client, mock_connect, caplog):
+    with patch('data.slow_queries.THRESHOLD', 60.0), \
+            caplog.at_level(logging.WARNING, logger='data.slow_queries'):
+        dbc.read_one('cities', {'name': 'x'})
+    assert not caplog.records
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_slow_query_logged_and_explained_once(mock_client, mock_connect,
+                                              caplog):
+    mock_client[dbc.SE_DB]['cities'].find_one.return_value = {'name': 'x'}
+    command = mock_client[dbc.SE_DB].command
+    command.return_value = {'queryPlanner': {'winningPlan':
+                                             {'stage': 'COLLSCAN'}}}
+    with patch('data.slow_queries.THRESHOLD', 0.0), \
+            patch('data.slow_queries.EXPLAIN', True), \
+            caplog.at_level(logging.WARNING, logger='data.slow_queries'):
+        dbc.read_one('cities', {'name': 'Secret Town'})
+        dbc.read_one('cities', {'name': 'Other Town'})
+        join_explains()
+    text = caplog.text
+    assert 'Secret Town' not in text
+    assert 'cities.read_one' in text
+    assert '{"name": "?"}' in text
+    assert 'COLLSCAN' in text
+    command.assert_called_once_with(
+        'explain', {'find': 'cities', 'filter': {'name': 'Secret Town'}},
+        verbosity='executionStats',
+    )
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_slow_read_iter_logged_when_done(mock_client, mock_connect, caplog):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value.__iter__.return_value = [{'name': 'a'}]
+    with patch('data.slow_queries.THRESHOLD', 0.0), \
+            caplog.at_level(logging.WARNING, logger='data.slow_queries'):
+        assert list(dbc.read_iter('cities', {'state_code': 'NY'})) == [
+            {'name': 'a'}]
+    assert 'cities.read_iter' in caplog.text
+    assert '1 docs' in caplog.text
+
+
+def test_explain_failure_is_retried_later():
+    explain = MagicMock(side_effect=RuntimeError('no'))
+    with patch('data.slow_queries.THRESHOLD', 0.0), \
+            patch('data.slow_queries.EXPLAIN', True):
+        sq.check(inspect.signature(dbc.count), 'count', 'cities',
+                 ('cities', {'a': 1}), {}, 1.0, 3, explain).join()
+    assert not sq.explains
+    explain.assert_called_once_with(dbc.SE_DB, 'cities', 'filt', {'a': 1})
+
+
+@patch('data.db_connect.connect_db')
+@patch('data.db_connect.client')
+def test_slow_consumer_not_logged(mock_client, mock_connect, caplog):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value.__iter__.return_value = [{'name': 'a'}]
+    with patch('data.slow_queries.THRESHOLD', 0.05), \
+            caplog.at_level(logging.WARNING, logger='data.slow_queries'):
+        for _ in dbc.read_iter('cities', {'state_code': 'NY'}):
+            time.sleep(0.1)  # the caller's work, not the DB's
+    assert not caplog.records
+
+
+def test_explain_runs_off_the_calling_thread():
+    threads = []
+    explain = MagicMock(side_effect=lambda *args: threads.append(
+        threading.current_thread()) or {})
+    with patch('data.slow_queries.THRESHOLD', 0.0), \
+            patch('data.slow_queries.EXPLAIN', True):
+        sq.check(inspect.signature(dbc.count), 'count', 'cities',
+                 ('cities', {'a': 1}), {}, 1.0, 3, explain).join()
+    assert threads and threads[0] is not threading.current_thread()
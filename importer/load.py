@@ -0,0 +1,233 @@
+"""
+Bulk-load city or state records from CSV or NDJSON files into the DB.
+
+The file is read in chunks, so memory stays flat however big it is; each
+chunk is validated and prepared with the same rules as create() and
+written with one unordered bulk upsert, by a pool of worker processes.
+Records whose unique key (a city's id, a state's code and country) is
+already taken are counted as duplicates, noted in the errors and
+skipped. Cities are new records unless they come with an id (e.g. an
+export being re-imported): like create(), the importer accepts two
+cities of the same name in one state.
+
+The registered indexes are ensured before loading, so every upsert's
+key lookup is an index seek and concurrent workers can't both insert
+the same key.
+
+    python -m importer.load cities gazetteer.csv --workers 4
+
+Records go straight to the DB: running servers pick them up when their
+caches are next loaded.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from itertools import islice
+
+import data.db_connect as dbc
+import cities.queries as cqry
+import USstates.queries as sqry
+
+CITIES = 'cities'
+STATES = 'states'
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+FORMATS = {'.csv': CSV, '.ndjson': NDJSON, '.jsonl': NDJSON}
+
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+# Keys of the per-chunk and total reports:
+READ = 'read'
+WRITTEN = 'written'
+DUPLICATES = 'duplicates'
+INVALID = 'invalid'
+FAILED = 'failed'
+ERRORS = 'errors'
+SECONDS = 'seconds'
+
+# Only this many error messages are kept in a report.
+MAX_ERRORS = 20
+
+
+def _city_doc(rec: dict) -> dict:
+    doc = cqry.to_doc(cqry.prepare(rec))
+    if rec.get(cqry.ID):
+        doc[cqry.ID] = rec[cqry.ID]  # e.g. re-importing an export
+    return doc
+
+
+# dataset -> (collection, validate, prepare a record, key fields); the
+# key fields must have a unique index (see dbc.register_index).
+DATASETS = {
+    CITIES: (cqry.CITY_COLLECTION, cqry.validate, _city_doc, [cqry.ID]),
+    STATES: (sqry.STATE_COLLECTION, sqry.validate, dict,
+             [sqry.CODE, sqry.COUNTRY_CODE]),
+}
+
+
+def file_format(path: str) -> str:
+    """CSV or NDJSON, going by the file's extension."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(f'Unknown file type: {path!r}')
+    return FORMATS[ext]
+
+
+def _clean(rec: dict) -> dict:
+    # CSV has no nulls: drop empty cells and surplus (unnamed) columns.
+    return {k: v for k, v in rec.items() if k is not None and v != ''}
+
+
+def read_records(path: str, fmt: str = None):
+    """Lazily yield the records in `path`, one dict at a time."""
+    fmt = fmt or file_format(path)
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == CSV:
+            for rec in csv.DictReader(f):
+                yield _clean(rec)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def chunked(records, size: int):
+    """Group an iterable of records into lists of up to `size`."""
+    it = iter(records)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def new_report() -> dict:
+    return {READ: 0, WRITTEN: 0, DUPLICATES: 0, INVALID: 0, FAILED: 0,
+            ERRORS: []}
+
+
+def _note_error(report: dict, msg: str) -> None:
+    if len(report[ERRORS]) < MAX_ERRORS:
+        report[ERRORS].append(msg)
+
+
+def load_chunk(dataset: str, chunk: list) -> dict:
+    """
+    Validate and write one chunk of records; returns its report.
+    Bad records are counted and skipped, and don't stop the others.
+    """
+    collection, validate, prepare, key_fields = DATASETS[dataset]
+    report = new_report()
+    report[READ] = len(chunk)
+    docs = []
+    for rec in chunk:
+        try:
+            validate(rec)
+        except ValueError as err:
+            report[INVALID] += 1
+            _note_error(report, str(err))
+            continue
+        docs.append(prepare(rec))
+    if not docs:
+        return report
+    bulk = dbc.create_many_unique(collection, docs, key_fields,
+                                  ordered=False)
+    report[WRITTEN] = len(bulk[dbc.INSERTED_IDS])
+    report[DUPLICATES] = len(bulk[dbc.DUPLICATES])
+    for i in bulk[dbc.DUPLICATES]:
+        key = ', '.join(f'{fld}={docs[i].get(fld)!r}' for fld in key_fields)
+        _note_error(report, f'Duplicate key: {key}')
+    failed = dbc.failed_indexes(bulk)
+    report[FAILED] = len(failed)
+    for msg in failed.values():
+        _note_error(report, msg)
+    return report
+
+
+def _merge(total: dict, report: dict) -> None:
+    for key in (READ, WRITTEN, DUPLICATES, INVALID, FAILED):
+        total[key] += report[key]
+    for msg in report[ERRORS]:
+        _note_error(total, msg)
+
+
+def _init_worker() -> None:
+    # Each worker gets its own client (see dbc.connect_db); open it now.
+    dbc.prewarm()
+
+
+def _load_star(args) -> dict:
+    return load_chunk(*args)
+
+
+def _progress(total: dict, started: float) -> None:
+    elapsed = time.monotonic() - started
+    rate = total[READ] / elapsed if elapsed else 0
+    print(f'{total[READ]} read, {total[WRITTEN]} written, '
+          f'{total[DUPLICATES]} duplicates, '
+          f'{total[INVALID] + total[FAILED]} rejected '
+          f'({rate:,.0f} records/s)', file=sys.stderr)
+
+
+def load(dataset: str, path: str, workers: int = DEFAULT_WORKERS,
+         chunk_size: int = DEFAULT_CHUNK_SIZE, fmt: str = None,
+         progress: bool = True) -> dict:
+    """
+    Import every record in `path` into `dataset` (CITIES or STATES).
+    With `workers` <= 1 everything runs in this process.
+
+    Returns the totals, including the elapsed seconds.
+
+    Raises:
+        ValueError: on an unknown dataset or file type.
+    """
+    if dataset not in DATASETS:
+        raise ValueError(f'Unknown dataset: {dataset!r}')
+    fmt = fmt or file_format(path)
+    # Without them each upsert scans the collection for its key.
+    dbc.ensure_indexes()
+    tasks = ((dataset, chunk)
+             for chunk in chunked(read_records(path, fmt), chunk_size))
+    total = new_report()
+    started = time.monotonic()
+    if workers <= 1:
+        reports = map(_load_star, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker)
+        reports = pool.imap_unordered(_load_star, tasks)
+    try:
+        for report in reports:
+            _merge(total, report)
+            if progress:
+                _progress(total, started)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    total[SECONDS] = round(time.monotonic() - started, 3)
+    return total
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('dataset', choices=sorted(DATASETS))
+    parser.add_argument('path')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--format', choices=[CSV, NDJSON], dest='fmt')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+    os.environ.setdefault('MONGO_PROFILE', dbc.PROFILE_BATCH)
+    total = load(args.dataset, args.path, workers=args.workers,
+                 chunk_size=args.chunk_size, fmt=args.fmt,
+                 progress=not args.quiet)
+    print(json.dumps(total, indent=2))
+    return 0 if not total[INVALID] and not total[FAILED] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
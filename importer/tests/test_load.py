@@ -0,0 +1,101 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+import cities.queries as cqry
+import data.db_connect as dbc
+import data.memory_backend as mb
+import importer.load as ld
+
+
+def fake_create_many_unique(collection, docs, key_fields, **kwargs):
+    # the first doc of every batch is already in the DB
+    return {dbc.INSERTED_IDS: {i: f'oid{i}' for i in range(1, len(docs))},
+            dbc.DUPLICATES: [0] if docs else [],
+            dbc.ERRORS: [], dbc.SKIPPED: []}
+
+
+@pytest.fixture
+def cities_csv(tmp_path):
+    path = tmp_path / 'cities.csv'
+    path.write_text('name,state_code\n'
+                    'Albany,ny\n'
+                    'Trenton,NJ\n'
+                    ',NJ\n'
+                    'Dover,DE\n')
+    return str(path)
+
+
+def test_file_format():
+    assert ld.file_format('a.CSV') == ld.CSV
+    assert ld.file_format('a.jsonl') == ld.NDJSON
+    with pytest.raises(ValueError):
+        ld.file_format('a.xml')
+
+
+def test_read_records_csv(cities_csv):
+    recs = list(ld.read_records(cities_csv))
+    assert recs[0] == {'name': 'Albany', 'state_code': 'ny'}
+    assert recs[2] == {'state_code': 'NJ'}
+
+
+def test_read_records_ndjson(tmp_path):
+    path = tmp_path / 'states.ndjson'
+    path.write_text(json.dumps({'code': 'NY'}) + '\n\n'
+                    + json.dumps({'code': 'NJ'}) + '\n')
+    assert [r['code'] for r in ld.read_records(str(path))] == ['NY', 'NJ']
+
+
+def test_chunked():
+    assert list(ld.chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+@patch('data.db_connect.ensure_indexes')
+@patch('data.db_connect.create_many_unique',
+       side_effect=fake_create_many_unique)
+def test_load_cities(mock_write, mock_ensure, cities_csv):
+    total = ld.load(ld.CITIES, cities_csv, workers=1, chunk_size=2,
+                    progress=False)
+    assert total[ld.READ] == 4
+    assert total[ld.INVALID] == 1
+    assert total[ld.DUPLICATES] == 2
+    assert total[ld.WRITTEN] == 1
+    assert len(total[ld.ERRORS]) == 3  # one invalid, two duplicates
+    mock_ensure.assert_called_once()
+    assert mock_write.call_count == 2
+    docs = mock_write.call_args_list[0].args[1]
+    assert docs[0]['state_code'] == 'NY'
+    assert all(doc.get('id') for doc in docs)
+    assert docs[0]['name_key'] == 'albany'
+    assert mock_write.call_args_list[0].args[2] == ['id']
+    assert mock_write.call_args_list[0].kwargs['ordered'] is False
+
+
+def test_load_cities_skips_existing(cities_csv, tmp_path):
+    mb.reset()
+    with patch('data.db_connect.client', mb.MemoryClient()), \
+            patch('data.db_connect.connect_db'), \
+            patch('data.db_connect.ensure_indexes'), \
+            patch('cities.queries._can_connect', return_value=True):
+        cqry.create_many([{'name': 'Dover', 'state_code': 'de'}])
+        # same-name cities in one state are separate records
+        total = ld.load(ld.CITIES, cities_csv, workers=1, progress=False)
+        assert total[ld.WRITTEN] == 3
+        assert total[ld.DUPLICATES] == 0
+        assert cqry.count_in_state('DE') == 2
+        # re-importing an export skips the ids already stored
+        path = tmp_path / 'export.ndjson'
+        path.write_text(''.join(json.dumps(rec) + '\n'
+                                for rec in cqry.export()))
+        again = ld.load(ld.CITIES, str(path), workers=1, progress=False)
+        assert again[ld.WRITTEN] == 0
+        assert again[ld.DUPLICATES] == 4
+        assert again[ld.ERRORS][0].startswith('Duplicate key: id=')
+    cqry.clear_cache()
+    mb.reset()
+
+
+def test_load_unknown_dataset(cities_csv):
+    with pytest.raises(ValueError):
+        ld.load('towns', cities_csv, workers=1)
@@ -0,0 +1,95 @@
+"""
+Response compression, negotiated with the client's Accept-Encoding.
+
+gzip is always available; brotli and zstd are used when their packages
+are installed.
+"""
+import gzip
+import os
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the environment
+    zstandard = None
+
+GZIP = 'gzip'
+BROTLI = 'br'
+ZSTD = 'zstd'
+
+GZIP_LEVEL = 6
+
+# Bodies smaller than this (in bytes) aren't worth compressing.
+MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+
+COMPRESSIBLE = ('application/json', 'text/')
+
+# Our preference when the client rates several encodings equally.
+encoders = {}
+if brotli is not None:
+    encoders[BROTLI] = brotli.compress
+if zstandard is not None:
+    encoders[ZSTD] = lambda body: zstandard.ZstdCompressor().compress(body)
+encoders[GZIP] = lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def negotiate(size: int):
+    """
+    The encoding to use for a body of `size` bytes in the current
+    request, or None to send it as is.
+    """
+    if size < MIN_SIZE:
+        return None
+    return request.accept_encodings.best_match(list(encoders))
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    return encoders[encoding](body)
+
+
+def variant_tag(etag: str, encoding) -> str:
+    """The ETag of the `encoding` representation of `etag`."""
+    return f'{etag}-{encoding}' if encoding else etag
+
+
+def holds_any(etag: str) -> bool:
+    """Does the client hold any representation of `etag`?"""
+    tags = request.if_none_match
+    return any(tags.contains(variant_tag(etag, enc))
+               for enc in [None, *encoders])
+
+
+def _compressible(resp) -> bool:
+    return (resp.status_code == 200
+            and not resp.direct_passthrough
+            and not resp.is_streamed
+            and 'Content-Encoding' not in resp.headers
+            and (resp.mimetype or '').startswith(COMPRESSIBLE))
+
+
+def compress_response(resp):
+    """
+    after_request hook: compress whatever a view didn't already encode
+    itself (see the snapshots in server.serialize).
+    """
+    if not _compressible(resp):
+        return resp
+    body = resp.get_data()
+    if len(body) < MIN_SIZE:
+        return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = negotiate(len(body))
+    if encoding is None:
+        return resp
+    resp.set_data(compress(body, encoding))
+    resp.headers['Content-Encoding'] = encoding
+    etag, weak = resp.get_etag()
+    if etag:
+        resp.set_etag(variant_tag(etag, encoding), weak=weak)
+    return resp
@@ -4,14 +4,19 @@ The endpoint called `endpoints` will return all available endpoints.
 """
 
 #test: trigger CI run
+import hashlib
+import json
+import time
 from http import HTTPStatus
+from uuid import uuid4
 
-from flask import Flask, request
+from flask import Flask, Response, g, request, stream_with_context
 # from flask_restx import Resource, Api  # , fields  # Namespace
 from flask_restx import Resource, Api, fields  # Namespace
 from flask_cors import CORS
 
-from data.db_connect import connect_db
+import data.db_connect as dbc
+from data import metrics
 
 from data.db_connect import ensure_indexes
 
@@ -19,16 +24,51 @@ from data.db_connect import ensure_indexes
 
 import cities.queries as cqry
 import USstates.queries as sqry
+from server import compress, serialize
 
 app = Flask(__name__)
 CORS(app)
 api = Api(app)
+serialize.install(app, api)
+
+
+@app.before_request
+def _start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def _observe_request(resp):
+    # Registered before compress_response, so it runs after it and the
+    # time includes compression.
+    started = g.pop('started', None)
+    if started is not None:
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - started,
+                                     request.method, rule, resp.status_code)
+    return resp
+
+
+app.after_request(compress.compress_response)
 ensure_indexes()
 
 ERROR = 'Error'
 MESSAGE = 'Message'
 NUM_RECS = 'Number of Records'
 READ = 'read'
+BULK = 'bulk'
+EXPORT = 'export'
+SEARCH = 'search'
+NEAR = 'near'
+RESULTS = 'Results'
+NUM_CREATED = 'Number Created'
+NUM_FAILED = 'Number Failed'
+NUM_CITIES = 'Number of Cities'
+STATS = 'stats'
+BY_STATE = 'by_state'
+COUNT = 'count'
+CITY_COUNTS_RESP = 'City counts'
+STATE_CODE = 'state_code'
 
 ENDPOINT_EP = '/endpoints'
 ENDPOINT_RESP = 'Available endpoints'
@@ -41,9 +81,23 @@ HELLO_RESP = 'hello'
 
 CITIES_EPS = '/cities'
 CITY_RESP = 'Cities'
+TOO_MANY_CITIES = (f'Too many cities to send at once; page through them '
+                   f'with ?limit= or stream them from {CITIES_EPS}/{EXPORT}')
 
 HEALTH_DB_EP = "/health/db"
 
+METRICS_EP = '/metrics'
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+NEXT_HEADER = 'X-Next-Cursor'
+MAX_SEARCH_LIMIT = 100
+MAX_NEAR_K = 100
+
+# Each worker has its own caches and version counters, so ETags carry a
+# per-process epoch: a tag from one worker never matches in another.
+ETAG_EPOCH = uuid4().hex[:8]
+
 # Swagger / RESTX model describing the JSON body for a city
 city_model = api.model(
     "City",
@@ -53,34 +107,130 @@ city_model = api.model(
     },
 )
 
+
+def _view(*args) -> str:
+    """
+    What this request renders: its route plus `args`, the (normalized)
+    arguments its body depends on. Other query-string parameters don't
+    make a new view, so they can't fill the snapshot cache.
+    """
+    rule = request.url_rule.rule if request.url_rule else request.path
+    return json.dumps([rule, *args])
+
+
+def _etag(name: str, version: int, view: str) -> str:
+    """
+    A strong ETag for cached collection `name` at `version`, also keyed
+    on the view (see _view()) since several endpoints render the same
+    collection differently.
+    """
+    view_hash = hashlib.sha1(view.encode()).hexdigest()[:12]
+    return f'{ETAG_EPOCH}-{name}-{version}-{view_hash}'
+
+
+def _conditional(name: str, version: int, view: str, make_body):
+    """
+    Answer 304 Not Modified if the client already holds the ETag for
+    `view` of collection `name` at `version` (in any encoding);
+    otherwise send the body, which is only built (with make_body()),
+    encoded and compressed once per ETag. Either way, send the ETag.
+    """
+    etag = _etag(name, version, view)
+    if compress.holds_any(etag):
+        return '', HTTPStatus.NOT_MODIFIED, {'ETag': f'"{etag}"'}
+    body = serialize.snapshot(view, etag, make_body)
+    headers = {}
+    if len(body) >= compress.MIN_SIZE:
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = compress.negotiate(len(body))
+        if encoding:
+            body = serialize.snapshot(view, etag, make_body, encoding)
+            headers['Content-Encoding'] = encoding
+            etag = compress.variant_tag(etag, encoding)
+    headers['ETag'] = f'"{etag}"'
+    return Response(body, status=HTTPStatus.OK, headers=headers,
+                    mimetype=serialize.JSON_MIME)
+
+
+def _export(export, **filters):
+    """
+    Stream what export(**filters) yields as NDJSON, one record per line,
+    straight from the DB cursor. `?fields=a,b` limits the fields sent.
+    """
+    fields = request.args.get('fields')
+    if fields:
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+    try:
+        docs = export(fields=fields or None, **filters)
+    except ConnectionError as e:
+        return {ERROR: str(e)}, HTTPStatus.SERVICE_UNAVAILABLE
+    return Response(stream_with_context(serialize.ndjson_lines(docs)),
+                    mimetype=serialize.NDJSON_MIME)
+
+
+def _bulk_create(create_many):
+    """
+    Shared body of the bulk POST endpoints: feed a JSON array of records
+    to `create_many` and report a result per record.
+    `?ordered=false` keeps going past failed records.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        return {ERROR: 'Expected a JSON array of records'}, \
+            HTTPStatus.BAD_REQUEST
+    ordered = request.args.get('ordered', 'true').lower() != 'false'
+    try:
+        results = create_many(data, ordered=ordered)
+    except ConnectionError as e:
+        return {ERROR: str(e)}, HTTPStatus.INTERNAL_SERVER_ERROR
+
+    num_failed = sum(1 for res in results if dbc.ERROR in res)
+    status = HTTPStatus.MULTI_STATUS if num_failed else HTTPStatus.CREATED
+    return {
+        RESULTS: results,
+        NUM_CREATED: len(results) - num_failed,
+        NUM_FAILED: num_failed,
+    }, status
+
+
 @api.route(f"{STATES_EPS}/<string:state_code>")
 class StateDetail(Resource):
     """
     Get a single state by its postal code, e.g. /state/NY.
     """
     def get(self, state_code: str):
+        """
+        `?country=` picks between states sharing a postal code.
+        """
         try:
-            states_data = sqry.read()
+            rec = sqry.read_one(state_code, request.args.get("country"))
         except ConnectionError as e:
             return {ERROR: str(e)}, HTTPStatus.INTERNAL_SERVER_ERROR
 
-        code = state_code.upper()
-        rec = None
-
-        if isinstance(states_data, dict):
-            rec = states_data.get(code)
-        else:
-            for s in states_data:
-                if str(s.get("code", "")).upper() == code:
-                    rec = s
-                    break
-
         if rec is None:
+            code = state_code.upper()
             return {ERROR: f"State not found: {code}"}, HTTPStatus.NOT_FOUND
 
         return rec, HTTPStatus.OK
 
 
+@api.route(f"{STATES_EPS}/<string:state_code>/{COUNT}")
+class StateCityCount(Resource):
+    """
+    How many cities a state has.
+    """
+    def get(self, state_code: str):
+        """
+        Counted by the DB (or the city cache's state index) and reused
+        until the cities change.
+        """
+        try:
+            num = cqry.count_in_state(state_code)
+        except ConnectionError as e:
+            return {ERROR: str(e)}, HTTPStatus.SERVICE_UNAVAILABLE
+        return {STATE_CODE: state_code.upper(), NUM_CITIES: num}, HTTPStatus.OK
+
+
 @api.route(f"{STATES_EPS}/{READ}")
 class States(Resource):
     """
@@ -89,6 +239,7 @@ class States(Resource):
     def get(self):
         """
         Return all states and a count of records.
+        Sends an ETag and answers If-None-Match with 304 when unchanged.
         """
         try:
             # Assuming sqry.read() returns a dict of states or a list
@@ -98,10 +249,36 @@ class States(Resource):
         except ConnectionError as e:
             return {ERROR: str(e)}, HTTPStatus.INTERNAL_SERVER_ERROR
 
-        return {
-            STATE_RESP: states_data,
-            NUM_RECS: num_recs,
-        }, HTTPStatus.OK
+        return _conditional(
+            sqry.STATE_COLLECTION, sqry.cache_version, _view(),
+            lambda: {STATE_RESP: states_data, NUM_RECS: num_recs},
+        )
+
+
+@api.route(f"{STATES_EPS}/{EXPORT}")
+class StatesExport(Resource):
+    """
+    Export states as newline-delimited JSON.
+    """
+    def get(self):
+        """
+        Stream every state (or those in `?country=`) from the DB.
+        """
+        return _export(sqry.export,
+                       country_code=request.args.get('country'))
+
+
+@api.route(f"{STATES_EPS}/{BULK}")
+class StatesBulk(Resource):
+    """
+    Create many states in one request.
+    """
+    def post(self):
+        """
+        Expects a JSON array of state objects.
+        """
+        return _bulk_create(sqry.create_many)
+
 
 @api.route(f'{CITIES_EPS}/{READ}')
 class Cities(Resource):
@@ -112,17 +289,46 @@ class Cities(Resource):
     def get(self):
         """
         Return all cities and a count of records.
+        Sends an ETag and answers If-None-Match with 304 when unchanged.
         """
         try:
             cities = cqry.read()
             num_recs = len(cities)
         except ConnectionError as e:
             return {ERROR: str(e)}, HTTPStatus.INTERNAL_SERVER_ERROR
-        
-        return {
-            CITY_RESP: cities,
-            NUM_RECS: num_recs,
-        }, HTTPStatus.OK
+        except ValueError:
+            return {ERROR: TOO_MANY_CITIES}, HTTPStatus.BAD_REQUEST
+
+        def body():
+            return {CITY_RESP: cities, NUM_RECS: num_recs}
+
+        return _conditional(
+            cqry.CITY_COLLECTION, cqry.cache_version, _view(), body,
+        )
+
+
+def _cities_page(limit_str, after, state_code):
+    """
+    Serve one keyset-paginated page of GET /cities.
+    """
+    try:
+        limit = min(int(limit_str), MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        limit = DEFAULT_PAGE_SIZE
+    if limit < 1:
+        limit = DEFAULT_PAGE_SIZE
+    try:
+        cities_list, next_token = cqry.read_page(
+            limit, after=after, state_code=state_code,
+        )
+    except ValueError as e:
+        return {ERROR: str(e)}, HTTPStatus.BAD_REQUEST
+    except ConnectionError:
+        return [], HTTPStatus.OK
+
+    headers = {NEXT_HEADER: next_token} if next_token else {}
+    return cities_list, HTTPStatus.OK, headers
+
 
 @api.route(CITIES_EPS)
 class CitiesList(Resource):
@@ -132,31 +338,34 @@ class CitiesList(Resource):
 
     def get(self):
         """
-        Return a list of all cities.
+        Return a list of all cities, with an ETag as /cities/read does.
+
+        With `?limit=` and/or `?after=`, return one page read straight from
+        the DB instead; the token for the next page comes back in the
+        X-Next-Cursor header (absent on the last page).
         """
         state_code = request.args.get("state_code")
         limit_str = request.args.get("limit")
+        after = request.args.get("after")
+        if limit_str or after:
+            return _cities_page(limit_str, after, state_code)
         try:
-            cities_dict = cqry.read()
+            if state_code:
+                cities = cqry.read_by_state(state_code)
+            else:
+                cities = cqry.read().values()
         except ConnectionError:
             return [], HTTPStatus.OK
+        except ValueError:
+            return {ERROR: TOO_MANY_CITIES}, HTTPStatus.BAD_REQUEST
 
-        cities_list = list(cities_dict.values())
-        if state_code:
-            code_upper = state_code.upper()
-            cities_list = [
-                c for c in cities_list
-                if c.get("state_code", "").upper() == code_upper
-            ]
-        if limit_str:
-            try:
-                limit = int(limit_str)
-                if limit > 0:
-                    cities_list = cities_list[:limit]
-            except ValueError:
-                pass
-
-        return cities_list, HTTPStatus.OK
+        if not cqry.cache_loaded:
+            return list(cities), HTTPStatus.OK
+        return _conditional(
+            cqry.CITY_COLLECTION, cqry.cache_version,
+            _view((state_code or '').upper()),
+            lambda: list(cities),
+        )
 
     def post(self):
         """
@@ -173,6 +382,109 @@ class CitiesList(Resource):
 
         return rec, HTTPStatus.CREATED
 
+
+@api.route(f"{CITIES_EPS}/{EXPORT}")
+class CitiesExport(Resource):
+    """
+    Export cities as newline-delimited JSON.
+    """
+    def get(self):
+        """
+        Stream every city from the DB, optionally filtered by
+        `?state_code=` and `?name=`.
+        """
+        return _export(cqry.export,
+                       state_code=request.args.get('state_code'),
+                       name=request.args.get('name'))
+
+
+@api.route(f"{CITIES_EPS}/{SEARCH}")
+class CitiesSearch(Resource):
+    """
+    Type-ahead search over city names.
+    """
+    def get(self):
+        """
+        Cities whose name starts with `?prefix=` (ignoring case), in name
+        order; `?state_code=` narrows to one state and `?limit=` (default
+        10, at most 100) caps how many come back.
+        With `?fuzzy=true`, return the cities whose names are closest to
+        `?q=` (or `?prefix=`) instead, so misspellings still match.
+        """
+        fuzzy = request.args.get('fuzzy', '').lower() in ('1', 'true', 'yes')
+        text = request.args.get('q') or request.args.get('prefix', '')
+        try:
+            limit = int(request.args.get('limit', cqry.DEFAULT_SEARCH_LIMIT))
+        except ValueError:
+            limit = cqry.DEFAULT_SEARCH_LIMIT
+        limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+        try:
+            cities = cqry.search(text,
+                                 state_code=request.args.get('state_code'),
+                                 limit=limit, fuzzy=fuzzy)
+        except ValueError as e:
+            return {ERROR: str(e)}, HTTPStatus.BAD_REQUEST
+        except ConnectionError as e:
+            return {ERROR: str(e)}, HTTPStatus.SERVICE_UNAVAILABLE
+        return cities, HTTPStatus.OK
+
+
+@api.route(f"{CITIES_EPS}/{NEAR}")
+class CitiesNear(Resource):
+    """
+    Nearest-city lookups.
+    """
+    def get(self):
+        """
+        The `?k=` (default 10, at most 100) cities nearest `?lat=`/`?lon=`,
+        nearest first, each with its distance in km; `?radius=` (km)
+        leaves out those further away.
+        """
+        args = request.args
+        try:
+            lat = float(args['lat'])
+            lon = float(args['lon'])
+            k = min(int(args.get('k', cqry.DEFAULT_NEAR_K)), MAX_NEAR_K)
+            radius = float(args['radius']) if 'radius' in args else None
+            cities = cqry.near(lat, lon, k=k, radius_km=radius)
+        except (KeyError, ValueError) as e:
+            return {ERROR: f'Bad query: {e}'}, HTTPStatus.BAD_REQUEST
+        except ConnectionError as e:
+            return {ERROR: str(e)}, HTTPStatus.SERVICE_UNAVAILABLE
+        return cities, HTTPStatus.OK
+
+
+@api.route(f"{CITIES_EPS}/{STATS}/{BY_STATE}")
+class CitiesByState(Resource):
+    """
+    Per-state city counts.
+    """
+    def get(self):
+        """
+        Return {state code: number of cities}, computed in the DB (or
+        from the city cache's state index) and reused until the cities
+        change.
+        """
+        try:
+            counts = cqry.count_by_state()
+        except ConnectionError as e:
+            return {ERROR: str(e)}, HTTPStatus.SERVICE_UNAVAILABLE
+        return {CITY_COUNTS_RESP: counts, NUM_RECS: len(counts)}, HTTPStatus.OK
+
+
+@api.route(f"{CITIES_EPS}/{BULK}")
+class CitiesBulk(Resource):
+    """
+    Create many cities in one request.
+    """
+    def post(self):
+        """
+        Expects a JSON array of city objects:
+        [{ "name": "...", "state_code": "..." }, ...]
+        """
+        return _bulk_create(cqry.create_many)
+
+
 @api.route(f"{CITIES_EPS}/<string:city_id>")
 class CityDetail(Resource):
     """
@@ -228,12 +540,30 @@ class HealthDB(Resource):
     Endpoint to verify MongoDB connectivity.
     """
     def get(self):
-        try:
-            client = connect_db()
-            client.admin.command("ping")
+        """
+        Answered from the connectivity tracker in data.db_connect, which
+        only pings Mongo when its last check has gone stale.
+        """
+        if dbc.is_available():
             return {"ok": True, "message": "Mongo reachable"}
-        except Exception as e:
-            return {"ok": False, "error": str(e)}, HTTPStatus.INTERNAL_SERVER_ERROR
+        return {
+            "ok": False,
+            "error": f"Mongo unreachable (circuit {dbc.health['state']})",
+        }, HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+@api.route(METRICS_EP)
+class Metrics(Resource):
+    """
+    This process's DB and request metrics, for Prometheus to scrape.
+    """
+    def get(self):
+        """
+        Latency histograms, error and document counts per DB operation
+        and collection, and request latency per endpoint.
+        """
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 
 @api.route(ENDPOINT_EP)
 class Endpoints(Resource):
@@ -0,0 +1,26 @@
+"""
+gunicorn settings for the API:
+
+    PYTHONPATH=. gunicorn -c server/gunicorn.conf.py server.endpoints:app
+
+The app is imported once in the master (preload_app) and forked into the
+workers. A client made before the fork can't be shared, so each worker
+builds its own (see data.db_connect); post_worker_init connects it as
+the worker starts, instead of on that worker's first request.
+"""
+import os
+
+import data.db_connect as dbc
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+preload_app = True
+
+# many pre-forked workers: small pools, short timeouts
+os.environ.setdefault("MONGO_PROFILE", dbc.PROFILE_WEB)
+
+
+def post_worker_init(worker):
+    """Connect this worker's DB client before it takes requests."""
+    if not dbc.prewarm():
+        worker.log.warning("DB not reachable at worker start")
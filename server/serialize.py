@@ -0,0 +1,100 @@
+"""
+Fast JSON encoding for our responses, and cached pre-encoded bodies for
+the big collection reads.
+
+orjson is optional: without it we fall back to the stdlib json module.
+"""
+import json
+import os
+
+from flask import make_response
+from flask.json.provider import DefaultJSONProvider
+
+from data.cache import BoundedCache
+from server import compress
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+JSON_MIME = 'application/json'
+NDJSON_MIME = 'application/x-ndjson'
+
+# How many encoded bodies (one per view) to keep, and how many bytes of
+# them in all, counting every encoding.
+MAX_SNAPSHOTS = 256
+MAX_SNAPSHOT_BYTES = int(os.getenv('SNAPSHOT_MAX_BYTES', 64 * 1024 * 1024))
+
+
+def _snapshot_size(cached) -> int:
+    """Bytes held by a snapshots entry: all its encoded bodies."""
+    return sum(len(body) for body in cached[1].values())
+
+
+# view -> (etag, {encoding: body}); see snapshot().
+snapshots = BoundedCache(max_entries=MAX_SNAPSHOTS,
+                         max_bytes=MAX_SNAPSHOT_BYTES,
+                         sizeof=_snapshot_size)
+
+
+def dumps(data) -> bytes:
+    """
+    Encode `data` as JSON bytes, with orjson when it is installed.
+    Anything JSON can't represent natively (e.g. an ObjectId) becomes
+    its string form.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=str,
+                            option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=str).encode()
+
+
+def ndjson_lines(docs):
+    """Encode `docs` lazily as newline-delimited JSON, one per line."""
+    for doc in docs:
+        yield dumps(doc) + b'\n'
+
+
+class OrJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that encodes with orjson; decoding stays with
+    the default provider.
+    """
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=str,
+                            option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def output_json(data, code, headers=None):
+    """flask-restx representation for application/json using dumps()."""
+    resp = make_response(dumps(data), code)
+    resp.headers.extend(headers or {})
+    resp.mimetype = JSON_MIME
+    return resp
+
+
+def snapshot(view: str, etag: str, build, encoding=None) -> bytes:
+    """
+    The encoded body for `view` at `etag`, compressed with `encoding` if
+    given. It is encoded (from build()) and compressed only the first
+    time that version is asked for; later requests reuse the bytes until
+    a write moves the etag on.
+    """
+    cached = snapshots.get(view)
+    if cached is None or cached[0] != etag:
+        cached = (etag, {None: dumps(build())})
+        snapshots[view] = cached
+    variants = cached[1]
+    if encoding not in variants:
+        variants[encoding] = compress.compress(variants[None], encoding)
+        snapshots[view] = cached  # re-measured with the new encoding
+    return variants[encoding]
+
+
+def install(app, api) -> None:
+    """Use orjson for the app and the API, if it is available."""
+    if orjson is None:
+        return
+    app.json = OrJSONProvider(app)
+    api.representation(JSON_MIME)(output_json)
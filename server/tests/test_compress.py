@@ -0,0 +1,42 @@
+import gzip
+
+from flask import Flask
+
+import server.compress as cmp
+
+app = Flask(__name__)
+app.after_request(cmp.compress_response)
+BIG = 'x' * (cmp.MIN_SIZE + 1)
+
+
+@app.route('/big')
+def big():
+    return {'data': BIG}, 200, {'ETag': '"v1"'}
+
+
+@app.route('/stream')
+def stream():
+    return app.response_class((c for c in [BIG]), mimetype='text/plain')
+
+
+TEST_CLIENT = app.test_client()
+
+
+def test_gzip_when_accepted():
+    resp = TEST_CLIENT.get('/big', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == cmp.GZIP
+    assert resp.headers['ETag'] == f'"v1-{cmp.GZIP}"'
+    assert BIG.encode() in gzip.decompress(resp.data)
+
+
+def test_identity_when_not_accepted():
+    resp = TEST_CLIENT.get('/big', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in resp.headers
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    assert resp.get_json() == {'data': BIG}
+
+
+def test_streamed_left_alone():
+    resp = TEST_CLIENT.get('/stream', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == BIG.encode()
@@ -3,15 +3,19 @@ from http.client import (
     FORBIDDEN,
     NOT_ACCEPTABLE,
     NOT_FOUND,
+    NOT_MODIFIED,
     OK,
     SERVICE_UNAVAILABLE,
 )
 
+import gzip
+import json
 from unittest.mock import patch
 
 import pytest
 
 import server.endpoints as ep
+import server.serialize as ser
 
 TEST_CLIENT = ep.app.test_client()
 
@@ -20,3 +24,296 @@ def test_hello():
     resp = TEST_CLIENT.get(ep.HELLO_EP)
     resp_json = resp.get_json()
     assert ep.HELLO_RESP in resp_json
+
+
+@patch('cities.queries.create_many',
+       return_value=[{'index': 0, 'id': 'abc'},
+                     {'index': 1, 'error': 'Missing city name'}])
+def test_cities_bulk_partial_failure(mock_create_many):
+    resp = TEST_CLIENT.post(f'{ep.CITIES_EPS}/{ep.BULK}?ordered=false',
+                            json=[{'name': 'A', 'state_code': 'ZZ'}, {}])
+    assert resp.status_code == 207
+    resp_json = resp.get_json()
+    assert resp_json[ep.NUM_CREATED] == 1
+    assert resp_json[ep.NUM_FAILED] == 1
+    assert mock_create_many.call_args.kwargs['ordered'] is False
+
+
+@patch('data.db_connect.create_many', side_effect=RuntimeError('down'))
+def test_cities_bulk_db_failure_not_created(mock_create_many):
+    with patch.dict('cities.queries.city_cache', {}, clear=True):
+        resp = TEST_CLIENT.post(f'{ep.CITIES_EPS}/{ep.BULK}',
+                                json=[{'name': 'A', 'state_code': 'ZZ'}])
+    assert resp.status_code == 207
+    assert resp.get_json()[ep.NUM_CREATED] == 0
+
+
+@patch('USstates.queries.create_many',
+       return_value=[{'index': 0, 'id': 'abc'}])
+def test_states_bulk(mock_create_many):
+    resp = TEST_CLIENT.post(f'{ep.STATES_EPS}/{ep.BULK}',
+                            json=[{'name': 'A', 'code': 'ZZ',
+                                   'country_code': 'USA'}])
+    assert resp.status_code == 201
+    assert resp.get_json()[ep.RESULTS] == [{'index': 0, 'id': 'abc'}]
+
+
+def test_bulk_rejects_non_array():
+    resp = TEST_CLIENT.post(f'{ep.CITIES_EPS}/{ep.BULK}', json={'a': 1})
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('cities.queries.read_page',
+       return_value=([{'id': '1', 'name': 'A', 'state_code': 'NY'}], 'tok'))
+def test_cities_page(mock_read_page):
+    resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}?limit=1&after=prev')
+    assert resp.status_code == OK
+    assert resp.headers[ep.NEXT_HEADER] == 'tok'
+    assert len(resp.get_json()) == 1
+    mock_read_page.assert_called_once_with(1, after='prev', state_code=None)
+
+
+@patch('cities.queries.read_page', side_effect=ValueError('Bad page token'))
+def test_cities_page_bad_token(mock_read_page):
+    resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}?after=junk')
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('cities.queries.read_by_state',
+       return_value=[{'id': '1', 'name': 'Albany', 'state_code': 'NY'}])
+def test_cities_by_state(mock_read_by_state):
+    resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}?state_code=ny')
+    assert resp.status_code == OK
+    assert resp.get_json()[0]['name'] == 'Albany'
+    mock_read_by_state.assert_called_once_with('ny')
+
+
+@patch('data.db_connect.is_available', return_value=True)
+def test_health_db(mock_available):
+    resp = TEST_CLIENT.get(ep.HEALTH_DB_EP)
+    assert resp.status_code == OK
+    assert resp.get_json()['ok']
+
+
+@patch('data.db_connect.is_available', return_value=False)
+def test_health_db_down(mock_available):
+    resp = TEST_CLIENT.get(ep.HEALTH_DB_EP)
+    assert resp.status_code == 500
+    assert not resp.get_json()['ok']
+
+
+@patch('USstates.queries.read_one',
+       return_value={'name': 'New York', 'code': 'NY', 'country_code': 'USA'})
+def test_state_detail(mock_read_one):
+    resp = TEST_CLIENT.get(f'{ep.STATES_EPS}/ny?country=USA')
+    assert resp.status_code == OK
+    assert resp.get_json()['name'] == 'New York'
+    mock_read_one.assert_called_once_with('ny', 'USA')
+
+
+@patch('USstates.queries.read_one', return_value=None)
+def test_state_detail_not_found(mock_read_one):
+    resp = TEST_CLIENT.get(f'{ep.STATES_EPS}/zz')
+    assert resp.status_code == NOT_FOUND
+
+
+@patch('USstates.queries.read',
+       return_value=[{'name': 'New York', 'code': 'NY'}])
+def test_states_etag_not_modified(mock_read):
+    resp = TEST_CLIENT.get(f'{ep.STATES_EPS}/{ep.READ}')
+    assert resp.status_code == OK
+    etag = resp.headers['ETag']
+    resp2 = TEST_CLIENT.get(f'{ep.STATES_EPS}/{ep.READ}',
+                            headers={'If-None-Match': etag})
+    assert resp2.status_code == NOT_MODIFIED
+    assert resp2.data == b''
+
+
+def test_cities_snapshot_ignores_unrelated_args():
+    cities = {'1': {'id': '1', 'name': 'Albany', 'state_code': 'NY'}}
+    with patch('cities.queries.read', return_value=cities), \
+            patch('cities.queries.cache_loaded', True), \
+            patch('cities.queries.cache_version', 7), \
+            patch.dict('server.serialize.snapshots', {}, clear=True):
+        resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}')
+        for junk in range(3):
+            resp2 = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}?x={junk}')
+            assert resp2.headers['ETag'] == resp.headers['ETag']
+        assert len(ser.snapshots) == 1
+
+
+def test_cities_etag_changes_with_version():
+    cities = {'1': {'id': '1', 'name': 'Albany', 'state_code': 'NY'}}
+    with patch('cities.queries.read', return_value=cities), \
+            patch('cities.queries.cache_loaded', True), \
+            patch('cities.queries.cache_version', 7):
+        resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}')
+        etag = resp.headers['ETag']
+        resp2 = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}',
+                                headers={'If-None-Match': etag})
+        assert resp2.status_code == NOT_MODIFIED
+        # a different query string is a different representation
+        resp3 = TEST_CLIENT.get(f'{ep.CITIES_EPS}',
+                                headers={'If-None-Match': etag})
+        assert resp3.status_code == OK
+    with patch('cities.queries.read', return_value=cities), \
+            patch('cities.queries.cache_loaded', True), \
+            patch('cities.queries.cache_version', 8):
+        resp4 = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}',
+                                headers={'If-None-Match': etag})
+        assert resp4.status_code == OK
+        assert resp4.get_json()[ep.NUM_RECS] == 1
+
+
+@patch('cities.queries.read', side_effect=ValueError('too many'))
+def test_cities_read_refused_when_too_many(mock_read):
+    resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}')
+    assert resp.status_code == BAD_REQUEST
+    assert f'{ep.CITIES_EPS}/{ep.EXPORT}' in resp.get_json()[ep.ERROR]
+
+
+def test_cities_read_reuses_encoded_body():
+    cities = {'1': {'id': '1', 'name': 'Albany', 'state_code': 'NY'}}
+    with patch('cities.queries.read', return_value=cities), \
+            patch('cities.queries.cache_loaded', True), \
+            patch('cities.queries.cache_version', 11), \
+            patch('server.serialize.dumps',
+                  wraps=ep.serialize.dumps) as mock_dumps:
+        resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}')
+        resp2 = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}')
+        assert resp.data == resp2.data
+        assert resp.get_json()[ep.CITY_RESP] == cities
+        assert mock_dumps.call_count == 1
+
+
+def test_cities_read_gzipped_once_per_version():
+    cities = {str(i): {'id': str(i), 'name': f'City {i}', 'state_code': 'NY'}
+              for i in range(200)}
+    gzip_hdr = {'Accept-Encoding': 'gzip'}
+    with patch('cities.queries.read', return_value=cities), \
+            patch('cities.queries.cache_loaded', True), \
+            patch('cities.queries.cache_version', 12), \
+            patch('server.compress.compress',
+                  wraps=ep.compress.compress) as mock_compress:
+        resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}', headers=gzip_hdr)
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in resp.headers['Vary']
+        body = json.loads(gzip.decompress(resp.data))
+        assert body[ep.CITY_RESP] == cities
+        resp2 = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}', headers=gzip_hdr)
+        assert resp2.data == resp.data
+        assert mock_compress.call_count == 1
+        # the gzipped tag is still recognised
+        tag = resp.headers['ETag']
+        resp3 = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}',
+                                headers={'If-None-Match': tag})
+        assert resp3.status_code == NOT_MODIFIED
+        plain = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.READ}')
+        assert 'Content-Encoding' not in plain.headers
+        assert plain.headers['ETag'] != resp.headers['ETag']
+
+
+def test_small_response_not_compressed():
+    resp = TEST_CLIENT.get(ep.HELLO_EP, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.get_json() == {ep.HELLO_RESP: 'world'}
+
+
+def test_cities_export_streams_ndjson():
+    docs = [{'id': str(i), 'name': f'City {i}'} for i in range(3)]
+    with patch('cities.queries.export',
+               return_value=iter(docs)) as mock_export:
+        resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.EXPORT}'
+                               '?state_code=NY&fields=id,name',
+                               headers={'Accept-Encoding': 'gzip'})
+        assert resp.status_code == OK
+        assert resp.mimetype == 'application/x-ndjson'
+        assert 'Content-Encoding' not in resp.headers
+        lines = resp.data.decode().splitlines()
+        assert [json.loads(line) for line in lines] == docs
+        mock_export.assert_called_once_with(fields=['id', 'name'],
+                                            state_code='NY', name=None)
+
+
+def test_states_export_db_down():
+    with patch('USstates.queries.export', side_effect=ConnectionError('x')):
+        resp = TEST_CLIENT.get(f'{ep.STATES_EPS}/{ep.EXPORT}')
+        assert resp.status_code == SERVICE_UNAVAILABLE
+
+
+def test_cities_search():
+    found = [{'id': '1', 'name': 'Albany', 'state_code': 'NY'}]
+    with patch('cities.queries.search', return_value=found) as mock_search:
+        resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.SEARCH}'
+                               '?prefix=al&state_code=NY&limit=500')
+        assert resp.status_code == OK
+        assert resp.get_json() == found
+        mock_search.assert_called_once_with('al', state_code='NY',
+                                            limit=ep.MAX_SEARCH_LIMIT,
+                                            fuzzy=False)
+
+
+def test_cities_fuzzy_search():
+    with patch('cities.queries.search', return_value=[]) as mock_search:
+        resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.SEARCH}'
+                               '?q=Philadelpia&fuzzy=true')
+        assert resp.status_code == OK
+        mock_search.assert_called_once_with(
+            'Philadelpia', state_code=None,
+            limit=ep.cqry.DEFAULT_SEARCH_LIMIT, fuzzy=True,
+        )
+
+
+def test_cities_search_needs_prefix():
+    resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.SEARCH}')
+    assert resp.status_code == BAD_REQUEST
+
+
+def test_cities_near():
+    with patch('cities.queries.near', return_value=[]) as mock_near:
+        resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.NEAR}'
+                               '?lat=40.7&lon=-74&k=500&radius=25')
+        assert resp.status_code == OK
+        mock_near.assert_called_once_with(40.7, -74.0, k=ep.MAX_NEAR_K,
+                                          radius_km=25.0)
+
+
+def test_cities_near_bad_query():
+    resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.NEAR}?lat=40.7')
+    assert resp.status_code == BAD_REQUEST
+
+
+def test_cities_stats_by_state():
+    with patch('cities.queries.count_by_state',
+               return_value={'NY': 2, 'NJ': 1}):
+        resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/{ep.STATS}/{ep.BY_STATE}')
+        assert resp.status_code == OK
+        assert resp.get_json()[ep.CITY_COUNTS_RESP] == {'NY': 2, 'NJ': 1}
+
+
+def test_state_city_count():
+    with patch('cities.queries.count_in_state', return_value=4):
+        resp = TEST_CLIENT.get(f'{ep.STATES_EPS}/ny/{ep.COUNT}')
+        assert resp.status_code == OK
+        assert resp.get_json() == {ep.STATE_CODE: 'NY', ep.NUM_CITIES: 4}
+
+
+def test_city_detail():
+    rec = {'id': 'c1', 'name': 'Albany', 'state_code': 'NY'}
+    with patch('cities.queries.read_one',
+               return_value=rec) as mock_read_one:
+        resp = TEST_CLIENT.get(f'{ep.CITIES_EPS}/c1')
+        assert resp.status_code == OK
+        assert resp.get_json() == rec
+        mock_read_one.assert_called_once_with('c1')
+
+
+def test_metrics_endpoint():
+    TEST_CLIENT.get(ep.HELLO_EP)
+    resp = TEST_CLIENT.get(ep.METRICS_EP)
+    assert resp.status_code == OK
+    assert resp.content_type == ep.metrics.CONTENT_TYPE
+    text = resp.get_data(as_text=True)
+    assert '# TYPE http_request_seconds histogram' in text
+    assert ('http_request_seconds_count'
+            '{method="GET",endpoint="/hello",status="200"}') in text
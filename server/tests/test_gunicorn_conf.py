@@ -0,0 +1,30 @@
+import importlib.util
+import os
+from unittest.mock import MagicMock, patch
+
+CONF_PATH = os.path.join(os.path.dirname(__file__), '..', 'gunicorn.conf.py')
+
+
+def load_conf():
+    spec = importlib.util.spec_from_file_location('gunicorn_conf', CONF_PATH)
+    conf = importlib.util.module_from_spec(spec)
+    with patch.dict(os.environ):
+        spec.loader.exec_module(conf)
+    return conf
+
+
+def test_post_worker_init_prewarms():
+    conf = load_conf()
+    assert conf.preload_app
+    worker = MagicMock()
+    with patch('data.db_connect.prewarm', return_value=True) as mock_prewarm:
+        conf.post_worker_init(worker)
+    mock_prewarm.assert_called_once_with()
+    worker.log.warning.assert_not_called()
+
+
+def test_post_worker_init_warns_when_db_down():
+    worker = MagicMock()
+    with patch('data.db_connect.prewarm', return_value=False):
+        load_conf().post_worker_init(worker)
+    worker.log.warning.assert_called_once()
@@ -0,0 +1,37 @@
+import json
+from unittest.mock import MagicMock, patch
+
+from bson import ObjectId
+
+import server.serialize as ser
+
+
+def test_dumps():
+    oid = ObjectId()
+    data = {'name': 'Albany', '_id': oid, 'n': [1, 2]}
+    assert json.loads(ser.dumps(data)) == {'name': 'Albany', '_id': str(oid),
+                                           'n': [1, 2]}
+
+
+def test_dumps_without_orjson():
+    with patch.object(ser, 'orjson', None):
+        assert json.loads(ser.dumps({'a': ObjectId()}))['a']
+
+
+def test_snapshot_encodes_once_per_etag():
+    build = MagicMock(return_value={'a': 1})
+    with patch.dict(ser.snapshots, {}, clear=True):
+        first = ser.snapshot('/x', 'v1', build)
+        assert ser.snapshot('/x', 'v1', build) is first
+        assert build.call_count == 1
+        ser.snapshot('/x', 'v2', build)
+        assert build.call_count == 2
+
+
+def test_snapshots_bounded_by_bytes():
+    snaps = ser.BoundedCache(max_bytes=100, sizeof=ser._snapshot_size)
+    with patch.object(ser, 'snapshots', snaps):
+        ser.snapshot('a', 'v1', lambda: 'x' * 60)
+        ser.snapshot('b', 'v1', lambda: 'y' * 60)
+        assert list(snaps) == ['b']
+        assert snaps.total_bytes == 62